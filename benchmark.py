@@ -0,0 +1,49 @@
+import argparse
+import sys
+
+from lib import benchmark
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description='Benchmark parsing, traversal, transpilation, execution and returns on synthetic symphonies (offline)')
+    parser.add_argument('-s', '--scenario', dest='scenarios', action='append', choices=list(benchmark.SCENARIOS.keys()),
+                        help='scenario to run, can be repeated (default: all)')
+    parser.add_argument('--stage', dest='stages', action='append', choices=benchmark.STAGES,
+                        help='stage to run, can be repeated (default: all)')
+    parser.add_argument('-r', '--repeat', dest='repeat', type=int, default=3,
+                        help='timed runs per stage, fastest is kept')
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    parser.add_argument('--baseline', dest='baseline', default=benchmark.DEFAULT_BASELINE_PATH,
+                        help='baseline json path')
+    parser.add_argument('--save-baseline', dest='save_baseline', action='store_true', default=False,
+                        help='store these results as the new baseline')
+    parser.add_argument('--check', dest='check', action='store_true', default=False,
+                        help='exit non-zero if any stage regressed beyond its budget')
+    parser.add_argument('--time-budget', dest='time_budget', type=float, default=benchmark.DEFAULT_TIME_BUDGET,
+                        help='allowed slowdown over baseline, 0.25 = 25%%')
+    parser.add_argument('--memory-budget', dest='memory_budget', type=float, default=benchmark.DEFAULT_MEMORY_BUDGET,
+                        help='allowed peak memory growth over baseline, 0.25 = 25%%')
+    args = parser.parse_args()
+
+    results = benchmark.run_benchmarks(
+        args.scenarios, args.stages, repeat=args.repeat, seed=args.seed)
+
+    baseline = benchmark.load_baseline(args.baseline)
+    comparisons = benchmark.compare_to_baseline(
+        results, baseline, time_budget=args.time_budget, memory_budget=args.memory_budget) if baseline else []
+    print(benchmark.format_results(results, comparisons))
+
+    if args.save_baseline:
+        benchmark.save_baseline(results, args.baseline)
+        print(f"Saved baseline to {args.baseline}")
+
+    regressions = [c for c in comparisons if c["regressed"]]
+    if args.check and regressions:
+        print(f"{len(regressions)} stage(s) regressed")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
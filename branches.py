@@ -1,6 +1,6 @@
 import json
 import os
-from lib import symphony_object, get_backtest_data, transpilers, traversers
+from lib import symphony_object, get_backtest_data, trading_calendar, transpilers, traversers
 
 
 def main():
@@ -31,17 +31,16 @@ def main():
             print(f"  skipping {e}")
             continue
 
-        backtest_start = allocations.dropna().index.min().date()
+        # already aligned by execute
+        start = trading_calendar.get_first_complete_position(allocations)
+        backtest_start = allocations.index[start].date()
 
-        allocations_aligned = allocations[allocations.index.date >=
-                                          backtest_start]
-        branch_tracker_aligned = branch_tracker[branch_tracker.index.date >= backtest_start]
+        allocations_aligned = allocations.iloc[start:]
+        branch_tracker_aligned = branch_tracker.slice_days(start)
 
         # Make sure they are useful
-        branches_by_failed_allocation_days = branch_tracker_aligned[(
-            allocations_aligned.sum(axis=1) - 1).abs() > 0.0001].sum(axis=0)
-        branches_with_failed_allocation_days = branches_by_failed_allocation_days[
-            branches_by_failed_allocation_days != 0].index.values
+        branches_with_failed_allocation_days = transpilers.VectorBTTranspiler.extract_branches_with_incorrect_allocations(
+            allocations_aligned, branch_tracker_aligned)
 
         if len(branches_with_failed_allocation_days):
             print(f"  {len(branches_with_failed_allocation_days)}")
@@ -51,14 +50,14 @@ def main():
         branches_by_leaf_node_id = {
             key.split("/")[-1]: value for key, value in branches_by_path.items()}
 
-        for branch_id in branch_tracker.columns:
-            if not branch_tracker[branch_id].sum():
+        days_active_by_branch_id = branch_tracker.counts()
+        for branch_id in branch_tracker.branch_ids:
+            if not days_active_by_branch_id[branch_id]:
                 continue
             node = traversers.find_node_by_id(root_node, branch_id)
             possible_allocations = traversers.collect_allocateable_assets(node)
             condition = branches_by_leaf_node_id[branch_id]
-            print("  ", branch_id, branch_tracker[branch_id].sum(
-            ))
+            print("  ", branch_id, days_active_by_branch_id[branch_id])
 
             json.dump({
                 "origin": symphony_id,
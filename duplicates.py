@@ -0,0 +1,43 @@
+import argparse
+import json
+
+import pandas as pd
+
+from lib import subtrees, symphony_object
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Find cached symphonies that are structurally identical (ignoring ids, names, prices) or share most of their subtrees')
+    parser.add_argument('symphony_ids', nargs='*',
+                        help='symphony ids to compare (default: every cached symphony in outputs/symphonies)')
+    parser.add_argument('-t', '--threshold', dest='threshold', type=float, default=subtrees.DEFAULT_SIMILARITY_THRESHOLD,
+                        help='min fraction of shared subtrees (Jaccard) to report a near-duplicate')
+    parser.add_argument('-o', '--outfile', dest='outfile', default='outputs/duplicates.csv',
+                        help='csv report path')
+    args = parser.parse_args()
+
+    root_nodes_by_id = {}
+    for symphony_id in args.symphony_ids or symphony_object.get_cached_symphony_ids():
+        try:
+            symphony = json.load(
+                open(f'outputs/symphonies/{symphony_id}/symphony.json'))
+        except FileNotFoundError:
+            continue
+        root_nodes_by_id[symphony_id] = symphony_object.extract_root_node_from_symphony_response(
+            symphony)
+
+    duplicates = subtrees.find_duplicates(
+        root_nodes_by_id, threshold=args.threshold)
+    for duplicate in duplicates:
+        print(
+            f"{duplicate['symphony_id']} ~ {duplicate['other_symphony_id']}: {duplicate['kind']} ({duplicate['similarity']:.0%} of subtrees shared)")
+
+    pd.DataFrame(duplicates, columns=["symphony_id", "other_symphony_id", "kind", "similarity", "shared_subtrees"]).to_csv(
+        args.outfile, index=False)
+    shared_hashes = subtrees.find_shared_subtrees(root_nodes_by_id)
+    print(f"{len(duplicates)} duplicate pairs, {len(shared_hashes)} subtrees shared by several symphonies")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import argparse
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+from lib import get_backtest_data, latest_allocation, online_indicators, quote_stream, symphony_object
+
+
+def format_weights(weights) -> str:
+    return " ".join(f"{ticker}={weight:.1%}" for ticker, weight in sorted(weights.items()) if weight)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Would-be allocations of cached symphonies as intraday quotes come in, each quote being its ticker's provisional close for today")
+    parser.add_argument('symphony_ids', nargs='*',
+                        help='symphony ids to evaluate (default: every cached symphony in outputs/symphonies)')
+    parser.add_argument('-r', '--replay', dest='replay', required=True,
+                        help='csv of quotes (time,ticker,price) to replay, - for stdin')
+    parser.add_argument('--checkpoint', dest='checkpoint', default='outputs/online_indicators.json',
+                        help='online indicator states, brought up to the last close first (see latest_allocations.py --checkpoint)')
+    parser.add_argument('--day', dest='day', default=None,
+                        help='day the quotes are for (default: today)')
+    args = parser.parse_args()
+
+    root_nodes_by_id = {}
+    for symphony_id in args.symphony_ids or symphony_object.get_cached_symphony_ids():
+        try:
+            symphony = json.load(
+                open(f'outputs/symphonies/{symphony_id}/symphony.json'))
+        except FileNotFoundError:
+            continue
+        root_nodes_by_id[symphony_id] = symphony_object.extract_root_node_from_symphony_response(
+            symphony)
+
+    indicators = online_indicators.update_checkpoint(
+        root_nodes_by_id, args.checkpoint, days=latest_allocation.TAIL_SLACK_DAYS)
+    last_closes = get_backtest_data.get_price_tails(
+        {ticker: 1 for ticker in indicators.get_tickers()}).ffill().iloc[-1].to_dict()
+    stream = quote_stream.QuoteStream(
+        root_nodes_by_id, indicators, last_closes, pd.Timestamp(args.day or pd.Timestamp.today()))
+    for symphony_id, reason in stream.unsupported.items():
+        print(f"skipping {symphony_id}: {reason}")
+    for symphony_id, allocation in stream.allocations.items():
+        print(f"open {symphony_id}: {format_weights(allocation.weights)}")
+
+    latencies = []
+    for quote in quote_stream.read_replay(args.replay):
+        start = time.perf_counter()
+        changed_symphony_ids = stream.on_quote(quote.ticker, quote.price)
+        latencies.append(time.perf_counter() - start)
+        for symphony_id in changed_symphony_ids:
+            print(f"{quote.time} {quote.ticker} {quote.price} {symphony_id}: {format_weights(stream.allocations[symphony_id].weights)}")
+
+    if latencies:
+        print(f"{len(latencies)} quotes, {len(root_nodes_by_id)} symphonies: median {np.median(latencies) * 1e6:.0f}us, p99 {np.percentile(latencies, 99) * 1e6:.0f}us per quote")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import argparse
+import json
+import time
+
+import pandas as pd
+
+from lib import latest_allocation, online_indicators, symphony_object
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Today's target weights of cached symphonies, from the tail of prices each indicator needs (no backtest)")
+    parser.add_argument('symphony_ids', nargs='*',
+                        help='symphony ids to evaluate (default: every cached symphony in outputs/symphonies)')
+    parser.add_argument('-o', '--outfile', dest='outfile', default='outputs/latest_allocations.csv',
+                        help='csv of (symphony_id, day, ticker, weight, active_branch_ids)')
+    parser.add_argument('--checkpoint', dest='checkpoint', default=None,
+                        help='online indicator states (e.g. outputs/online_indicators.json): only price rows after the checkpoint are read and fed, then it is saved again')
+    args = parser.parse_args()
+
+    root_nodes_by_id = {}
+    for symphony_id in args.symphony_ids or symphony_object.get_cached_symphony_ids():
+        try:
+            symphony = json.load(
+                open(f'outputs/symphonies/{symphony_id}/symphony.json'))
+        except FileNotFoundError:
+            continue
+        root_nodes_by_id[symphony_id] = symphony_object.extract_root_node_from_symphony_response(
+            symphony)
+
+    start = time.perf_counter()
+    if args.checkpoint:
+        allocations, failures = latest_allocation.get_latest_allocations(
+            root_nodes_by_id, indicator_values=online_indicators.update_checkpoint(root_nodes_by_id, args.checkpoint, days=latest_allocation.TAIL_SLACK_DAYS))
+    else:
+        allocations, failures = latest_allocation.get_latest_allocations(
+            root_nodes_by_id)
+    for symphony_id, failure in failures.items():
+        print(f"{symphony_id}: {failure}")
+
+    rows = []
+    for symphony_id, allocation in allocations.items():
+        for ticker, weight in sorted(allocation.weights.items()):
+            rows.append({
+                "symphony_id": symphony_id,
+                "day": allocation.day.date().isoformat(),
+                "ticker": ticker,
+                "weight": weight,
+                "active_branch_ids": " ".join(allocation.active_branch_ids),
+            })
+    pd.DataFrame(rows, columns=["symphony_id", "day", "ticker", "weight", "active_branch_ids"]).to_csv(
+        args.outfile, index=False)
+    print(f"{len(allocations)} symphonies allocated, {len(failures)} failed in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+import glob
+import json
+import os
+import typing
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.fs
+
+from . import atomic_files
+from .branch_tracker import BranchTracker
+from .sparse_allocations import SparseAllocations
+
+
+#
+# Columnar store for per-symphony artifacts
+# - Arrow IPC files (uncompressed, so they memory-map), hive-partitioned:
+#     outputs/artifacts/<artifact type>/symphony_id=<id>/part-<n>.arrow
+# - overwrite or append per symphony, without touching other symphonies
+# - one dataset scan loads an artifact for every symphony (e.g. load_all_returns)
+# - all artifacts are "long" tables keyed by Date
+#
+ARTIFACT_STORE_DIR = "outputs/artifacts"
+ARTIFACT_TYPES = ["allocations", "branch_tracker", "returns"]
+
+PARTITIONING = ds.partitioning(
+    pa.schema([("symphony_id", pa.string())]), flavor="hive")
+
+
+def get_partition_dir(artifact_type: str, symphony_id: str) -> str:
+    return f"{ARTIFACT_STORE_DIR}/{artifact_type}/symphony_id={symphony_id}"
+
+
+def get_part_paths(artifact_type: str, symphony_id: str) -> typing.List[str]:
+    return sorted(glob.glob(f"{get_partition_dir(artifact_type, symphony_id)}/part-*.arrow"), key=lambda path: int(path.rsplit("-", 1)[1].split(".")[0]))
+
+
+def has_artifact(artifact_type: str, symphony_id: str) -> bool:
+    return bool(get_part_paths(artifact_type, symphony_id))
+
+
+def write_table(artifact_type: str, symphony_id: str, table: pa.Table, mode: str = "overwrite"):
+    """
+    mode="append" adds a part after the stored ones; days it has that are already stored replace them (the partition is rewritten).
+    """
+    assert mode in ("overwrite", "append"), f"unexpected mode {mode}"
+    partition_dir = get_partition_dir(artifact_type, symphony_id)
+    os.makedirs(partition_dir, exist_ok=True)
+
+    existing_paths = get_part_paths(artifact_type, symphony_id)
+    if mode == "append" and existing_paths:
+        existing = read_table(artifact_type, symphony_id)
+        stored = pc.is_in(existing.column("Date"),
+                          value_set=table.column("Date").combine_chunks())
+        if pc.any(stored).as_py():
+            table = concat_parts(
+                [existing.filter(pc.invert(stored)), table]).sort_by("Date")
+            mode = "overwrite"
+    part_number = len(existing_paths) if mode == "append" else 0
+    path = f"{partition_dir}/part-{part_number}.arrow"
+    with atomic_files.replacing(path) as partial_path:
+        with pa.OSFile(partial_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        if mode == "overwrite":
+            for existing_path in existing_paths:
+                if existing_path != path:
+                    os.remove(existing_path)
+
+
+def concat_parts(tables: typing.List[pa.Table]) -> pa.Table:
+    """
+    Parts are written with their own labels (tickers, branch_ids metadata): label lists are merged in first-seen order,
+    so every part's labels resolve, other metadata comes from the last part.
+    """
+    metadata = {}
+    for table in tables:
+        for key, value in (table.schema.metadata or {}).items():
+            value = json.loads(value)
+            if isinstance(value, list) and isinstance(metadata.get(key), list):
+                value = metadata[key] + \
+                    [label for label in value if label not in metadata[key]]
+            metadata[key] = value
+    table = pa.concat_tables([table.replace_schema_metadata(None) for table in tables])
+    return table.replace_schema_metadata({key.decode(): json.dumps(value) for key, value in metadata.items()} if metadata else None)
+
+
+def read_table(artifact_type: str, symphony_id: str) -> pa.Table:
+    tables = []
+    for path in get_part_paths(artifact_type, symphony_id):
+        with pa.memory_map(path) as source:
+            tables.append(pa.ipc.open_file(source).read_all())
+    if not tables:
+        raise FileNotFoundError(
+            f"no {artifact_type} artifact for {symphony_id}")
+    return concat_parts(tables)
+
+
+def scan_table(artifact_type: str, symphony_ids: typing.Optional[typing.Iterable[str]] = None, columns: typing.Optional[typing.List[str]] = None) -> pa.Table:
+    """
+    One scan over every symphony's partition, with a symphony_id column.
+    """
+    dataset = ds.dataset(
+        f"{ARTIFACT_STORE_DIR}/{artifact_type}",
+        format="ipc",
+        partitioning=PARTITIONING,
+        filesystem=pyarrow.fs.LocalFileSystem(use_mmap=True),
+    )
+    return dataset.to_table(
+        columns=columns,
+        filter=ds.field("symphony_id").isin(
+            list(symphony_ids)) if symphony_ids is not None else None,
+    )
+
+
+def build_dates_array(index: pd.DatetimeIndex, row_numbers: np.ndarray) -> pa.Array:
+    return pa.array(index.values.astype("datetime64[ns]")[row_numbers])
+
+
+def attach_metadata(table: pa.Table, **metadata) -> pa.Table:
+    return table.replace_schema_metadata({key: json.dumps(value) for key, value in metadata.items()})
+
+
+def read_metadata(table: pa.Table, key: str):
+    return json.loads(table.schema.metadata[key.encode()])
+
+
+def build_sparse_rows(dates: np.ndarray, labels: np.ndarray, label_order: typing.List[str]) -> typing.Tuple[pd.DatetimeIndex, np.ndarray, np.ndarray]:
+    """
+    Long (Date, label) rows back to (index, row numbers, label positions); null labels only keep a day in the index.
+    """
+    index = pd.DatetimeIndex(np.unique(dates), name="Date")
+    row_numbers = index.get_indexer(dates)
+    present = pd.notna(labels)
+    label_positions = pd.Index(label_order).get_indexer(labels[present])
+    return index, row_numbers[present], label_positions
+
+
+#
+# Allocations: (Date, ticker, weight), days without any weight get one null-ticker row
+#
+def write_allocations(symphony_id: str, allocations: SparseAllocations, mode: str = "overwrite"):
+    row_numbers = allocations.get_row_numbers()
+    empty_row_numbers = np.flatnonzero(np.diff(allocations.indptr) == 0)
+    order = np.argsort(np.concatenate(
+        [row_numbers, empty_row_numbers]), kind="stable")
+
+    tickers = np.array(allocations.tickers + [None], dtype=object)
+    table = pa.table({
+        "Date": build_dates_array(allocations.index, np.concatenate([row_numbers, empty_row_numbers])[order]),
+        "ticker": pa.array(np.concatenate([tickers[allocations.ticker_indices], np.full(len(empty_row_numbers), None, dtype=object)])[order], type=pa.string()).dictionary_encode(),
+        "weight": np.concatenate([allocations.weights, np.zeros(len(empty_row_numbers))])[order],
+    })
+    write_table("allocations", symphony_id, attach_metadata(
+        table, tickers=allocations.tickers), mode=mode)
+
+
+def read_allocations(symphony_id: str) -> SparseAllocations:
+    table = read_table("allocations", symphony_id)
+    tickers = read_metadata(table, "tickers")
+    dates = table.column("Date").to_numpy()
+    labels = table.column("ticker").to_pandas().to_numpy(dtype=object)
+    weights = table.column("weight").to_numpy()
+
+    index, row_numbers, ticker_indices = build_sparse_rows(
+        dates, labels, tickers)
+    indptr = np.zeros(len(index) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(row_numbers, minlength=len(index)), out=indptr[1:])
+    order = np.argsort(row_numbers, kind="stable")
+    return SparseAllocations(
+        index=index,
+        tickers=tickers,
+        indptr=indptr,
+        ticker_indices=ticker_indices[order].astype(np.int32),
+        weights=weights[pd.notna(labels)][order],
+    )
+
+
+#
+# Branch tracker: (Date, branch_id) for every active branch, days without any get one null row
+#
+def write_branch_tracker(symphony_id: str, branch_tracker: BranchTracker, mode: str = "overwrite"):
+    bits = branch_tracker.to_bits()
+    row_numbers, branch_indices = np.nonzero(bits)
+    empty_row_numbers = np.flatnonzero(~bits.any(axis=1))
+    order = np.argsort(np.concatenate(
+        [row_numbers, empty_row_numbers]), kind="stable")
+
+    branch_ids = np.array(branch_tracker.branch_ids + [None], dtype=object)
+    table = pa.table({
+        "Date": build_dates_array(branch_tracker.index, np.concatenate([row_numbers, empty_row_numbers])[order]),
+        "branch_id": pa.array(np.concatenate([branch_ids[branch_indices], np.full(len(empty_row_numbers), None, dtype=object)])[order], type=pa.string()).dictionary_encode(),
+    })
+    write_table("branch_tracker", symphony_id, attach_metadata(
+        table, branch_ids=branch_tracker.branch_ids), mode=mode)
+
+
+def read_branch_tracker(symphony_id: str) -> BranchTracker:
+    table = read_table("branch_tracker", symphony_id)
+    branch_ids = read_metadata(table, "branch_ids")
+    index, row_numbers, branch_indices = build_sparse_rows(
+        table.column("Date").to_numpy(), table.column("branch_id").to_pandas().to_numpy(dtype=object), branch_ids)
+    bits = np.zeros((len(index), len(branch_ids)), dtype=bool)
+    bits[row_numbers, branch_indices] = True
+    return BranchTracker.from_bits(index, branch_ids, bits)
+
+
+#
+# Returns: (Date, returns)
+#
+def write_returns(symphony_id: str, returns: pd.Series, mode: str = "overwrite"):
+    write_table("returns", symphony_id, pa.table({
+        "Date": pa.array(returns.index.values.astype("datetime64[ns]")),
+        "returns": returns.to_numpy(dtype=np.float64),
+    }), mode=mode)
+
+
+def read_returns(symphony_id: str) -> pd.Series:
+    # named like VectorBTTranspiler.get_returns output
+    frame = read_table("returns", symphony_id).to_pandas()
+    return pd.Series(frame["returns"].to_numpy(), index=pd.DatetimeIndex(frame["Date"], name="Date"), name="group").sort_index()
+
+
+def load_all_returns(symphony_ids: typing.Optional[typing.Iterable[str]] = None) -> pd.DataFrame:
+    """
+    (days, symphonies) returns for every stored symphony, NaN outside each one's backtest.
+    """
+    frame = scan_table("returns", symphony_ids).to_pandas()
+    if frame.empty:
+        return pd.DataFrame(index=pd.DatetimeIndex([], name="Date"))
+    frame["symphony_id"] = frame["symphony_id"].astype(str)
+    wide = frame.pivot(index="Date", columns="symphony_id", values="returns")
+    wide.columns.name = None
+    return wide
+
+
+def export_csvs(symphony_id: str, directory: str):
+    """
+    The old per-symphony CSV files, for anything still reading them.
+    """
+    if has_artifact("allocations", symphony_id):
+        read_allocations(symphony_id).to_frame().to_csv(
+            f"{directory}/allocations.csv")
+    if has_artifact("branch_tracker", symphony_id):
+        read_branch_tracker(symphony_id).to_frame().to_csv(
+            f"{directory}/branch_tracker.csv")
+    if has_artifact("returns", symphony_id):
+        read_returns(symphony_id).to_csv(f"{directory}/returns.csv")
+
+
+def check_append_round_trip():
+    """
+    Appends with new labels and already stored days, in a scratch store, read back like one overwrite.
+    """
+    import tempfile
+
+    global ARTIFACT_STORE_DIR
+    artifact_store_dir = ARTIFACT_STORE_DIR
+    try:
+        with tempfile.TemporaryDirectory() as ARTIFACT_STORE_DIR:
+            index = pd.bdate_range("2023-01-02", periods=6, name="Date")
+            allocations = pd.DataFrame(0.0, index=index, columns=["SPY", "TLT", "QQQ"])
+            allocations.iloc[:3, :2] = 0.5
+            # QQQ is only in the appended part, the 3rd day is stored twice
+            allocations.iloc[2:, 2] = 1.0
+            allocations.iloc[2, :2] = 0.0
+            branch_tracker = pd.DataFrame(0, index=index, columns=["a", "b"])
+            branch_tracker.iloc[:3, 0] = 1
+            branch_tracker.iloc[2:, 0] = 0
+            branch_tracker.iloc[2:, 1] = 1
+            returns = pd.Series(np.arange(6) / 100, index=index, name="group")
+
+            write_allocations("check", SparseAllocations.from_frame(
+                allocations.iloc[:3, :2]))
+            write_allocations("check", SparseAllocations.from_frame(
+                allocations.iloc[3:, 1:]), mode="append")
+            write_allocations("check", SparseAllocations.from_frame(
+                allocations.iloc[2:3, 2:]), mode="append")
+            write_branch_tracker("check", BranchTracker.from_frame(
+                branch_tracker.iloc[:3, :1]))
+            write_branch_tracker("check", BranchTracker.from_frame(
+                branch_tracker.iloc[2:, 1:]), mode="append")
+            write_returns("check", returns.iloc[:4])
+            write_returns("check", returns.iloc[2:], mode="append")
+
+            pd.testing.assert_frame_equal(read_allocations(
+                "check").to_frame(), allocations, check_freq=False)
+            pd.testing.assert_frame_equal(read_branch_tracker(
+                "check").to_frame(), branch_tracker, check_freq=False)
+            pd.testing.assert_series_equal(
+                read_returns("check"), returns, check_freq=False)
+            pd.testing.assert_series_equal(load_all_returns()[
+                "check"], returns, check_freq=False, check_names=False)
+    finally:
+        ARTIFACT_STORE_DIR = artifact_store_dir
+    print("append round trip ok")
+
+
+def main():
+    check_append_round_trip()
+    returns = load_all_returns()
+    print(returns.describe().T)
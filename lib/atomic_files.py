@@ -0,0 +1,60 @@
+import contextlib
+import os
+import typing
+
+
+#
+# Files replaced in one step: readers (and interrupted runs) see the old file or the whole new one, never half of it
+# - written to a temp file next to it, then os.replace'd over it (same directory, so the same filesystem)
+# - the temp name is per process: two runs, or --workers processes, writing the same file never write into the same temp file
+# - the temp name is dot-prefixed, so glob("*") and Arrow dataset scans of the directory skip it
+#
+
+
+def get_partial_path(path: str) -> str:
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f".{name}.{os.getpid()}.partial")
+
+
+@contextlib.contextmanager
+def replacing(path: str) -> typing.Iterator[str]:
+    """
+    Yields the temp path to write path's new content to, moved over path when the block exits without an exception (removed otherwise).
+    """
+    partial_path = get_partial_path(path)
+    try:
+        yield partial_path
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(partial_path)
+        raise
+    os.replace(partial_path, path)
+
+
+@contextlib.contextmanager
+def open_replacing(path: str, mode: str = "w") -> typing.Iterator[typing.IO]:
+    """
+    open(path, mode) for writing, through replacing.
+    """
+    with replacing(path) as partial_path:
+        with open(partial_path, mode) as f:
+            yield f
+
+
+def main():
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "file.txt")
+        with open_replacing(path) as f:
+            f.write("first")
+        try:
+            with open_replacing(path) as f:
+                f.write("half")
+                raise RuntimeError("interrupted")
+        except RuntimeError:
+            pass
+        with open(path) as f:
+            assert f.read() == "first"
+        assert os.listdir(directory) == ["file.txt"], os.listdir(directory)
+    print("interrupted writes leave the old file")
@@ -0,0 +1,264 @@
+import typing
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+import vectorbt as vbt
+
+from . import instrumentation, subtrees, trading_calendar, transpilers, traversers
+from .branch_tracker import BranchTracker
+from .sparse_allocations import SparseAllocations
+
+
+#
+# Backtests many symphonies against one shared closes frame.
+#
+# Allocations are laid out "ragged": one column per (symphony_id, ticker) the
+# symphony can actually allocate toward, instead of a dense
+# (symphonies x days x tickers) tensor over the whole catalog universe (which is
+# mostly zeros and does not fit in memory for the full catalog).
+# `BatchBacktest.to_tensor` densifies on demand.
+#
+DEFAULT_CHUNK_SIZE = 250
+
+
+@dataclass
+class BatchBacktest:
+    symphony_ids: typing.List[str]
+    index: pd.DatetimeIndex
+    # MultiIndex of (symphony_id, ticker), one entry per column of `allocations`
+    columns: pd.MultiIndex
+    # (days, columns), NaN before each symphony's backtest start
+    allocations: np.ndarray
+    # (days, symphonies), NaN before (and on) each symphony's backtest start, and on days of other symphonies it does not have
+    returns: pd.DataFrame
+    backtest_starts: typing.Dict[str, pd.Timestamp]
+    failures: typing.Dict[str, str]
+    # each symphony's own days (its allocations' index), index is their union
+    indexes: typing.Dict[str, pd.DatetimeIndex] = field(default_factory=dict)
+
+    def get_days(self, symphony_id: str, after: bool = False) -> pd.DatetimeIndex:
+        # the symphony's own days from its backtest start (after it, with after=True)
+        backtest_start = self.backtest_starts[symphony_id]
+        index = self.indexes.get(symphony_id, self.index)
+        if pd.isna(backtest_start):
+            return index[:0]
+        return index[index.searchsorted(backtest_start, side="right" if after else "left"):]
+
+    def get_start_position(self, symphony_id: str) -> int:
+        # position of the backtest start in index (len if the symphony never allocates)
+        backtest_start = self.backtest_starts[symphony_id]
+        return len(self.index) if pd.isna(backtest_start) else int(self.index.searchsorted(backtest_start))
+
+    def get_allocations(self, symphony_id: str) -> pd.DataFrame:
+        mask = self.columns.get_level_values(0) == symphony_id
+        days = self.get_days(symphony_id)
+        positions = trading_calendar.TradingCalendar(
+            self.index).get_positions(days)
+        return pd.DataFrame(
+            self.allocations[positions][:, mask], index=days, columns=self.columns[mask].get_level_values(1))
+
+    def get_returns(self, symphony_id: str) -> pd.Series:
+        # on the symphony's own days only (like VectorBTTranspiler.get_returns), not every day of the batch
+        # named like VectorBTTranspiler.get_returns output, so returns.csv stays compatible
+        days = self.get_days(symphony_id, after=True)
+        return pd.Series(trading_calendar.TradingCalendar(self.index).take(
+            self.returns, days, [symphony_id])[:, 0], index=days, name="group")
+
+    def to_tensor(self) -> typing.Tuple[np.ndarray, typing.List[str]]:
+        """
+        Dense (symphonies, days, tickers) allocations over the union of allocated tickers.
+        """
+        tickers = sorted(set(self.columns.get_level_values(1)))
+        ticker_positions = {ticker: i for i, ticker in enumerate(tickers)}
+        symphony_positions = {
+            symphony_id: i for i, symphony_id in enumerate(self.symphony_ids)}
+
+        tensor = np.zeros(
+            (len(self.symphony_ids), len(self.index), len(tickers)))
+        for column_index, (symphony_id, ticker) in enumerate(self.columns):
+            tensor[symphony_positions[symphony_id], :, ticker_positions[ticker]] = np.nan_to_num(
+                self.allocations[:, column_index])
+        return tensor, tickers
+
+
+def collect_universe(root_nodes_by_id: typing.Mapping[str, dict]) -> typing.Set[str]:
+    tickers = set()
+    for root_node in root_nodes_by_id.values():
+        tickers.update(traversers.collect_referenced_assets(root_node))
+    return tickers
+
+
+def select_symphony_closes(closes: pd.DataFrame, root_node: dict) -> pd.DataFrame:
+    # same frame get_backtest_data would have built for this symphony alone
+    tickers = sorted(traversers.collect_referenced_assets(root_node))
+    return closes[tickers].dropna(how="all")
+
+
+def execute_symphonies(root_nodes_by_id: typing.Mapping[str, dict], closes: pd.DataFrame, ticker_index=None) -> typing.Tuple[typing.Dict[str, typing.Tuple[pd.DataFrame, pd.DataFrame]], typing.Dict[str, str]]:
+    results = {}
+    failures = {}
+    # subtrees copied between symphonies are evaluated once
+    subtree_cache = subtrees.SubtreeCache(
+        subtrees.find_shared_subtrees(root_nodes_by_id))
+    for symphony_id, root_node in root_nodes_by_id.items():
+        try:
+            results[symphony_id] = transpilers.VectorBTTranspiler.execute(
+                root_node, select_symphony_closes(closes, root_node), subtree_cache=subtree_cache, ticker_index=ticker_index)
+        except Exception as e:
+            failures[symphony_id] = f"Backtest error {e}"
+    return results, failures
+
+
+def stack_allocations(allocations_by_id: typing.Mapping[str, typing.Union[pd.DataFrame, SparseAllocations]], index: pd.DatetimeIndex) -> typing.Tuple[np.ndarray, pd.MultiIndex]:
+    column_tuples = []
+    blocks = []
+    for symphony_id, allocations in allocations_by_id.items():
+        if isinstance(allocations, SparseAllocations):
+            # scattered straight into the block, no intermediate frame
+            blocks.append(allocations.to_dense_block(index))
+            tickers = allocations.tickers
+        else:
+            blocks.append(trading_calendar.TradingCalendar(
+                allocations.index).take(allocations, index))
+            tickers = allocations.columns
+        column_tuples.extend((symphony_id, ticker) for ticker in tickers)
+    columns = pd.MultiIndex.from_tuples(
+        column_tuples, names=["symphony_id", "ticker"])
+    if not blocks:
+        return np.empty((len(index), 0)), columns
+    return np.hstack(blocks), columns
+
+
+def simulate_stacked_returns(closes: pd.DataFrame, allocations: np.ndarray, columns: pd.MultiIndex, index: pd.DatetimeIndex) -> pd.DataFrame:
+    """
+    One vectorbt simulation for every symphony at once: each symphony is its own cash-sharing group.
+    """
+    stacked_closes = trading_calendar.TradingCalendar(closes.index).take(
+        closes, index, columns.get_level_values(1))
+    with instrumentation.span("vectorbt_simulation", category="vectorbt", items=len(set(columns.get_level_values(0)))):
+        portfolio = vbt.Portfolio.from_orders(
+            close=pd.DataFrame(stacked_closes, index=index, columns=columns),
+            size=pd.DataFrame(allocations, index=index, columns=columns),
+            size_type="targetpercent",
+            group_by="symphony_id",
+            cash_sharing=True,
+            call_seq="auto",
+            freq='D',
+            fees=transpilers.BACKTEST_FEES,
+        )
+        returns = portfolio.asset_returns()
+    # vectorbt squeezes a single group down to a Series
+    if isinstance(returns, pd.Series):
+        returns = returns.to_frame(name=columns.get_level_values(0)[0])
+    return returns
+
+
+def simulate_returns(closes: pd.DataFrame, allocations_by_id: typing.Mapping[str, typing.Union[pd.DataFrame, SparseAllocations]], branch_trackers_by_id: typing.Optional[typing.Mapping[str, BranchTracker]] = None) -> BatchBacktest:
+    failures = {}
+    valid_allocations_by_id = {}
+    for symphony_id, allocations in allocations_by_id.items():
+        if branch_trackers_by_id is not None and len(transpilers.VectorBTTranspiler.extract_branches_with_incorrect_allocations(
+                allocations, branch_trackers_by_id[symphony_id])):
+            failures[symphony_id] = "Failed to get returns: found incomplete allocations (!= 100%)"
+            continue
+        valid_allocations_by_id[symphony_id] = allocations
+
+    symphony_ids = list(valid_allocations_by_id.keys())
+    # sparse allocations never have NaN days (they come from execute, already aligned)
+    backtest_starts = {}
+    for symphony_id, allocations in valid_allocations_by_id.items():
+        start = 0 if isinstance(allocations, SparseAllocations) else trading_calendar.get_first_complete_position(
+            allocations)
+        backtest_starts[symphony_id] = allocations.index[start] if start < len(
+            allocations.index) else pd.NaT
+
+    index = pd.DatetimeIndex([], name="Date")
+    for allocations in valid_allocations_by_id.values():
+        index = index.union(allocations.index)
+
+    allocations, columns = stack_allocations(valid_allocations_by_id, index)
+    if symphony_ids:
+        returns = simulate_stacked_returns(
+            closes, allocations, columns, index)[symphony_ids]
+    else:
+        returns = pd.DataFrame(index=index)
+    calendar = trading_calendar.TradingCalendar(index)
+    indexes = {}
+    for symphony_id, symphony_allocations in valid_allocations_by_id.items():
+        indexes[symphony_id] = pd.DatetimeIndex(
+            symphony_allocations.index, name="Date")
+        # days only other symphonies of the batch have (weekend tickers), nothing was held on them
+        own_days = np.zeros(len(index), dtype=bool)
+        own_days[calendar.get_positions(indexes[symphony_id])] = True
+        returns.iloc[~own_days, returns.columns.get_loc(symphony_id)] = np.nan
+    for symphony_id, backtest_start in backtest_starts.items():
+        if pd.isna(backtest_start):
+            continue
+        # for some reason, the first entry is -inf, breaks some stats
+        returns.iloc[:index.searchsorted(backtest_start, side="right"),
+                     returns.columns.get_loc(symphony_id)] = np.nan
+
+    return BatchBacktest(
+        symphony_ids=symphony_ids,
+        index=index,
+        columns=columns,
+        allocations=allocations,
+        returns=returns,
+        backtest_starts=backtest_starts,
+        failures=failures,
+        indexes=indexes,
+    )
+
+
+def run_batch_backtest(root_nodes_by_id: typing.Mapping[str, dict], closes: typing.Optional[pd.DataFrame] = None) -> BatchBacktest:
+    ticker_index = None
+    if closes is None:
+        from . import get_backtest_data
+        from .ticker_index import update_index
+        universe = collect_universe(root_nodes_by_id)
+        closes = get_backtest_data.get_backtest_data(universe)
+        # closes come from the price store, the index knows where each ticker starts
+        ticker_index = update_index(universe)
+    closes = typing.cast(pd.DataFrame, closes)
+
+    results, failures = execute_symphonies(
+        root_nodes_by_id, closes, ticker_index=ticker_index)
+    batch = simulate_returns(
+        closes,
+        {symphony_id: allocations for symphony_id,
+            (allocations, _branch_tracker) in results.items()},
+        {symphony_id: branch_tracker for symphony_id,
+            (_allocations, branch_tracker) in results.items()},
+    )
+    batch.failures.update(failures)
+    return batch
+
+
+def iter_batch_backtests(root_nodes_by_id: typing.Mapping[str, dict], closes: typing.Optional[pd.DataFrame] = None, chunk_size: int = DEFAULT_CHUNK_SIZE) -> typing.Iterator[BatchBacktest]:
+    """
+    Bounds memory for the whole catalog: one simulation per chunk of symphonies.
+    """
+    symphony_ids = list(root_nodes_by_id.keys())
+    for chunk_start in range(0, len(symphony_ids), chunk_size):
+        chunk_ids = symphony_ids[chunk_start:chunk_start + chunk_size]
+        yield run_batch_backtest({symphony_id: root_nodes_by_id[symphony_id] for symphony_id in chunk_ids}, closes)
+
+
+def main():
+    import json
+    from . import symphony_object, get_backtest_data
+
+    root_nodes_by_id = {}
+    for symphony_id in symphony_object.get_cached_symphony_ids():
+        symphony = json.load(
+            open(f'outputs/symphonies/{symphony_id}/symphony.json'))
+        root_nodes_by_id[symphony_id] = symphony_object.extract_root_node_from_symphony_response(
+            symphony)
+
+    closes = get_backtest_data.get_backtest_data(
+        collect_universe(root_nodes_by_id))
+    for batch in iter_batch_backtests(root_nodes_by_id, closes):
+        print(batch.returns.describe())
+        for symphony_id, failure in batch.failures.items():
+            print(f"  {symphony_id}: {failure}")
@@ -0,0 +1,198 @@
+import contextlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+import typing
+
+import edn_format
+
+from . import code_cache, edn_syntax, synthetic, transpilers, traversers, vectorbt
+
+
+#
+# Stage benchmarks on synthetic symphonies (fully offline)
+#
+DEFAULT_BASELINE_PATH = "benchmarks/baseline.json"
+# allowed slowdown/growth over baseline before a stage counts as a regression
+DEFAULT_TIME_BUDGET = 0.25
+DEFAULT_MEMORY_BUDGET = 0.25
+
+SCENARIOS = {
+    "small": {"symphonies": 4, "depth": 3, "breadth": 2, "tickers": 8, "days": 1260},
+    "medium": {"symphonies": 4, "depth": 4, "breadth": 3, "tickers": 20, "days": 2520},
+    "large": {"symphonies": 2, "depth": 6, "breadth": 3, "tickers": 40, "days": 5040},
+}
+# execute reuses the code compiled for the process (like every backtest of a symphony after its first),
+# execute_cold starts without compiled code in memory or on disk (a new or edited symphony)
+STAGES = ["parse", "traverse", "transpile", "execute", "execute_cold", "returns"]
+
+
+@contextlib.contextmanager
+def isolated_code_cache() -> typing.Iterator[str]:
+    """
+    Points code_cache at an empty temp dir with an empty memory cache, so runs neither read nor leave data/code_cache.
+    """
+    code_cache_dir = code_cache.CODE_CACHE_DIR
+    with tempfile.TemporaryDirectory() as directory:
+        code_cache.CODE_CACHE_DIR = directory
+        code_cache.clear_memory_cache()
+        try:
+            yield directory
+        finally:
+            code_cache.CODE_CACHE_DIR = code_cache_dir
+            code_cache.clear_memory_cache()
+
+
+def build_scenario(scenario: dict, seed: int = 0) -> dict:
+    tickers = synthetic.generate_tickers(scenario["tickers"])
+    generator = synthetic.SymphonyGenerator(
+        tickers, seed=seed, node_mix=scenario.get("node_mix"))
+    root_nodes = [generator.generate(scenario["depth"], scenario["breadth"], name=f"Synthetic {i}")
+                  for i in range(scenario["symphonies"])]
+    return {
+        "root_nodes": root_nodes,
+        "edn_texts": [synthetic.convert_root_node_to_edn(root_node) for root_node in root_nodes],
+        "closes": synthetic.generate_closes(tickers, days=scenario["days"], seed=seed),
+    }
+
+
+def build_stage_functions(data: dict) -> typing.Dict[str, typing.Callable[[], typing.Any]]:
+    root_nodes = data["root_nodes"]
+    closes = data["closes"]
+    # later stages take earlier stages' outputs as given, so each stage is timed alone
+    executed = [transpilers.VectorBTTranspiler.execute(root_node, closes)
+                for root_node in root_nodes]
+
+    def parse():
+        return [edn_syntax.convert_edn_to_pythonic(edn_format.loads(text)) for text in data["edn_texts"]]
+
+    def traverse():
+        return [(
+            traversers.collect_referenced_assets(root_node),
+            traversers.collect_indicators(root_node),
+            traversers.collect_branches(root_node),
+            traversers.collect_conditions(root_node),
+        ) for root_node in root_nodes]
+
+    def transpile():
+        return [vectorbt.convert_to_vectorbt(root_node) for root_node in root_nodes]
+
+    def execute():
+        return [transpilers.VectorBTTranspiler.execute(root_node, closes) for root_node in root_nodes]
+
+    def execute_cold():
+        code_cache.clear_memory_cache()
+        shutil.rmtree(code_cache.CODE_CACHE_DIR, ignore_errors=True)
+        return execute()
+
+    def returns():
+        return [transpilers.VectorBTTranspiler.get_returns(closes, allocations, branch_tracker)
+                for allocations, branch_tracker in executed]
+
+    return {"parse": parse, "traverse": traverse, "transpile": transpile, "execute": execute, "execute_cold": execute_cold, "returns": returns}
+
+
+def measure(fn: typing.Callable[[], typing.Any], repeat: int = 3) -> dict:
+    fn()  # warm up (numba compilation, imports, caches)
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+
+    # separate run, tracemalloc slows everything down
+    tracemalloc.start()
+    fn()
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "seconds": min(timings),
+        "median_seconds": statistics.median(timings),
+        "peak_memory_bytes": peak,
+    }
+
+
+def run_benchmarks(scenario_names: typing.Optional[typing.List[str]] = None, stage_names: typing.Optional[typing.List[str]] = None, repeat: int = 3, seed: int = 0) -> dict:
+    results = {
+        "meta": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "repeat": repeat,
+            "seed": seed,
+        },
+        "scenarios": {},
+    }
+    with isolated_code_cache():
+        for scenario_name in scenario_names or list(SCENARIOS.keys()):
+            stage_functions = build_stage_functions(
+                build_scenario(SCENARIOS[scenario_name], seed=seed))
+            results["scenarios"][scenario_name] = {}
+            for stage_name in stage_names or STAGES:
+                print(f"  {scenario_name} / {stage_name}")
+                results["scenarios"][scenario_name][stage_name] = measure(
+                    stage_functions[stage_name], repeat=repeat)
+    return results
+
+
+def load_baseline(path: str = DEFAULT_BASELINE_PATH) -> typing.Optional[dict]:
+    try:
+        return json.load(open(path))
+    except FileNotFoundError:
+        return
+
+
+def save_baseline(results: dict, path: str = DEFAULT_BASELINE_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    json.dump(results, open(path, 'w'), indent=4, sort_keys=True)
+
+
+def compare_to_baseline(results: dict, baseline: dict, time_budget: float = DEFAULT_TIME_BUDGET, memory_budget: float = DEFAULT_MEMORY_BUDGET) -> typing.List[dict]:
+    comparisons = []
+    for scenario_name, stages in results["scenarios"].items():
+        for stage_name, measurement in stages.items():
+            baseline_measurement = baseline["scenarios"].get(
+                scenario_name, {}).get(stage_name)
+            if not baseline_measurement:
+                continue
+            time_ratio = measurement["seconds"] / \
+                max(baseline_measurement["seconds"], 1e-9)
+            memory_ratio = measurement["peak_memory_bytes"] / \
+                max(baseline_measurement["peak_memory_bytes"], 1)
+            comparisons.append({
+                "scenario": scenario_name,
+                "stage": stage_name,
+                "time_ratio": time_ratio,
+                "memory_ratio": memory_ratio,
+                "regressed": time_ratio > 1 + time_budget or memory_ratio > 1 + memory_budget,
+            })
+    return comparisons
+
+
+def format_results(results: dict, comparisons: typing.Optional[typing.List[dict]] = None) -> str:
+    comparisons_by_key = {(c["scenario"], c["stage"]): c for c in comparisons or []}
+    lines = [
+        f"{'scenario':<10} {'stage':<12} {'seconds':>10} {'median':>10} {'peak MB':>10} {'vs base':>9} {'mem vs':>8}"]
+    for scenario_name, stages in results["scenarios"].items():
+        for stage_name, measurement in stages.items():
+            line = f"{scenario_name:<10} {stage_name:<12} {measurement['seconds']:>10.4f} {measurement['median_seconds']:>10.4f} {measurement['peak_memory_bytes'] / 1e6:>10.2f}"
+            comparison = comparisons_by_key.get((scenario_name, stage_name))
+            if comparison:
+                line += f" {comparison['time_ratio']:>8.2f}x {comparison['memory_ratio']:>7.2f}x"
+                if comparison["regressed"]:
+                    line += "  REGRESSION"
+            lines.append(line)
+    return "\n".join(lines)
+
+
+def main():
+    results = run_benchmarks(["small"], repeat=1)
+    baseline = load_baseline()
+    print(format_results(results, compare_to_baseline(
+        results, baseline) if baseline else None))
@@ -0,0 +1,118 @@
+import typing
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+
+#
+# Which branches (leaf :if-child ids) were active on each day, as a bitset
+# - bit b of day d is set if branch_ids[b] was active on index[d]
+# - packed into uint64 words, (days, ceil(branches / 64)), instead of a dense 0/1 frame with a column per branch
+# - to_frame() gives the old dense DataFrame when something really needs it
+#
+WORD_BITS = 64
+WORD_MASK = (1 << WORD_BITS) - 1
+
+
+@dataclass
+class BranchTracker:
+    index: pd.DatetimeIndex
+    branch_ids: typing.List[str]
+    words: np.ndarray
+
+    @staticmethod
+    def count_words(branch_count: int) -> int:
+        return max(1, -(-branch_count // WORD_BITS))
+
+    @classmethod
+    def from_int_rows(cls, index: pd.Index, branch_ids: typing.List[str], rows: typing.List[int]) -> "BranchTracker":
+        """
+        rows are python ints used as bitsets (what generated build_allocations_matrix code accumulates).
+        """
+        words = np.zeros(
+            (len(rows), cls.count_words(len(branch_ids))), dtype=np.uint64)
+        for word in range(words.shape[1]):
+            shift = word * WORD_BITS
+            words[:, word] = np.fromiter(
+                ((row >> shift) & WORD_MASK for row in rows), dtype=np.uint64, count=len(rows))
+        return cls(index=pd.DatetimeIndex(index, name="Date"), branch_ids=list(branch_ids), words=words)
+
+    @classmethod
+    def from_bits(cls, index: pd.Index, branch_ids: typing.List[str], bits: np.ndarray) -> "BranchTracker":
+        padded = np.zeros((len(index), cls.count_words(
+            len(branch_ids)) * WORD_BITS), dtype=np.uint8)
+        padded[:, :len(branch_ids)] = bits != 0
+        words = np.packbits(padded, axis=1, bitorder="little").view("<u8")
+        return cls(index=pd.DatetimeIndex(index, name="Date"), branch_ids=list(branch_ids), words=words.astype(np.uint64))
+
+    @classmethod
+    def from_frame(cls, frame: pd.DataFrame) -> "BranchTracker":
+        # the old dense format (or a branch_tracker.csv written by it)
+        return cls.from_bits(frame.index, [str(c) for c in frame.columns], frame.fillna(0).to_numpy() != 0)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def to_bits(self) -> np.ndarray:
+        """
+        Dense (days, branches) boolean matrix.
+        """
+        bits = np.unpackbits(self.words.astype(
+            "<u8").view(np.uint8), axis=1, bitorder="little")
+        return bits[:, :len(self.branch_ids)].astype(bool)
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.to_bits().astype(np.int64), index=self.index, columns=self.branch_ids)
+
+    def filter_days(self, mask) -> "BranchTracker":
+        mask = np.asarray(mask, dtype=bool)
+        return BranchTracker(index=self.index[mask], branch_ids=self.branch_ids, words=self.words[mask])
+
+    def slice_days(self, start: int, stop: typing.Optional[int] = None) -> "BranchTracker":
+        # views, no copy (see trading_calendar)
+        return BranchTracker(index=self.index[start:stop], branch_ids=self.branch_ids, words=self.words[start:stop])
+
+    def counts(self) -> pd.Series:
+        """
+        Days active per branch.
+        """
+        return pd.Series(self.to_bits().sum(axis=0), index=self.branch_ids, dtype=np.int64)
+
+    def get_branch(self, branch_id: str) -> pd.Series:
+        bit = self.branch_ids.index(branch_id)
+        return pd.Series(((self.words[:, bit // WORD_BITS] >> np.uint64(bit % WORD_BITS)) & np.uint64(1)).astype(np.int64), index=self.index, name=branch_id)
+
+    def get_active_branch_ids(self, day) -> typing.List[str]:
+        row = self.index.get_loc(day)
+        bits = np.unpackbits(self.words[row].astype(
+            "<u8").view(np.uint8), bitorder="little")
+        return [self.branch_ids[b] for b in np.flatnonzero(bits[:len(self.branch_ids)])]
+
+    def save(self, path: str):
+        np.savez_compressed(
+            path,
+            index=self.index.values.astype("datetime64[ns]").view(np.int64),
+            branch_ids=np.array(self.branch_ids, dtype=str),
+            words=self.words,
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "BranchTracker":
+        with np.load(path) as data:
+            return cls(
+                index=pd.DatetimeIndex(data["index"].view(
+                    "datetime64[ns]"), name="Date"),
+                branch_ids=[str(b) for b in data["branch_ids"]],
+                words=data["words"],
+            )
+
+
+def main():
+    index = pd.bdate_range("2023-01-02", periods=5, name="Date")
+    branch_ids = [f"branch-{i}" for i in range(70)]
+    tracker = BranchTracker.from_int_rows(
+        index, branch_ids, [1, 2, 1 << 65, 1 | (1 << 69), 0])
+    print(tracker.counts()[tracker.counts() != 0])
+    print(tracker.get_active_branch_ids(index[3]))
+    assert BranchTracker.from_frame(tracker.to_frame()).words.tolist() == tracker.words.tolist()
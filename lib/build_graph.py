@@ -0,0 +1,179 @@
+import ast
+import hashlib
+import json
+import os
+import typing
+
+from . import get_backtest_data, symphony_object, traversers, vectorbt
+
+
+#
+# Per symphony build graph, every stage's artifacts are stamped with a hash of their inputs
+# (the catalog's stage_completions.input_hash), and a stage only reruns when that hash changed:
+#
+#   EDN -> symphony.json -> human.txt
+#                        -> vectorbt.py
+#                        -> allocations, branch_tracker (+ prices of referenced tickers)
+#                           -> returns, stats (+ prices of allocated tickers and the benchmark)
+#                              -> VectorBT.html / report.html
+#
+# - a stage's hash covers its parent stage's hash, so a new symphony version rebuilds everything downstream of it
+# - and the source of the library modules the stage runs and everything they import from lib/ (STAGE_MODULES are the entry points),
+#   so a transpiler fix rebuilds allocations and returns (but not human.txt)
+# - and the content of the price files it reads, so refreshed prices rebuild allocations and returns
+# force_update still redoes everything (and downloads the symphony again)
+#
+STAGE_PARENTS = {
+    "symphony.json": None,
+    "human.txt": "symphony.json",
+    "vectorbt.py": "symphony.json",
+    "allocations": "symphony.json",
+    "returns": "allocations",
+    "VectorBT.html": "returns",
+    "report.html": "returns",
+}
+
+PARSE_MODULES = ["edn_syntax", "logic", "traversers"]
+STAGE_MODULES = {
+    "symphony.json": [],
+    "human.txt": PARSE_MODULES + ["symphony_object", "human"],
+    "vectorbt.py": PARSE_MODULES + ["symphony_object", "vectorbt"],
+    "allocations": PARSE_MODULES + ["symphony_object", "transpilers", "subtrees", "batch_backtest", "ticker_index", "artifact_store", "get_backtest_data"],
+    "returns": ["batch_backtest", "metrics", "artifact_store", "get_backtest_data"],
+    "VectorBT.html": ["reports", "metrics"],
+    "report.html": ["reports", "metrics"],
+}
+# imported for bookkeeping only, they do not change what a stage writes
+UNVERSIONED_MODULES = {"instrumentation", "parallel"}
+
+_code_versions_by_stage: typing.Dict[str, str] = {}
+_imported_modules_by_name: typing.Dict[str, typing.List[str]] = {}
+# price file content hashes, by (path, mtime, size) so a refreshed file is hashed again
+_price_hashes_by_stat: typing.Dict[tuple, str] = {}
+_tickers_by_edn_hash: typing.Dict[str, typing.Tuple[typing.List[str], typing.List[str]]] = {}
+
+
+def hash_values(*values) -> str:
+    return hashlib.sha256(json.dumps(values, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get_edn(symphony: dict) -> str:
+    return symphony['fields']['latest_version_edn']['stringValue']
+
+
+def get_edn_hash(symphony: dict) -> str:
+    return hashlib.sha256(get_edn(symphony).encode()).hexdigest()
+
+
+def get_module_path(module_name: str) -> str:
+    return os.path.join(os.path.dirname(__file__), f"{module_name}.py")
+
+
+def get_imported_modules(module_name: str) -> typing.List[str]:
+    """
+    lib/ modules imported by module_name, at module level or inside functions (lazy imports), but not by its main().
+    """
+    if module_name not in _imported_modules_by_name:
+        with open(get_module_path(module_name)) as f:
+            tree = ast.parse(f.read())
+        nodes = [node for statement in tree.body if not (isinstance(statement, ast.FunctionDef) and statement.name == "main")
+                 for node in ast.walk(statement)]
+        imported = set()
+        for node in nodes:
+            if isinstance(node, ast.ImportFrom) and node.level == 1:
+                # from . import a, b / from .a import B
+                imported.update([node.module] if node.module else [
+                                alias.name for alias in node.names])
+        _imported_modules_by_name[module_name] = sorted(imported)
+    return _imported_modules_by_name[module_name]
+
+
+def collect_stage_modules(stage: str) -> typing.List[str]:
+    """
+    STAGE_MODULES[stage] and every lib/ module they import, transitively.
+    """
+    modules = set()
+    pending = list(STAGE_MODULES[stage])
+    while pending:
+        module_name = pending.pop()
+        if module_name in modules or module_name in UNVERSIONED_MODULES:
+            continue
+        modules.add(module_name)
+        pending.extend(get_imported_modules(module_name))
+    return sorted(modules)
+
+
+def get_code_version(stage: str) -> str:
+    if stage not in _code_versions_by_stage:
+        source_hashes = []
+        for module_name in collect_stage_modules(stage):
+            with open(get_module_path(module_name), 'rb') as f:
+                source_hashes.append(
+                    [module_name, hashlib.sha256(f.read()).hexdigest()])
+        _code_versions_by_stage[stage] = hash_values(
+            source_hashes, vectorbt.TRANSPILER_VERSION)
+    return _code_versions_by_stage[stage]
+
+
+def get_price_hash(ticker: str) -> str:
+    path = get_backtest_data.get_price_path(ticker)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        # not downloaded yet, never matches a stamp
+        return "missing"
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if key not in _price_hashes_by_stat:
+        with open(path, 'rb') as f:
+            _price_hashes_by_stat[key] = hashlib.sha256(
+                f.read()).hexdigest()
+    return _price_hashes_by_stat[key]
+
+
+def get_price_version(tickers: typing.Iterable[str]) -> str:
+    return hash_values([[ticker, get_price_hash(ticker)] for ticker in sorted(tickers)])
+
+
+def get_tickers(symphony: dict) -> typing.Tuple[typing.List[str], typing.List[str]]:
+    """
+    (referenced tickers, allocateable tickers), parsed once per EDN.
+    """
+    edn_hash = get_edn_hash(symphony)
+    if edn_hash not in _tickers_by_edn_hash:
+        root_node = symphony_object.extract_root_node_from_symphony_response(
+            symphony)
+        _tickers_by_edn_hash[edn_hash] = (
+            sorted(traversers.collect_referenced_assets(root_node)),
+            sorted(traversers.collect_allocateable_assets(root_node)))
+    return _tickers_by_edn_hash[edn_hash]
+
+
+def get_input_hashes(symphony: dict, benchmark_ticker: str = "SPY") -> typing.Dict[str, str]:
+    """
+    Input hash of every stage, by stage name (the first artifact of populate_symphonies.STAGE_ARTIFACTS).
+    """
+    referenced_tickers, allocateable_tickers = get_tickers(symphony)
+    extra_inputs = {
+        "allocations": [get_price_version(referenced_tickers)],
+        "returns": [get_price_version(allocateable_tickers), benchmark_ticker, get_price_version([benchmark_ticker])],
+    }
+
+    input_hashes = {"symphony.json": get_edn_hash(symphony)}
+    for stage, parent_stage in STAGE_PARENTS.items():
+        if parent_stage is None:
+            continue
+        input_hashes[stage] = hash_values(
+            stage, input_hashes[parent_stage], get_code_version(stage), extra_inputs.get(stage, []))
+    return input_hashes
+
+
+def main():
+    for stage in STAGE_PARENTS:
+        print(f"{stage:<14} {' '.join(collect_stage_modules(stage))}")
+    print()
+    for symphony_id in symphony_object.get_cached_symphony_ids()[:5]:
+        symphony = json.load(
+            open(f'outputs/symphonies/{symphony_id}/symphony.json'))
+        print(symphony_id)
+        for stage, input_hash in get_input_hashes(symphony).items():
+            print(f"  {stage:<14} {input_hash[:16]}")
@@ -0,0 +1,254 @@
+import json
+import math
+import os
+import sqlite3
+import time
+import typing
+
+import pandas as pd
+
+from . import atomic_files
+from .metrics import STAT_NAMES
+
+
+#
+# SQLite catalog of symphonies, replaces mutating outputs/symphonies.csv in memory until the end of a run
+# - symphonies: metadata (one row per symphony, plus any extra csv columns as json)
+# - failures: why a symphony was skipped, in which stage and from which inputs (a failure is retried once they change)
+# - stats: one row per (symphony, stat), indexed by stat for rankings
+# - stage_completions: which stages finished for which symphony (artifact freshness), so runs resume
+# every save is its own transaction, so a crash loses at most the symphony in flight
+#
+CATALOG_PATH = "outputs/symphonies.sqlite"
+
+METADATA_COLUMNS = ["name", "branches_count", "unique_conditions_count", "allocations_days",
+                    "branch_tracker_days", "backtest_start", "backtest_end", "report_url"]
+# column order of the csv export (same as the old symphonies.csv)
+EXPORT_COLUMNS = ["force_update", "failure_status", "failure_detail"] + \
+    METADATA_COLUMNS[:-1] + STAT_NAMES + ["report_url"]
+RECORD_ONLY_COLUMNS = ["symphony_id", "force_update",
+                       "failure_status", "failure_detail", "failure_stage", "failure_input_hash"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS symphonies (
+    symphony_id TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    name TEXT,
+    branches_count INTEGER,
+    unique_conditions_count INTEGER,
+    allocations_days INTEGER,
+    branch_tracker_days INTEGER,
+    backtest_start TEXT,
+    backtest_end TEXT,
+    report_url TEXT,
+    extra TEXT NOT NULL DEFAULT '{}',
+    -- set by reset, cleared once the symphony is downloaded again
+    forced INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS failures (
+    symphony_id TEXT PRIMARY KEY REFERENCES symphonies (symphony_id),
+    stage TEXT,
+    failure_status TEXT NOT NULL,
+    failure_detail TEXT,
+    failed_at REAL,
+    -- build_graph hash of the inputs the stage failed on
+    input_hash TEXT
+);
+CREATE TABLE IF NOT EXISTS stats (
+    symphony_id TEXT NOT NULL REFERENCES symphonies (symphony_id),
+    name TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (symphony_id, name)
+);
+CREATE INDEX IF NOT EXISTS stats_by_name ON stats (name, value);
+CREATE TABLE IF NOT EXISTS stage_completions (
+    symphony_id TEXT NOT NULL REFERENCES symphonies (symphony_id),
+    stage TEXT NOT NULL,
+    completed_at REAL,
+    -- build_graph hash of what the stage's artifacts were built from
+    input_hash TEXT,
+    PRIMARY KEY (symphony_id, stage)
+);
+CREATE INDEX IF NOT EXISTS stage_completions_by_stage ON stage_completions (stage);
+"""
+
+
+def is_missing(value) -> bool:
+    return value is None or value == "" or (isinstance(value, float) and math.isnan(value))
+
+
+def to_sql_value(value):
+    if is_missing(value):
+        return None
+    # numpy scalars
+    return value.item() if hasattr(value, "item") else value
+
+
+class Catalog:
+    def __init__(self, path: str = CATALOG_PATH):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.migrate()
+
+    def migrate(self):
+        # catalogs from before stage input hashes, their completions and failures count as stale
+        for table in ["stage_completions", "failures"]:
+            columns = [row["name"] for row in self.connection.execute(
+                f"PRAGMA table_info({table})")]
+            if "input_hash" not in columns:
+                with self.connection:
+                    self.connection.execute(
+                        f"ALTER TABLE {table} ADD COLUMN input_hash TEXT")
+
+    def close(self):
+        self.connection.close()
+
+    def get_symphony_ids(self) -> typing.List[str]:
+        return [row["symphony_id"] for row in self.connection.execute("SELECT symphony_id FROM symphonies ORDER BY position")]
+
+    def add_symphony(self, symphony_id: str):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO symphonies (symphony_id, position) VALUES (?, (SELECT COALESCE(MAX(position), -1) + 1 FROM symphonies))", (symphony_id,))
+
+    def sync_from_csv(self, path: str) -> typing.Tuple[typing.List[str], typing.List[str]]:
+        """
+        Adds symphonies (and everything known about them) that are only in the csv.
+        Returns (new symphony ids, symphony ids with force_update set).
+        """
+        if not os.path.exists(path):
+            return [], []
+        known_symphony_ids = set(self.get_symphony_ids())
+        new_symphony_ids, forced_symphony_ids = [], []
+        symphonies = pd.read_csv(path, dtype={"symphony_id": str})
+        for record in symphonies.to_dict("records"):
+            symphony_id = record["symphony_id"]
+            if symphony_id not in known_symphony_ids:
+                self.add_symphony(symphony_id)
+                self.save_record(record)
+                new_symphony_ids.append(symphony_id)
+            if not is_missing(record.get("force_update")):
+                forced_symphony_ids.append(symphony_id)
+        return new_symphony_ids, forced_symphony_ids
+
+    def load_records(self) -> typing.List[dict]:
+        """
+        Records shaped like rows of the old symphonies.csv.
+        """
+        failures_by_id = {row["symphony_id"]: row for row in self.connection.execute(
+            "SELECT * FROM failures")}
+        stats_by_id = {}
+        for row in self.connection.execute("SELECT symphony_id, name, value FROM stats WHERE value IS NOT NULL"):
+            stats_by_id.setdefault(row["symphony_id"], {})[
+                row["name"]] = row["value"]
+
+        records = []
+        for row in self.connection.execute("SELECT * FROM symphonies ORDER BY position"):
+            symphony_id = row["symphony_id"]
+            failure = failures_by_id.get(symphony_id)
+            record = {
+                "symphony_id": symphony_id,
+                "force_update": "true" if row["forced"] else "",
+                "failure_status": failure["failure_status"] if failure else "",
+                "failure_detail": (failure["failure_detail"] or "") if failure else "",
+                "failure_stage": failure["stage"] if failure else None,
+                "failure_input_hash": failure["input_hash"] if failure else None,
+            }
+            record.update({column: row[column]
+                          for column in METADATA_COLUMNS if row[column] is not None})
+            record.update(stats_by_id.get(symphony_id, {}))
+            record.update(json.loads(row["extra"]))
+            records.append(record)
+        return records
+
+    def save_record(self, record: dict, stage: typing.Optional[str] = None, input_hash: typing.Optional[str] = None):
+        """
+        Commits everything a stage learned about one symphony, and marks the stage done (or failed)
+        with the hash of its inputs.
+        """
+        symphony_id = record["symphony_id"]
+        metadata = {column: to_sql_value(record[column])
+                    for column in METADATA_COLUMNS if column in record}
+        extra = {key: to_sql_value(value) for key, value in record.items() if key not in METADATA_COLUMNS and key not in STAT_NAMES and key not in RECORD_ONLY_COLUMNS and not is_missing(value)}
+        now = time.time()
+        failed = not is_missing(record.get("failure_status"))
+
+        with self.connection:
+            assignments = ", ".join(
+                f"{column} = ?" for column in metadata.keys())
+            self.connection.execute(
+                f"UPDATE symphonies SET {assignments + ', ' if assignments else ''}extra = ?, updated_at = ? WHERE symphony_id = ?",
+                list(metadata.values()) + [json.dumps(extra), now, symphony_id])
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO stats (symphony_id, name, value) VALUES (?, ?, ?)",
+                [(symphony_id, name, to_sql_value(record[name])) for name in STAT_NAMES if name in record])
+            if failed:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO failures (symphony_id, stage, failure_status, failure_detail, failed_at, input_hash) VALUES (?, ?, ?, ?, ?, ?)",
+                    (symphony_id, stage, record["failure_status"], to_sql_value(record.get("failure_detail")), now, input_hash))
+            elif stage:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO stage_completions (symphony_id, stage, completed_at, input_hash) VALUES (?, ?, ?, ?)", (symphony_id, stage, now, input_hash))
+
+    def is_stage_complete(self, symphony_id: str, stage: str, input_hash: typing.Optional[str] = None) -> bool:
+        """
+        With an input_hash, only if the stage was completed from the same inputs.
+        """
+        row = self.connection.execute(
+            "SELECT input_hash FROM stage_completions WHERE symphony_id = ? AND stage = ?", (symphony_id, stage)).fetchone()
+        return row is not None and (input_hash is None or row["input_hash"] == input_hash)
+
+    def mark_stage_complete(self, symphony_id: str, stage: str, input_hash: typing.Optional[str] = None):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO stage_completions (symphony_id, stage, completed_at, input_hash) VALUES (?, ?, ?, ?)", (symphony_id, stage, time.time(), input_hash))
+
+    def reset(self, symphony_id: str):
+        """
+        Forgets failures and completed stages, so every stage runs again.
+        """
+        with self.connection:
+            self.connection.execute(
+                "UPDATE symphonies SET forced = 1 WHERE symphony_id = ?", (symphony_id,))
+            self.connection.execute(
+                "DELETE FROM failures WHERE symphony_id = ?", (symphony_id,))
+            self.connection.execute(
+                "DELETE FROM stage_completions WHERE symphony_id = ?", (symphony_id,))
+
+    def clear_failure(self, symphony_id: str):
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM failures WHERE symphony_id = ?", (symphony_id,))
+
+    def clear_force(self, symphony_id: str):
+        with self.connection:
+            self.connection.execute(
+                "UPDATE symphonies SET forced = 0 WHERE symphony_id = ?", (symphony_id,))
+
+    def get_top_symphonies_by_stat(self, name: str, limit: int = 10, descending: bool = True) -> typing.List[typing.Tuple[str, float]]:
+        return [(row["symphony_id"], row["value"]) for row in self.connection.execute(
+            f"SELECT symphony_id, value FROM stats WHERE name = ? AND value IS NOT NULL ORDER BY value {'DESC' if descending else 'ASC'} LIMIT ?", (name, limit))]
+
+    def export_csv(self, path: str):
+        df = pd.DataFrame(self.load_records())
+        if df.empty:
+            df = pd.DataFrame(columns=["symphony_id"] + EXPORT_COLUMNS)
+        columns = [c for c in EXPORT_COLUMNS if c in df.columns]
+        columns += [c for c in df.columns if c not in columns and c not in RECORD_ONLY_COLUMNS]
+        df = df.set_index("symphony_id")[columns]
+        # forcing is tracked in the catalog, the csv flag is only an input
+        df["force_update"] = ""
+        with atomic_files.replacing(path) as partial_path:
+            df.to_csv(partial_path)
+
+
+def main():
+    catalog = Catalog()
+    print(f"{len(catalog.get_symphony_ids())} symphonies")
+    for symphony_id, sharpe in catalog.get_top_symphonies_by_stat("Sharpe"):
+        print(f"  {symphony_id} {sharpe:.2f}")
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import marshal
+import os
+import sys
+import types
+import typing
+
+from . import atomic_files, instrumentation, vectorbt
+
+
+#
+# Compiled build_allocations_matrix code, keyed by tree content + transpiler version
+# - in memory for the process, marshalled bytecode on disk across runs
+# - marshal output is python-version specific, so the interpreter's cache tag is part of the path
+#
+CODE_CACHE_DIR = "data/code_cache"
+
+_code_by_key: typing.Dict[str, types.CodeType] = {}
+
+
+def get_tree_hash(root_node: dict) -> str:
+    return hashlib.sha256(json.dumps(root_node, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get_code_cache_key(root_node: dict, profile: bool = False, subtree_slots: typing.Optional[typing.Mapping[str, int]] = None) -> str:
+    key = f"{get_tree_hash(root_node)}_v{vectorbt.TRANSPILER_VERSION}{'_profile' if profile else ''}"
+    if subtree_slots:
+        # which subtrees are shared changes the generated code
+        key += "_s" + hashlib.sha256(json.dumps(
+            subtree_slots, sort_keys=True).encode()).hexdigest()[:16]
+    return key
+
+
+def get_code_cache_path(key: str) -> str:
+    return f"{CODE_CACHE_DIR}/{sys.implementation.cache_tag}/{key}.marshal"
+
+
+def read_code_from_disk(path: str) -> typing.Optional[types.CodeType]:
+    try:
+        with open(path, 'rb') as f:
+            code = marshal.load(f)
+    except FileNotFoundError:
+        return
+    except (EOFError, ValueError, TypeError):
+        print(f"WARNING: ignoring unreadable code cache entry {path}")
+        return
+    return code if isinstance(code, types.CodeType) else None
+
+
+def write_code_to_disk(path: str, code: types.CodeType):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # --workers may compile the same tree at once
+    with atomic_files.open_replacing(path, 'wb') as f:
+        marshal.dump(code, f)
+
+
+def compile_symphony(root_node: dict, profile: bool = False, subtree_slots: typing.Optional[typing.Mapping[str, int]] = None) -> types.CodeType:
+    with instrumentation.span("convert_to_vectorbt", category="codegen"):
+        code = vectorbt.convert_to_vectorbt(
+            root_node, profile=profile, subtree_slots=subtree_slots)
+    with instrumentation.span("compile", category="codegen"):
+        return compile(code, f"<symphony {root_node.get(':id', '')}>", "exec")
+
+
+def get_compiled_symphony(root_node: dict, profile: bool = False, use_disk: bool = True, subtree_slots: typing.Optional[typing.Mapping[str, int]] = None) -> types.CodeType:
+    """
+    Code object defining build_allocations_matrix(closes, subtree_uses=None, days=None) for this tree.
+    """
+    key = get_code_cache_key(
+        root_node, profile=profile, subtree_slots=subtree_slots)
+    if key in _code_by_key:
+        instrumentation.count("code_cache.hit")
+        return _code_by_key[key]
+
+    path = get_code_cache_path(key)
+    code = read_code_from_disk(path) if use_disk else None
+    if code:
+        instrumentation.count("code_cache.hit")
+    else:
+        instrumentation.count("code_cache.miss")
+        code = compile_symphony(
+            root_node, profile=profile, subtree_slots=subtree_slots)
+        if use_disk:
+            write_code_to_disk(path, code)
+
+    _code_by_key[key] = code
+    return code
+
+
+def clear_memory_cache():
+    _code_by_key.clear()
+
+
+def main():
+    import time
+    from . import synthetic
+
+    root_node = synthetic.generate_symphony(depth=6, breadth=3)
+    for attempt in ["cold", "memory"]:
+        start = time.perf_counter()
+        get_compiled_symphony(root_node)
+        print(f"{attempt}: {time.perf_counter() - start:.4f}s")
+    clear_memory_cache()
+    start = time.perf_counter()
+    get_compiled_symphony(root_node)
+    print(f"disk: {time.perf_counter() - start:.4f}s")
@@ -23,5 +23,19 @@ def convert_edn_to_pythonic(d):
         return d
 
 
+def convert_pythonic_to_edn(d):
+    """
+    Inverse of convert_edn_to_pythonic (":foo" strings become keywords again)
+    """
+    if type(d) == dict:
+        return {convert_pythonic_to_edn(k): convert_pythonic_to_edn(v) for k, v in d.items()}
+    elif type(d) == list:
+        return [convert_pythonic_to_edn(v) for v in d]
+    elif type(d) == str and d.startswith(":"):
+        return edn_format.Keyword(d[1:])
+    else:
+        return d
+
+
 def main():
     pprint.pprint(manual_testing.get_root_node_from_path("inputs/weird.edn"))
@@ -1,3 +1,4 @@
+import io
 import os
 import typing
 
@@ -5,6 +6,12 @@ import requests
 import pandas as pd
 import yfinance
 
+from . import instrumentation
+
+
+def get_price_path(ticker: str) -> str:
+    return f"data/adj-close_{ticker.replace('/', '-')}.csv"
+
 
 def get_backtest_data(raw_tickers: typing.Set[str], use_simulated_data: bool = False) -> pd.DataFrame:
     tickers = [t.replace("/", "-") for t in raw_tickers]
@@ -18,35 +25,43 @@ def get_backtest_data(raw_tickers: typing.Set[str], use_simulated_data: bool = F
 
     tickers_to_fetch = []
     for ticker in tickers:
-        path = f"data/adj-close_{ticker}.csv"
+        path = get_price_path(ticker)
         if not os.path.exists(path):
             tickers_to_fetch.append(ticker)
+    instrumentation.count("prices.hit", len(tickers) - len(tickers_to_fetch))
+    instrumentation.count("prices.miss", len(tickers_to_fetch))
 
     if tickers_to_fetch:
-        data = yfinance.download(tickers_to_fetch)
+        with instrumentation.span("yfinance_download", category="download", items=len(tickers_to_fetch)):
+            data = yfinance.download(tickers_to_fetch)
 
         # yfinance behaves different depending on number of tickers
         if len(tickers_to_fetch) > 1:
             for ticker in tickers_to_fetch:
-                path = f"data/adj-close_{ticker}.csv"
+                path = get_price_path(ticker)
                 data['Adj Close'][ticker].dropna().sort_index().to_csv(path)
         else:
             ticker = tickers_to_fetch[0]
-            path = f"data/adj-close_{ticker}.csv"
+            path = get_price_path(ticker)
             d = pd.DataFrame(data['Adj Close'])
             d = d.rename(columns={"Adj Close": ticker})
             d.to_csv(path)
 
-    main_dataframe = None
-    for ticker in tickers:
-        path = f"data/adj-close_{ticker}.csv"
-        data = pd.read_csv(path, index_col="Date", parse_dates=True)
-        data = data.sort_index()
+        # new price files get their ticker_index entry right away
+        from . import ticker_index
+        ticker_index.update_index(tickers_to_fetch)
 
-        if main_dataframe is None:
-            main_dataframe = data
-        else:
-            main_dataframe = pd.concat([main_dataframe, data], axis=1)
+    main_dataframe = None
+    with instrumentation.span("load_price_csvs", category="csv", items=len(tickers)):
+        for ticker in tickers:
+            path = get_price_path(ticker)
+            data = pd.read_csv(path, index_col="Date", parse_dates=True)
+            data = data.sort_index()
+
+            if main_dataframe is None:
+                main_dataframe = data
+            else:
+                main_dataframe = pd.concat([main_dataframe, data], axis=1)
 
     main_dataframe = typing.cast(pd.DataFrame, main_dataframe)
 
@@ -76,5 +91,42 @@ def get_backtest_data(raw_tickers: typing.Set[str], use_simulated_data: bool = F
     return typing.cast(pd.DataFrame, main_dataframe)
 
 
+def read_price_tail(ticker: str, days: int) -> pd.DataFrame:
+    """
+    Last `days` rows of a ticker's price csv, read backwards from the end of the file instead of parsing all of it.
+    """
+    with open(get_price_path(ticker), 'rb') as f:
+        header = f.readline()
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b""
+        # one more line than needed, the first one read may be cut off
+        while position > len(header) and data.count(b"\n") <= days:
+            read_size = min(1 << 16, position - len(header))
+            position -= read_size
+            f.seek(position)
+            data = f.read(read_size) + data
+    lines = data.splitlines()[-days:] if days else []
+    return pd.read_csv(io.BytesIO(header + b"\n".join(lines)), index_col="Date", parse_dates=True).sort_index()
+
+
+def get_price_tails(days_by_ticker: typing.Mapping[str, int]) -> pd.DataFrame:
+    """
+    Like get_backtest_data, but only the last days of each ticker (days_by_ticker).
+    """
+    tickers_to_fetch = {ticker for ticker in days_by_ticker if not os.path.exists(
+        get_price_path(ticker.replace("/", "-")))}
+    if tickers_to_fetch:
+        get_backtest_data(tickers_to_fetch)
+
+    with instrumentation.span("load_price_tails", category="csv", items=len(days_by_ticker)):
+        tails = [read_price_tail(ticker.replace("/", "-"), days)
+                 for ticker, days in days_by_ticker.items()]
+    if not tails:
+        return pd.DataFrame(index=pd.DatetimeIndex([], name="Date"))
+    return pd.concat(tails, axis=1).sort_index()
+
+
 def main():
     print(get_backtest_data(set(['SPY', 'UVXY', 'TLT']), True))
+    print(get_price_tails({'SPY': 3, 'TLT': 5}))
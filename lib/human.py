@@ -90,10 +90,12 @@ def pretty_filter(node) -> str:
     return f"{pretty_selector(node)} by {pretty_indicator(node[':sort-by-fn'], '____', node[':sort-by-window-days'])}"
 
 
-def print_children(node, depth=0, parent_node_branch_state: typing.Optional[logic.NodeBranchState] = None, file=None):
+def print_children(node, depth=0, parent_node_branch_state: typing.Optional[logic.NodeBranchState] = None, file=None, annotate: typing.Optional[typing.Callable[[dict], str]] = None):
     """
     Recursively visits every child node (depth-first)
     and pretty-prints it out.
+
+    annotate(node) is appended to each node's line, if given.
     """
     if not parent_node_branch_state:
         # current node is :root, there is no higher node
@@ -117,6 +119,8 @@ def print_children(node, depth=0, parent_node_branch_state: typing.Optional[logi
 
         if logic.is_asset_node(node):
             s += f" (max: {current_node_branch_state.weight:.1%})"
+        if annotate:
+            s += annotate(node)
         print(s, file=file)
 
     if logic.is_root_node(node):
@@ -149,7 +153,7 @@ def print_children(node, depth=0, parent_node_branch_state: typing.Optional[logi
 
     for child in logic.get_node_children(node):
         print_children(child, depth=depth+1,
-                       parent_node_branch_state=current_node_branch_state, file=file)
+                       parent_node_branch_state=current_node_branch_state, file=file, annotate=annotate)
 
 
 def convert_to_pretty_format(root_node) -> str:
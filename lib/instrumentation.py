@@ -0,0 +1,232 @@
+import contextlib
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import typing
+
+
+#
+# Stage/symphony timing, throughput and memory instrumentation
+# - `span` times a block (wall, cpu, peak rss), spans nest
+# - `count` tallies things like cache hits/misses
+# - everything is a no-op until `start` is called, so library code can stay instrumented
+#
+# Outputs:
+# - JSONL metrics file (one line per finished span, counters at the end)
+# - Chrome trace json (open in chrome://tracing or https://ui.perfetto.dev)
+# - summary table
+#
+
+
+def get_peak_rss_bytes() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports KB, macOS reports bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Instrumentation:
+    def __init__(self, metrics_path: typing.Optional[str] = None, trace_path: typing.Optional[str] = None):
+        self.metrics_path = metrics_path
+        self.trace_path = trace_path
+        self.metrics_file = open(metrics_path, 'w') if metrics_path else None
+        self.origin = time.perf_counter()
+        self.spans: typing.List[dict] = []
+        self.counters: typing.Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str = "stage", **attributes):
+        """
+        Yields the span's attributes dict, so callers can add to it (like items=len(records)).
+        """
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield attributes
+        finally:
+            wall_seconds = time.perf_counter() - start
+            self.record_span({
+                "type": "span",
+                "name": name,
+                "category": category,
+                "start_seconds": start - self.origin,
+                "wall_seconds": wall_seconds,
+                "cpu_seconds": time.process_time() - cpu_start,
+                "peak_rss_bytes": get_peak_rss_bytes(),
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "attributes": attributes,
+            })
+
+    def record_span(self, span: dict):
+        with self.lock:
+            self.spans.append(span)
+            if self.metrics_file:
+                self.metrics_file.write(json.dumps(span, default=str) + "\n")
+
+    def count(self, name: str, value: float = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def export_chrome_trace(self, path: str):
+        events = []
+        for span in self.spans:
+            events.append({
+                "name": span["name"],
+                "cat": span["category"],
+                "ph": "X",
+                "ts": span["start_seconds"] * 1e6,
+                "dur": span["wall_seconds"] * 1e6,
+                "pid": span["pid"],
+                "tid": span["tid"],
+                "args": dict(span["attributes"], cpu_seconds=span["cpu_seconds"], peak_rss_bytes=span["peak_rss_bytes"]),
+            })
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"},
+                  open(path, 'w'), default=str)
+
+    def summarize(self) -> typing.List[dict]:
+        rows_by_key = {}
+        for span in self.spans:
+            key = (span["category"], span["name"]) if span["category"] != "symphony" else (
+                "symphony", span["attributes"].get("stage", ""))
+            row = rows_by_key.setdefault(key, {
+                "category": key[0], "name": key[1], "count": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "items": 0, "peak_rss_bytes": 0, "max_wall_seconds": 0.0,
+            })
+            row["count"] += 1
+            row["wall_seconds"] += span["wall_seconds"]
+            row["cpu_seconds"] += span["cpu_seconds"]
+            row["items"] += span["attributes"].get("items", 0)
+            row["peak_rss_bytes"] = max(
+                row["peak_rss_bytes"], span["peak_rss_bytes"])
+            row["max_wall_seconds"] = max(
+                row["max_wall_seconds"], span["wall_seconds"])
+        return sorted(rows_by_key.values(), key=lambda row: row["wall_seconds"], reverse=True)
+
+    def cache_hit_counts(self) -> typing.Dict[str, typing.Tuple[int, int]]:
+        # counters named "<cache>.hit" and "<cache>.miss", as (hits, total)
+        counts = {}
+        for name in self.counters:
+            cache, _, outcome = name.rpartition(".")
+            if outcome not in ("hit", "miss"):
+                continue
+            hits = int(self.counters.get(f"{cache}.hit", 0))
+            counts[cache] = (hits, hits + int(self.counters.get(f"{cache}.miss", 0)))
+        return counts
+
+    def format_summary(self) -> str:
+        lines = [
+            f"{'category':<10} {'name':<28} {'count':>7} {'wall s':>10} {'cpu s':>10} {'max s':>9} {'items/s':>9} {'peak MB':>9}"]
+        for row in self.summarize():
+            items_per_second = (
+                row["items"] / row["wall_seconds"]) if row["items"] and row["wall_seconds"] else 0
+            lines.append(
+                f"{row['category']:<10} {row['name'][:28]:<28} {row['count']:>7} {row['wall_seconds']:>10.3f} {row['cpu_seconds']:>10.3f} {row['max_wall_seconds']:>9.3f} {items_per_second:>9.1f} {row['peak_rss_bytes'] / 1e6:>9.1f}")
+
+        slowest_symphonies = sorted(
+            [s for s in self.spans if s["category"] == "symphony"], key=lambda s: s["wall_seconds"], reverse=True)[:5]
+        if slowest_symphonies:
+            lines.append("")
+            lines.append("Slowest symphonies:")
+            for span in slowest_symphonies:
+                lines.append(
+                    f"  {span['name']:<24} {span['attributes'].get('stage', ''):<12} {span['wall_seconds']:.3f}s")
+
+        hit_counts = self.cache_hit_counts()
+        if hit_counts:
+            lines.append("")
+            lines.append("Cache hit rates:")
+            for cache, (hits, total) in sorted(hit_counts.items()):
+                lines.append(
+                    f"  {cache:<24} {hits / total if total else 0:.1%} ({hits}/{total})")
+
+        lines.append("")
+        lines.append(f"Peak RSS: {get_peak_rss_bytes() / 1e6:.1f} MB")
+        return "\n".join(lines)
+
+    def close(self):
+        if self.metrics_file:
+            for name, value in sorted(self.counters.items()):
+                self.metrics_file.write(json.dumps(
+                    {"type": "counter", "name": name, "value": value}) + "\n")
+            self.metrics_file.close()
+            self.metrics_file = None
+        if self.trace_path:
+            self.export_chrome_trace(self.trace_path)
+
+
+_active: typing.Optional[Instrumentation] = None
+
+
+def start(metrics_path: typing.Optional[str] = None, trace_path: typing.Optional[str] = None) -> Instrumentation:
+    global _active
+    _active = Instrumentation(metrics_path=metrics_path, trace_path=trace_path)
+    return _active
+
+
+def finish(file=None) -> typing.Optional[Instrumentation]:
+    """
+    Writes outputs and prints the summary table.
+    """
+    global _active
+    instrumentation, _active = _active, None
+    if instrumentation:
+        instrumentation.close()
+        print(instrumentation.format_summary(), file=file)
+    return instrumentation
+
+
+def span(name: str, category: str = "stage", **attributes) -> typing.ContextManager[dict]:
+    if not _active:
+        return contextlib.nullcontext(attributes)
+    return _active.span(name, category=category, **attributes)
+
+
+def count(name: str, value: float = 1):
+    if _active:
+        _active.count(name, value)
+
+
+def get_origin() -> typing.Optional[float]:
+    return _active.origin if _active else None
+
+
+def start_worker(origin: float) -> Instrumentation:
+    """
+    For worker processes: spans and counters stay in memory until take_records, the parent merges them (merge_records).
+    origin is the parent's, so worker spans line up in the trace (perf_counter is system-wide).
+    """
+    global _active
+    _active = Instrumentation()
+    _active.origin = origin
+    return _active
+
+
+def take_records() -> typing.Optional[dict]:
+    if not _active:
+        return None
+    with _active.lock:
+        records = {"spans": _active.spans, "counters": _active.counters}
+        _active.spans, _active.counters = [], {}
+    return records
+
+
+def merge_records(records: typing.Optional[dict]):
+    if not _active or not records:
+        return
+    for recorded_span in records["spans"]:
+        _active.record_span(recorded_span)
+    for name, value in records["counters"].items():
+        _active.count(name, value)
+
+
+def main():
+    start()
+    with span("outer", items=3):
+        for i in range(3):
+            with span(f"s{i}", category="symphony", stage="outer"):
+                count("example.hit" if i else "example.miss")
+                sum(range(1000000))
+    finish()
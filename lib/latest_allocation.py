@@ -0,0 +1,269 @@
+import math
+import operator
+import typing
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+
+from . import logic, transpilers, traversers, vectorbt
+
+
+#
+# Latest allocation: a symphony's target weights for the last day, without backtesting its whole history
+# - every indicator only needs a lookback (its window, plus a warmup for exponentially smoothed ones),
+#   so only that tail of each ticker's prices is read (get_backtest_data.get_price_tails)
+# - the tree is interpreted for that one day, with the same semantics as the generated code (vectorbt.print_python_logic)
+# - indicators are computed once per (ticker, indicator, window, day) across all symphonies
+#
+# The last day is the last one all of the symphony's indicators are available on, like the last row of execute's allocations.
+# Exponentially smoothed indicators (RSI, EMA) depend on all of history, a warmup long enough that
+# the cut off history weighs less than EXPONENTIAL_TOLERANCE makes them equal to the backtest's up to float noise.
+#
+EXPONENTIAL_TOLERANCE = 1e-8
+# extra rows read per ticker, so a ticker whose latest price lags the others by a few days still has its full lookback
+TAIL_SLACK_DAYS = 21
+
+
+def get_exponential_warmup(alpha: float) -> int:
+    return math.ceil(math.log(EXPONENTIAL_TOLERANCE) / math.log(1 - alpha))
+
+
+def get_indicator_lookback(indicator: dict) -> int:
+    """
+    Rows of the ticker's prices precompute_indicator needs for its value on the last one.
+    """
+    window_days = max(indicator["window-days"], 1)
+    fn = indicator["fn"]
+    if fn == logic.ComposerIndicatorFunction.CURRENT_PRICE:
+        return 1
+    if fn in (logic.ComposerIndicatorFunction.MOVING_AVERAGE_PRICE, logic.ComposerIndicatorFunction.STANDARD_DEVIATION_PRICE):
+        return window_days
+    if fn in (logic.ComposerIndicatorFunction.CUMULATIVE_RETURN, logic.ComposerIndicatorFunction.MOVING_AVERAGE_RETURNS, logic.ComposerIndicatorFunction.STANDARD_DEVIATION_RETURNS):
+        return window_days + 1
+    if fn == logic.ComposerIndicatorFunction.MAX_DRAWDOWN:
+        # rolling min of drawdowns from a rolling max
+        return 2 * window_days - 1
+    if fn == logic.ComposerIndicatorFunction.EMA_PRICE:
+        # seeded with the SMA of the first window, then smoothed with alpha = 2 / (window + 1)
+        return window_days + get_exponential_warmup(2 / (window_days + 1))
+    if fn == logic.ComposerIndicatorFunction.RSI:
+        # Wilder's smoothing of daily changes, alpha = 1 / window
+        return window_days + 1 + get_exponential_warmup(1 / window_days)
+    raise NotImplementedError("Have not implemented indicator " + fn)
+
+
+def get_ticker_lookbacks(root_node: dict) -> typing.Dict[str, int]:
+    lookbacks = {}
+    for indicator in traversers.collect_indicators(root_node):
+        lookbacks[indicator["val"]] = max(lookbacks.get(
+            indicator["val"], 0), get_indicator_lookback(indicator))
+    return lookbacks
+
+
+@dataclass
+class LatestAllocation:
+    day: pd.Timestamp
+    weights: typing.Dict[str, float]
+    # leaf :if-child ids (or the root id) that allocated, like BranchTracker.get_active_branch_ids
+    active_branch_ids: typing.List[str]
+    # by active branch id, the :if-child ids taken from the root down to it
+    branch_paths: typing.Dict[str, typing.List[str]] = field(default_factory=dict)
+
+
+class IndicatorValues:
+    """
+    Indicator values on one day, computed on the tail of prices and memoized across symphonies.
+    days_by_ticker: rows read per ticker (get_price_tails), None if closes is the whole history.
+    """
+
+    def __init__(self, closes: pd.DataFrame, days_by_ticker: typing.Optional[typing.Mapping[str, int]] = None):
+        self.closes = closes
+        self.days_by_ticker = days_by_ticker
+        self.values: typing.Dict[tuple, float] = {}
+
+    def get_last_day(self, tickers: typing.Iterable[str]) -> typing.Optional[pd.Timestamp]:
+        """
+        Last day every ticker has a price (any ticker for a symphony without indicators).
+        """
+        tickers = list(tickers)
+        if tickers:
+            available = self.closes[tickers].notna().to_numpy().all(axis=1)
+        else:
+            available = self.closes.notna().to_numpy().any(axis=1)
+        if not available.any():
+            return None
+        return self.closes.index[len(available) - 1 - available[::-1].argmax()]
+
+    def get(self, indicator: dict, day: pd.Timestamp) -> float:
+        key = (indicator["val"], indicator["fn"], indicator["window-days"], day)
+        if key not in self.values:
+            ticker_closes = self.closes[indicator["val"]]
+            close_series = ticker_closes.iloc[:ticker_closes.index.searchsorted(
+                day, side="right")].dropna()
+            lookback = get_indicator_lookback(indicator)
+            if len(close_series) < lookback and self.days_by_ticker is not None and ticker_closes.count() >= self.days_by_ticker[indicator["val"]]:
+                # the tail was cut before the lookback started, not the ticker's history
+                raise ValueError(
+                    f"{indicator['val']} has more than {TAIL_SLACK_DAYS} days of prices after {day.date()}, read a longer tail")
+            self.values[key] = float(transpilers.precompute_indicator(
+                close_series.iloc[-lookback:], indicator["fn"], indicator["window-days"]).iloc[-1])
+        return self.values[key]
+
+
+COMPARISON_OPERATORS = {
+    logic.ComposerComparison.LTE: operator.le,
+    logic.ComposerComparison.LT: operator.lt,
+    logic.ComposerComparison.GTE: operator.ge,
+    logic.ComposerComparison.GT: operator.gt,
+    logic.ComposerComparison.EQ: operator.eq,
+}
+
+
+def evaluate_condition(node: dict, indicator_values: IndicatorValues, day: pd.Timestamp) -> bool:
+    lhs = indicator_values.get(traversers.extract_lhs_indicator(node), day)
+    rhs_indicator = traversers.extract_rhs_indicator(node)
+    rhs = indicator_values.get(
+        rhs_indicator, day) if rhs_indicator else float(node[":rhs-val"])
+    return COMPARISON_OPERATORS[node[":comparator"]](lhs, rhs)
+
+
+def select_filter_tickers(node: dict, indicator_values: IndicatorValues, day: pd.Timestamp) -> typing.List[str]:
+    entries = [(indicator_values.get(indicator, day), indicator["val"])
+               for indicator in traversers.extract_filter_indicators(node)]
+    return [ticker for _sort_value, ticker in sorted(entries, reverse=node[":select-fn"] == ":top")[:int(node[":select-n"])]]
+
+
+def evaluate_node(node: dict, parent_node_branch_state: logic.NodeBranchState, indicator_values: IndicatorValues, day: pd.Timestamp, allocation: LatestAllocation):
+    """
+    vectorbt.print_python_logic, for one day: adds node's weights to allocation.
+    """
+    current_node_branch_state = logic.advance_branch_state(
+        parent_node_branch_state, node)
+
+    def activate_branch():
+        branch_id = current_node_branch_state.branch_path_ids[-1]
+        if branch_id not in allocation.branch_paths:
+            allocation.active_branch_ids.append(branch_id)
+            allocation.branch_paths[branch_id] = current_node_branch_state.branch_path_ids[1:]
+
+    def allocate(ticker: str, weight: float):
+        allocation.weights[ticker] = allocation.weights.get(
+            ticker, 0.0) + weight
+
+    if logic.is_if_node(node):
+        for child_node in logic.get_node_children(node):
+            if not logic.is_conditional_node(child_node) or evaluate_condition(child_node, indicator_values, day):
+                evaluate_node(child_node, current_node_branch_state,
+                              indicator_values, day, allocation)
+                break
+        return
+    if logic.is_asset_node(node):
+        activate_branch()
+        allocate(logic.get_ticker_of_asset_node(node),
+                 current_node_branch_state.weight)
+        return
+    if logic.is_filter_node(node):
+        activate_branch()
+        weight = logic.advance_branch_state(
+            current_node_branch_state, logic.get_node_children(node)[0]).weight
+        for ticker in select_filter_tickers(node, indicator_values, day):
+            allocate(ticker, weight)
+        return
+    if logic.is_weight_inverse_volatility_node(node):
+        activate_branch()
+        entries = [(1 / indicator_values.get(indicator, day), indicator["val"])
+                   for indicator in traversers.extract_inverse_volatility_indicators(node)]
+        overall_inverse_volatility = sum(entry[0] for entry in entries)
+        weight = logic.advance_branch_state(
+            current_node_branch_state, logic.get_node_children(node)[0]).weight
+        for inverse_volatility, ticker in entries:
+            allocate(ticker, weight * (inverse_volatility /
+                     overall_inverse_volatility))
+        return
+
+    for child_node in logic.get_node_children(node):
+        evaluate_node(child_node, current_node_branch_state,
+                      indicator_values, day, allocation)
+
+
+def get_latest_allocation(root_node: dict, indicator_values: IndicatorValues) -> LatestAllocation:
+    assert not traversers.collect_nodes_of_type(
+        ":wt-marketcap", root_node), "Market cap weighting is not supported."
+    indicators = traversers.collect_indicators(root_node)
+    day = indicator_values.get_last_day(
+        {indicator["val"] for indicator in indicators})
+    if day is None:
+        raise ValueError("no day with prices for every indicator")
+    for indicator in indicators:
+        if np.isnan(indicator_values.get(indicator, day)):
+            raise ValueError(
+                f"{vectorbt.extract_indicator_key_from_indicator(indicator)} is not available yet (not enough history)")
+
+    return evaluate_allocation(root_node, indicator_values, day)
+
+
+def evaluate_allocation(root_node: dict, indicator_values: IndicatorValues, day: pd.Timestamp) -> LatestAllocation:
+    """
+    Interprets the tree on day, every indicator must be available (see get_latest_allocation).
+    """
+    allocation = LatestAllocation(day=day, weights={}, active_branch_ids=[])
+    evaluate_node(root_node, logic.build_node_branch_state_from_root_node(
+        root_node), indicator_values, day, allocation)
+    allocation.active_branch_ids.sort()
+    return allocation
+
+
+def get_latest_allocations(root_nodes_by_id: typing.Mapping[str, dict], closes: typing.Optional[pd.DataFrame] = None, indicator_values=None) -> typing.Tuple[typing.Dict[str, LatestAllocation], typing.Dict[str, str]]:
+    """
+    (allocations, failures) by symphony id. Without closes, only the tail of prices each indicator needs is read.
+    indicator_values: anything with IndicatorValues' get_last_day/get instead, like online_indicators.OnlineIndicators.
+    """
+    allocations, failures = {}, {}
+    if indicator_values is not None:
+        for symphony_id, root_node in root_nodes_by_id.items():
+            try:
+                allocations[symphony_id] = get_latest_allocation(
+                    root_node, indicator_values)
+            except Exception as e:
+                failures[symphony_id] = f"{type(e).__name__}: {e}"
+        return allocations, failures
+
+    days_by_ticker = None
+    if closes is None:
+        from . import get_backtest_data
+        days_by_ticker = {}
+        for root_node in root_nodes_by_id.values():
+            for ticker, lookback in get_ticker_lookbacks(root_node).items():
+                days_by_ticker[ticker] = max(days_by_ticker.get(
+                    ticker, 0), lookback + TAIL_SLACK_DAYS)
+        closes = get_backtest_data.get_price_tails(days_by_ticker)
+    return get_latest_allocations(root_nodes_by_id, indicator_values=IndicatorValues(closes, days_by_ticker))
+
+
+def main():
+    import time
+
+    from . import batch_backtest, synthetic
+
+    tickers = synthetic.generate_tickers(20)
+    closes = synthetic.generate_closes(tickers)
+    root_nodes_by_id = {f"s{seed}": synthetic.generate_symphony(
+        depth=5, breadth=2, tickers=tickers, seed=seed) for seed in range(10)}
+
+    start = time.perf_counter()
+    allocations, failures = get_latest_allocations(root_nodes_by_id, closes)
+    print(f"latest: {time.perf_counter() - start:.2f}s, {len(failures)} failed")
+
+    start = time.perf_counter()
+    for symphony_id, root_node in root_nodes_by_id.items():
+        backtest_allocations, branch_tracker = transpilers.VectorBTTranspiler.execute(
+            root_node, batch_backtest.select_symphony_closes(closes, root_node))
+        last_row = backtest_allocations.iloc[-1]
+        latest = allocations[symphony_id]
+        assert latest.day == backtest_allocations.index[-1]
+        assert all(abs(last_row.get(ticker, 0.0) - latest.weights.get(ticker, 0.0)) < 1e-9 for ticker in set(
+            last_row.index) | set(latest.weights)), symphony_id
+        assert latest.active_branch_ids == sorted(
+            branch_tracker.get_active_branch_ids(latest.day)), symphony_id
+    print(f"execute: {time.perf_counter() - start:.2f}s, same allocations")
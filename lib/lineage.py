@@ -0,0 +1,337 @@
+import difflib
+import typing
+
+import numpy as np
+import pandas as pd
+
+from . import human, latest_allocation, logic, subtrees, transpilers, traversers
+from .branch_tracker import BranchTracker
+
+
+#
+# Versions of a symphony: parent/child copies (Composer's `copied-from`) and edits
+#
+# diff_trees pairs the nodes of two versions, so edits read as "inserted/deleted/modified" instead of a wall of text:
+# - children are paired by :id first (edits in the same symphony keep ids),
+# - then by structural hash (copies get new ids, see subtrees.collect_subtree_hashes),
+# - then in order among children of the same :step (a changed threshold, a swapped ticker)
+# unpaired children are deleted (parent only) or inserted (child only), paired subtrees with equal hashes are unchanged.
+#
+# evaluate_lineage backtests every version by splicing it from the one before it (splice_version):
+# - a change can only matter on days its parent node is reached, which the parent version's branch tracker tells
+#   (a node is reached whenever a branch at or under its nearest :if-child is active)
+# - a changed condition only matters on those days if its value flipped (conditions are vectorized, indicators computed once
+#   with transpilers.precompute_indicator_cached)
+# only those days are evaluated (build_allocations_matrix days), every other day keeps the parent version's allocation rows and branches.
+# Versions that cannot be spliced are evaluated whole.
+#
+CHANGE_TYPES = ["inserted", "deleted", "modified"]
+# fields of an :if-child's condition, changing only those matters on the days the condition flips
+CONDITION_FIELDS = {":lhs-fn", ":lhs-val", ":lhs-window-days", ":comparator",
+                    ":rhs-fn", ":rhs-val", ":rhs-window-days", ":rhs-fixed-value?"}
+
+
+def describe_node(node: dict) -> str:
+    if logic.is_if_child_node(node):
+        if logic.is_conditional_node(node):
+            return f"if {human.pretty_condition(node)}"
+        return "else"
+    if logic.is_asset_node(node):
+        return node[":ticker"]
+    if logic.is_filter_node(node):
+        return human.pretty_filter(node)
+    if node.get(":name"):
+        return f"{node[':step']} \"{node[':name']}\""
+    return node[":step"]
+
+
+def get_compared_fields(node: dict, parent_node: typing.Optional[dict]) -> dict:
+    fields = subtrees.get_node_fields(node)
+    # a child's weight belongs to its parent, like in subtrees.collect_subtree_hashes
+    if parent_node is not None and logic.is_specified_weight_node(parent_node):
+        fields[":weight"] = node.get(":weight")
+    return fields
+
+
+def pair_children(children: typing.List[dict], other_children: typing.List[dict], hashes_by_id: typing.Dict[str, str], other_hashes_by_id: typing.Dict[str, str]) -> typing.Tuple[typing.List[typing.Tuple[dict, dict]], typing.List[dict], typing.List[dict]]:
+    """
+    (paired children, deleted children, inserted children)
+    """
+    unpaired = list(range(len(children)))
+    other_unpaired = list(range(len(other_children)))
+    pairs = []
+
+    def pair_by(get_key, get_other_key):
+        for i in list(unpaired):
+            key = get_key(children[i])
+            for j in other_unpaired:
+                if get_other_key(other_children[j]) == key:
+                    pairs.append((i, j))
+                    unpaired.remove(i)
+                    other_unpaired.remove(j)
+                    break
+
+    pair_by(lambda child: child[":id"], lambda child: child[":id"])
+    pair_by(lambda child: hashes_by_id[child[":id"]],
+            lambda child: other_hashes_by_id[child[":id"]])
+    pair_by(lambda child: child[":step"], lambda child: child[":step"])
+
+    pairs.sort(key=lambda pair: pair[1])
+    return [(children[i], other_children[j]) for i, j in pairs], [children[i] for i in unpaired], [other_children[j] for j in other_unpaired]
+
+
+def compare_trees(parent_root_node: dict, child_root_node: dict) -> typing.Tuple[typing.List[dict], typing.Dict[str, str]]:
+    """
+    (diff_trees' changes, child node id by parent node id of every paired node).
+    """
+    parent_hashes_by_id = subtrees.collect_subtree_hashes(parent_root_node)
+    child_hashes_by_id = subtrees.collect_subtree_hashes(child_root_node)
+    changes = []
+    child_ids_by_parent_id = {}
+
+    def add_change(change_type: str, node: dict, path: typing.List[str], parent_id: str, fields: typing.Optional[dict] = None):
+        changes.append({
+            "change": change_type,
+            "id": node[":id"],
+            "step": node[":step"],
+            "path": path + [describe_node(node)],
+            "fields": fields or {},
+            # node of the parent tree the change is under (the root for changes of the root itself)
+            "parent_id": parent_id,
+        })
+
+    def visit(parent_node: dict, child_node: dict, parent_of_parent_node: typing.Optional[dict], parent_of_child_node: typing.Optional[dict], path: typing.List[str]):
+        fields = get_compared_fields(parent_node, parent_of_parent_node)
+        child_fields = get_compared_fields(child_node, parent_of_child_node)
+        if parent_hashes_by_id[parent_node[":id"]] == child_hashes_by_id[child_node[":id"]] and fields == child_fields:
+            child_ids_by_parent_id.update(
+                subtrees.map_node_ids(parent_node, child_node))
+            return
+        child_ids_by_parent_id[parent_node[":id"]] = child_node[":id"]
+        changed_fields = {key: (fields.get(key), child_fields.get(key)) for key in sorted(
+            fields.keys() | child_fields.keys()) if fields.get(key) != child_fields.get(key)}
+        if changed_fields:
+            add_change("modified", child_node, path,
+                       (parent_of_parent_node or parent_node)[":id"], changed_fields)
+
+        child_path = path + [describe_node(child_node)]
+        pairs, deleted, inserted = pair_children(
+            logic.get_node_children(parent_node), logic.get_node_children(child_node), parent_hashes_by_id, child_hashes_by_id)
+        for node in deleted:
+            add_change("deleted", node, child_path, parent_node[":id"])
+        for node in inserted:
+            add_change("inserted", node, child_path, parent_node[":id"])
+        for parent_child, child_child in pairs:
+            visit(parent_child, child_child,
+                  parent_node, child_node, child_path)
+
+    visit(parent_root_node, child_root_node, None, None, [])
+    return changes, child_ids_by_parent_id
+
+
+def diff_trees(parent_root_node: dict, child_root_node: dict) -> typing.List[dict]:
+    """
+    Changes from parent to child, in child tree order (deletions where their parent is).
+    """
+    return compare_trees(parent_root_node, child_root_node)[0]
+
+
+def format_value(value) -> str:
+    if isinstance(value, dict) and ":num" in value:
+        return f"{value[':num']}/{value[':den']}"
+    return str(value)
+
+
+def format_changes(changes: typing.List[dict]) -> str:
+    if not changes:
+        return "no changes"
+    lines = []
+    symbols = {"inserted": "+", "deleted": "-", "modified": "~"}
+    for change in changes:
+        lines.append(
+            f"{symbols[change['change']]} {' > '.join(change['path'])} ({change['id']})")
+        for key, (value, other_value) in change["fields"].items():
+            lines.append(
+                f"    {key}: {format_value(value)} -> {format_value(other_value)}")
+    return "\n".join(lines)
+
+
+def format_unified_diff(parent_root_node: dict, child_root_node: dict, parent_name: str = "parent", child_name: str = "child") -> str:
+    """
+    Line diff of the human readable format.
+    """
+    return "".join(difflib.unified_diff(
+        human.convert_to_pretty_format(parent_root_node).splitlines(True),
+        human.convert_to_pretty_format(child_root_node).splitlines(True),
+        fromfile=parent_name, tofile=child_name))
+
+
+#
+# Incremental backtests
+#
+def collect_region_ids(root_node: dict) -> typing.Dict[str, str]:
+    """
+    By node id, the nearest :if-child at or above it (or the root): the node is reached on the days that branch is taken.
+    """
+    region_ids = {}
+
+    def visit(node: dict, region_id: str):
+        if logic.is_if_child_node(node):
+            region_id = node[":id"]
+        region_ids[node[":id"]] = region_id
+        for child_node in logic.get_node_children(node):
+            visit(child_node, region_id)
+
+    visit(root_node, root_node[":id"])
+    return region_ids
+
+
+def always_activates_branch(node: dict) -> bool:
+    """
+    Whether evaluating node always sets a branch tracker bit, so the days it is reached show in the branch tracker.
+    """
+    if logic.is_asset_node(node) or logic.is_filter_node(node) or logic.is_weight_inverse_volatility_node(node):
+        return True
+    children = logic.get_node_children(node)
+    if logic.is_if_node(node):
+        return bool(children) and not logic.is_conditional_node(children[-1]) and all(always_activates_branch(child_node) for child_node in children)
+    return any(always_activates_branch(child_node) for child_node in children)
+
+
+def evaluate_condition_days(node: dict, closes: pd.DataFrame, index: pd.DatetimeIndex, indicator_cache: dict) -> np.ndarray:
+    """
+    The :if-child's condition on each day of index, like the generated code's condition columns.
+    """
+    def get_values(indicator: dict) -> np.ndarray:
+        return transpilers.precompute_indicator_cached(indicator_cache, closes[indicator["val"]], indicator["fn"], indicator["window-days"]).reindex(index).to_numpy()
+
+    rhs_indicator = traversers.extract_rhs_indicator(node)
+    rhs = get_values(rhs_indicator) if rhs_indicator else float(
+        node[":rhs-val"])
+    return latest_allocation.COMPARISON_OPERATORS[node[":comparator"]](get_values(traversers.extract_lhs_indicator(node)), rhs)
+
+
+def splice_version(parent_root_node: dict, parent_closes: pd.DataFrame, parent_matrix: typing.Tuple[pd.DataFrame, BranchTracker], root_node: dict, closes: pd.DataFrame, indicator_cache: dict) -> typing.Optional[typing.Tuple[pd.DataFrame, BranchTracker]]:
+    """
+    build_allocations_matrix of root_node, from its parent version's (parent_matrix): only the days a change could matter on
+    are evaluated, the others keep the parent's allocation rows and branches.
+    None if the parent's branches cannot tell those days, or the versions are not on the same days.
+    """
+    parent_allocations, parent_branch_tracker = parent_matrix
+    changes, child_ids_by_parent_id = compare_trees(
+        parent_root_node, root_node)
+    parent_nodes_by_id = {node[":id"]: node for node in subtrees.iter_nodes(
+        parent_root_node)}
+    child_nodes_by_id = {node[":id"]: node for node in subtrees.iter_nodes(
+        root_node)}
+    parent_ids_by_child_id = {child_id: parent_id for parent_id,
+                              child_id in child_ids_by_parent_id.items()}
+    region_ids = collect_region_ids(parent_root_node)
+    index = parent_branch_tracker.index
+    parent_bits = parent_branch_tracker.to_bits()
+
+    changed_days = np.zeros(len(index), dtype=bool)
+    for change in changes:
+        region_node = parent_nodes_by_id[region_ids[change["parent_id"]]]
+        if not always_activates_branch(region_node):
+            return None
+        region_node_ids = {node[":id"]
+                           for node in subtrees.iter_nodes(region_node)}
+        reached_days = parent_bits[:, [bit for bit, branch_id in enumerate(
+            parent_branch_tracker.branch_ids) if branch_id in region_node_ids]].any(axis=1)
+        child_node = child_nodes_by_id.get(change["id"])
+        if change["change"] == "modified" and logic.is_conditional_node(child_node) and change["fields"].keys() <= CONDITION_FIELDS:
+            reached_days &= evaluate_condition_days(parent_nodes_by_id[parent_ids_by_child_id[change["id"]]], parent_closes, index, indicator_cache) != evaluate_condition_days(
+                child_node, closes, index, indicator_cache)
+        changed_days |= reached_days
+
+    allocations, branch_tracker = transpilers.VectorBTTranspiler.build_allocations_matrix(
+        root_node, closes, indicator_cache=indicator_cache, days=index[changed_days])
+    if not allocations.index.equals(index):
+        return None
+
+    kept_days = ~changed_days
+    values = allocations.to_numpy(dtype=np.float64, copy=True)
+    columns = allocations.columns.get_indexer(parent_allocations.columns)
+    present = columns >= 0
+    values[np.ix_(kept_days, columns[present])] = parent_allocations.to_numpy(
+        dtype=np.float64)[kept_days][:, present]
+
+    bits = branch_tracker.to_bits()
+    bits_by_branch_id = {branch_id: bit for bit,
+                         branch_id in enumerate(branch_tracker.branch_ids)}
+    for parent_bit, parent_branch_id in enumerate(parent_branch_tracker.branch_ids):
+        kept_branch_days = kept_days & parent_bits[:, parent_bit]
+        if not kept_branch_days.any():
+            continue
+        bit = bits_by_branch_id.get(
+            child_ids_by_parent_id.get(parent_branch_id))
+        if bit is None:
+            return None
+        bits[kept_branch_days, bit] = True
+    return pd.DataFrame(values, index=allocations.index, columns=allocations.columns), BranchTracker.from_bits(index, branch_tracker.branch_ids, bits)
+
+
+def evaluate_lineage(root_nodes: typing.List[dict], closes: pd.DataFrame, subtree_cache: typing.Optional[subtrees.SubtreeCache] = None) -> typing.List[typing.Tuple[pd.DataFrame, BranchTracker]]:
+    """
+    VectorBTTranspiler.execute of every version (a copied-from chain, in order: each version is spliced from the one before it).
+    Only the first version, and versions that cannot be spliced, are evaluated whole (with subtree_cache, if given).
+    """
+    from . import batch_backtest
+
+    if subtree_cache is None:
+        # for its indicator cache, subtrees are not shared: splicing only evaluates the days a change matters on
+        subtree_cache = subtrees.SubtreeCache(set())
+
+    results = []
+    parent = None
+    for root_node in root_nodes:
+        version_closes = batch_backtest.select_symphony_closes(
+            closes, root_node)
+        matrix = splice_version(
+            *parent, root_node, version_closes, subtree_cache.indicator_cache) if parent else None
+        if matrix is None:
+            matrix = transpilers.VectorBTTranspiler.build_allocations_matrix(
+                root_node, version_closes, subtree_cache=subtree_cache)
+        parent = (root_node, version_closes, matrix)
+        results.append(transpilers.VectorBTTranspiler.trim_allocations(
+            root_node, version_closes, *matrix))
+    return results
+
+
+def main():
+    import copy
+    import time
+
+    from . import synthetic
+
+    root_node = synthetic.generate_symphony(depth=5, breadth=2, seed=1)
+    closes = synthetic.generate_closes(
+        sorted(traversers.collect_referenced_assets(root_node)))
+
+    # each version moves one threshold of the previous one
+    versions = [root_node]
+    for version_number in range(1, 20):
+        version = copy.deepcopy(versions[-1])
+        conditions = [node for node in subtrees.iter_nodes(version) if logic.is_conditional_node(
+            node) and node.get(":rhs-fixed-value?", type(node[":rhs-val"]) != str)]
+        condition = conditions[version_number % len(conditions)]
+        condition[":rhs-val"] = str(float(condition[":rhs-val"]) + 1)
+        versions.append(version)
+    print(format_changes(diff_trees(versions[0], versions[1])))
+
+    start = time.perf_counter()
+    evaluate_lineage(versions[:1], closes)
+    one_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    results = evaluate_lineage(versions, closes)
+    print(
+        f"{len(versions)} versions: {time.perf_counter() - start:.2f}s, one version: {one_seconds:.2f}s")
+
+    # spliced versions are what a whole evaluation gives
+    from . import batch_backtest
+    allocations, branch_tracker = transpilers.VectorBTTranspiler.execute(
+        versions[-1], batch_backtest.select_symphony_closes(closes, versions[-1]))
+    assert np.allclose(results[-1][0].to_numpy(dtype=np.float64), allocations.to_numpy(dtype=np.float64))
+    assert (results[-1][1].to_bits() == branch_tracker.to_bits()).all()
+    print("last version matches its whole evaluation")
@@ -1,5 +1,8 @@
 import datetime
+import typing
+
 from . import traversers, manual_testing
+from .ticker_index import TickerIndex
 
 
 #
@@ -9,33 +12,82 @@ from . import traversers, manual_testing
 # - patterns/indicators we find are flawed
 # - TODO: think of additional common issues we might scan for
 #
+# Ticker facts come from the ticker index (lib/ticker_index.py), never from price data,
+# so linting the whole catalog is a loop over its tickers.
+#
+# tickers whose prices stopped this many days before the newest prices in the index (delisted, renamed)
+STALE_DAYS = 7
+
 
+def get_ticker_warnings(tickers: typing.Iterable[str], ticker_index: TickerIndex, newest_day: typing.Optional[datetime.date] = None) -> typing.Dict[str, str]:
+    """
+    Warning by ticker. newest_day: ticker_index.get_newest_day(), to only compute it once per catalog.
+    """
+    tickers = sorted(tickers)
+    warnings = ticker_index.get_illiquid_tickers(tickers)
+    newest_day = newest_day or ticker_index.get_newest_day()
+    for ticker in tickers:
+        entry = ticker_index.get(ticker)
+        if entry is None or entry.first_day is None:
+            warnings.setdefault(ticker, "No price data")
+            continue
+        if newest_day and (newest_day - datetime.date.fromisoformat(entry.last_day)).days > STALE_DAYS:
+            warnings.setdefault(
+                ticker, f"No prices since {entry.last_day}")
+        if entry.gaps:
+            warnings.setdefault(
+                ticker, f"{entry.gaps} gaps in its prices")
+    return warnings
 
-def log_warnings_for_dangerous_tickers(root_node):
+
+def log_warnings_for_dangerous_tickers(root_node, ticker_index: typing.Optional[TickerIndex] = None):
+    ticker_index = ticker_index or TickerIndex.load()
     allocateable_assets = traversers.collect_allocateable_assets(root_node)
     print("Possible assets to allocate toward:", allocateable_assets)
-    problematic_assets = {  # TODO: look entries up (I have this in the ETF DB)
-        "UGE": "Volume is too low",
-        # TODO: remove this:
-        "VIXY": "(Fake error for testing this code, ignore)",
-    }
-    for asset in allocateable_assets:
-        if asset in problematic_assets:
-            print("WARNING", asset, problematic_assets[asset])
+    for asset, warning in get_ticker_warnings(allocateable_assets, ticker_index).items():
+        print("WARNING", asset, warning)
 
 
-def log_earliest_backtest_date(root_node):
+def log_earliest_backtest_date(root_node, ticker_index: typing.Optional[TickerIndex] = None):
+    ticker_index = ticker_index or TickerIndex.load()
     all_referenced_assets = traversers.collect_referenced_assets(root_node)
     print("All assets referenced:", all_referenced_assets)
-    latest_founded_asset = max(all_referenced_assets, key=get_founded_date)
-    latest_founded_date = get_founded_date(latest_founded_asset)
+    latest_founded_date, latest_founded_asset = ticker_index.get_earliest_backtest_day(
+        all_referenced_assets)
+    if latest_founded_date is None:
+        unknown_assets = sorted(
+            asset for asset in all_referenced_assets if get_founded_date(asset, ticker_index) is None)
+        print(f"Earliest backtest date is unknown (no prices for {unknown_assets})")
+        return
     print(
         f"Earliest backtest date is {latest_founded_date} (when {latest_founded_asset} was founded)")
 
 
-def get_founded_date(ticker: str) -> datetime.date:
-    print("TODO: implement actual founded_date lookup")
-    return datetime.date(2012, 1, 1)
+def get_founded_date(ticker: str, ticker_index: typing.Optional[TickerIndex] = None) -> typing.Optional[datetime.date]:
+    """
+    First day with a price in the price store, None if it has none.
+    """
+    return (ticker_index or TickerIndex.load()).get_founded_day(ticker)
+
+
+def lint_symphonies(root_nodes_by_id: typing.Mapping[str, dict], ticker_index: TickerIndex) -> typing.List[dict]:
+    """
+    A row per symphony: earliest backtest date, and warnings about the tickers it can allocate toward.
+    """
+    newest_day = ticker_index.get_newest_day()
+    rows = []
+    for symphony_id, root_node in root_nodes_by_id.items():
+        earliest_day, latest_founded_asset = ticker_index.get_earliest_backtest_day(
+            traversers.collect_referenced_assets(root_node))
+        warnings = get_ticker_warnings(
+            traversers.collect_allocateable_assets(root_node), ticker_index, newest_day)
+        rows.append({
+            "symphony_id": symphony_id,
+            "earliest_backtest_date": earliest_day.isoformat() if earliest_day else None,
+            "latest_founded_ticker": latest_founded_asset,
+            "warnings": "; ".join(f"{ticker}: {warning}" for ticker, warning in warnings.items()),
+        })
+    return rows
 
 
 def main():
@@ -123,7 +123,7 @@ class NodeBranchState:
     parent_nodes: typing.List[dict]
 
     def copy(self):
-        return NodeBranchState(weight=self.weight, branch_path_ids=[i for i in self.branch_path_ids], parent_nodes=[n for n in self.parent_nodes])
+        return NodeBranchState(weight=self.weight, branch_path_ids=list(self.branch_path_ids), parent_nodes=list(self.parent_nodes))
 
 
 def build_node_branch_state_from_root_node(node) -> NodeBranchState:
@@ -0,0 +1,280 @@
+import typing
+
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+
+#
+# Performance stats for many symphonies at once
+# - input is a (days, symphonies) returns matrix, NaN outside each symphony's backtest (artifact_store.load_all_returns, BatchBacktest.returns)
+# - same numbers as the quantstats.stats functions populate_symphonies used to call per symphony
+#   (max_drawdown, sharpe, kelly_criterion, cagr, serenity_index, greeks beta, and their 126 day tails)
+# - internally (symphonies, days), so every reduction runs along contiguous rows like pandas does on a Series
+#
+TRADING_DAYS = 252
+ROLLING_DAYS = 126
+RECENT_DAYS = 10
+CVAR_CONFIDENCE = 0.95
+
+STAT_NAMES = ["Max Drawdown", "Sharpe", "Kelly", "CAGR", "Serenity", "Adjusted Drawdown Risk",
+              "rolling_kelly", "rolling_beta", "rolling_sharpe", "2weeks"]
+
+# expected shortfall of a standard normal at 1 - CVAR_CONFIDENCE, in standard deviations
+EXPECTED_SHORTFALL_FACTOR = norm.pdf(
+    norm.ppf(1 - CVAR_CONFIDENCE)) / (1 - CVAR_CONFIDENCE)
+
+
+#
+# NaN-aware row reductions (what pandas nanops does for a Series)
+#
+def nan_count(values: np.ndarray) -> np.ndarray:
+    return (~np.isnan(values)).sum(axis=1)
+
+
+def nan_sum(values: np.ndarray) -> np.ndarray:
+    return np.where(np.isnan(values), 0.0, values).sum(axis=1)
+
+
+def nan_mean(values: np.ndarray) -> np.ndarray:
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return nan_sum(values) / nan_count(values)
+
+
+def nan_std(values: np.ndarray) -> np.ndarray:
+    mask = np.isnan(values)
+    count = (~mask).sum(axis=1)
+    filled = np.where(mask, 0.0, values)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = filled.sum(axis=1) / count
+        squares = np.where(mask, 0.0, (mean[:, None] - filled) ** 2)
+        variance = squares.sum(axis=1) / (count - 1)
+    variance[count <= 1] = np.nan
+    return np.sqrt(variance)
+
+
+def nan_prod(values: np.ndarray) -> np.ndarray:
+    return np.where(np.isnan(values), 1.0, values).prod(axis=1)
+
+
+#
+# Stats over (symphonies, days) rows
+#
+def compute_sharpe(values: np.ndarray) -> np.ndarray:
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return nan_mean(values) / nan_std(values) * np.sqrt(TRADING_DAYS)
+
+
+def compute_kelly(values: np.ndarray) -> np.ndarray:
+    wins = np.where(values > 0, values, np.nan)
+    losses = np.where(values < 0, values, np.nan)
+    win_count = nan_count(wins)
+    non_zero_count = win_count + nan_count(losses)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        payoff_ratio = nan_mean(wins) / np.abs(nan_mean(losses))
+        win_rate = np.where(non_zero_count > 0,
+                            win_count / non_zero_count, 0.0)
+        kelly = ((payoff_ratio * win_rate) - (1 - win_rate)) / payoff_ratio
+    kelly[(payoff_ratio == 0) | np.isnan(payoff_ratio)] = np.nan
+    return kelly
+
+
+def compute_cagr(values: np.ndarray) -> np.ndarray:
+    wealth = (nan_prod(values + 1) - 1) + 1.0
+    years = nan_count(values) / TRADING_DAYS
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(wealth < 0, np.nan, np.abs(wealth) ** (1.0 / years) - 1)
+
+
+def compute_drawdowns(values: np.ndarray, in_span: np.ndarray) -> np.ndarray:
+    """
+    Drawdown series (NaN outside each span), from a baseline of 1.0 before the first day.
+    """
+    # prices as quantstats rebuilds them: 1 + compsum, gaps carried forward
+    prices = 1.0 + (np.cumprod(np.where(np.isnan(values),
+                    0.0, values) + 1, axis=1) - 1)
+    peaks = np.maximum.accumulate(np.maximum(prices, 1.0), axis=1)
+    return np.where(in_span, prices / peaks - 1.0, np.nan)
+
+
+def compute_max_drawdown(drawdowns: np.ndarray) -> np.ndarray:
+    with np.errstate(invalid="ignore"):
+        return np.nanmin(np.where(np.isnan(drawdowns), np.inf, drawdowns + 1.0), axis=1) - 1
+
+
+def compute_serenity(values: np.ndarray, drawdowns: np.ndarray, span_lengths: np.ndarray) -> np.ndarray:
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ulcer_index = np.sqrt(nan_sum(drawdowns ** 2) / (span_lengths - 1))
+
+        # parametric CVaR of the drawdown series
+        drawdown_means = nan_mean(drawdowns)
+        drawdown_stds = nan_std(drawdowns)
+        cvar = np.where((drawdown_stds == 0) | np.isnan(drawdown_stds), drawdown_means,
+                        drawdown_means - drawdown_stds * EXPECTED_SHORTFALL_FACTOR)
+
+        stds = nan_std(values)
+        pitfall = -cvar / stds
+        denominator = ulcer_index * pitfall
+        serenity = nan_sum(values) / denominator
+    serenity[(stds == 0) | (denominator == 0)] = np.nan
+    return serenity
+
+
+def compute_beta(values: np.ndarray, benchmark_values: np.ndarray) -> np.ndarray:
+    """
+    Beta over the days both are observed, 0 when undefined (like quantstats.stats.greeks).
+    """
+    paired = ~np.isnan(values) & ~np.isnan(benchmark_values)
+    count = paired.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        x = np.where(paired, values, 0.0)
+        y = np.where(paired, benchmark_values, 0.0)
+        x_centered = np.where(
+            paired, x - (x.sum(axis=1) / count)[:, None], 0.0)
+        y_centered = np.where(
+            paired, y - (y.sum(axis=1) / count)[:, None], 0.0)
+        covariance = (x_centered * y_centered).sum(axis=1) / (count - 1)
+        benchmark_variance = (y_centered ** 2).sum(axis=1) / (count - 1)
+        beta = covariance / benchmark_variance
+    beta[(benchmark_variance == 0) | (count < 2) | np.isnan(beta)] = 0.0
+    return beta
+
+
+#
+# Ragged spans
+#
+def get_spans(values: np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    (first, last) observed day of each row, (0, -1) for rows without any observation
+    """
+    observed = ~np.isnan(values)
+    any_observed = observed.any(axis=1)
+    days = values.shape[1]
+    first = np.where(any_observed, observed.argmax(axis=1), 0)
+    last = np.where(any_observed, days - 1 -
+                    observed[:, ::-1].argmax(axis=1), -1)
+    return first, last
+
+
+def get_tail_positions(first: np.ndarray, last: np.ndarray, days: int) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Day positions of each row's last `days` days (like Series.tail), and which of them are inside the span.
+    """
+    positions = last[:, None] - (days - 1) + np.arange(days)[None, :]
+    inside = positions >= first[:, None]
+    return np.clip(positions, 0, None), inside
+
+
+def take_tails(values: np.ndarray, positions: np.ndarray, inside: np.ndarray) -> np.ndarray:
+    return np.where(inside, np.take_along_axis(values, positions, axis=1), np.nan)
+
+
+def align_benchmark_returns(benchmark_returns: pd.Series, index: pd.DatetimeIndex) -> pd.Series:
+    """
+    Benchmark returns on exactly `index`, as quantstats.stats.greeks does when the days differ.
+    """
+    if set(index) == set(benchmark_returns.index):
+        return benchmark_returns.reindex(index)
+    prices = 1 + ((benchmark_returns.fillna(0) + 1).cumprod() - 1)
+    aligned = prices.reindex(pd.date_range(index[0], index[-1], freq="D"), method="bfill").reindex(
+        index).pct_change().fillna(0)
+    return aligned.reindex(index)
+
+
+def build_benchmark_tails(benchmark_returns: pd.Series, index: pd.DatetimeIndex, positions: np.ndarray, inside: np.ndarray) -> np.ndarray:
+    benchmark_tail = benchmark_returns.replace(
+        [np.inf, -np.inf], np.nan).dropna().tail(ROLLING_DAYS)
+    tails = np.full(positions.shape, np.nan)
+    # rows with the same tail days share one alignment
+    tail_spans = np.stack([np.where(inside, positions, np.iinfo(np.int64).max).min(
+        axis=1), positions[:, -1], inside.sum(axis=1)], axis=1)
+    for tail_span in np.unique(tail_spans, axis=0):
+        start, end, count = tail_span
+        if count == 0:
+            continue
+        rows = (tail_spans == tail_span).all(axis=1)
+        aligned = align_benchmark_returns(
+            benchmark_tail, index[start:end + 1])
+        tails[np.ix_(rows, np.arange(positions.shape[1] - count, positions.shape[1]))] = aligned.to_numpy()
+    return tails
+
+
+def compute_stats(returns: pd.DataFrame, benchmark_returns: pd.Series, allocation_days: typing.Optional[typing.Mapping[str, int]] = None) -> pd.DataFrame:
+    """
+    STAT_NAMES per symphony (rows), for a (days, symphonies) returns matrix.
+    - benchmark_returns: daily returns of the benchmark (e.g. closes["SPY"].pct_change().dropna()), its last 126 days are used for rolling_beta
+    - allocation_days: days of allocations per symphony, for the Adjusted Drawdown Risk (defaults to the days with returns)
+    """
+    values = returns.to_numpy(dtype=np.float64).T.copy()
+    values[np.isinf(values)] = np.nan
+    days = values.shape[1]
+    first, last = get_spans(values)
+    span_lengths = np.maximum(last - first + 1, 0)
+    in_span = (np.arange(days)[None, :] >= first[:, None]) & (
+        np.arange(days)[None, :] <= last[:, None])
+
+    drawdowns = compute_drawdowns(values, in_span)
+    max_drawdown = compute_max_drawdown(drawdowns)
+    if allocation_days is None:
+        adjustment_days = span_lengths
+    else:
+        adjustment_days = np.array(
+            [allocation_days[symphony_id] for symphony_id in returns.columns])
+
+    positions, inside = get_tail_positions(first, last, ROLLING_DAYS)
+    rolling_values = take_tails(values, positions, inside)
+    recent_positions, recent_inside = get_tail_positions(
+        first, last, RECENT_DAYS)
+    recent_values = take_tails(values, recent_positions, recent_inside)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        stats = pd.DataFrame({
+            "Max Drawdown": max_drawdown,
+            "Sharpe": compute_sharpe(values),
+            "Kelly": compute_kelly(values),
+            "CAGR": compute_cagr(values),
+            "Serenity": compute_serenity(values, drawdowns, span_lengths),
+            # max drawdown is proportional to sqrt(time), so correct for that!
+            "Adjusted Drawdown Risk": max_drawdown / ((adjustment_days / TRADING_DAYS) ** 0.5),
+            "rolling_kelly": compute_kelly(rolling_values),
+            "rolling_beta": compute_beta(rolling_values, build_benchmark_tails(benchmark_returns, returns.index, positions, inside)),
+            "rolling_sharpe": compute_sharpe(rolling_values),
+            "2weeks": nan_prod(recent_values + 1) - 1,
+        }, index=pd.Index(returns.columns, name="symphony_id"))
+    # symphonies without any returns
+    stats[span_lengths == 0] = np.nan
+    return stats
+
+
+def main():
+    import quantstats
+
+    from . import synthetic
+
+    closes = synthetic.generate_closes(synthetic.generate_tickers(6))
+    daily_returns = closes.pct_change().iloc[1:]
+    returns = daily_returns.iloc[:, 1:].copy()
+    # ragged starts and ends, like a catalog of symphonies
+    returns.iloc[:300, 0] = np.nan
+    returns.iloc[-20:, 1] = np.nan
+    benchmark_returns = daily_returns.iloc[:, 0]
+
+    stats = compute_stats(returns, benchmark_returns)
+    print(stats.T)
+    for symphony_id in returns.columns:
+        series = returns[symphony_id].dropna()
+        expected = {
+            "Max Drawdown": quantstats.stats.max_drawdown(series),
+            "Sharpe": quantstats.stats.sharpe(series),
+            "Kelly": quantstats.stats.kelly_criterion(series),
+            "CAGR": quantstats.stats.cagr(series),
+            "Serenity": quantstats.stats.serenity_index(series),
+            "rolling_kelly": quantstats.stats.kelly_criterion(series.tail(ROLLING_DAYS)),
+            "rolling_beta": quantstats.stats.greeks(series.tail(ROLLING_DAYS), benchmark_returns.tail(ROLLING_DAYS))['beta'],
+            "rolling_sharpe": quantstats.stats.sharpe(series.tail(ROLLING_DAYS)),
+            "2weeks": (1 + series.tail(RECENT_DAYS)).prod() - 1,
+        }
+        for name, value in expected.items():
+            assert np.isclose(stats.at[symphony_id, name], value, rtol=1e-9, atol=1e-12, equal_nan=True), \
+                f"{symphony_id} {name}: {stats.at[symphony_id, name]} != {value}"
+    print("matches quantstats")
@@ -0,0 +1,600 @@
+import collections
+import itertools
+import json
+import math
+import os
+import typing
+from dataclasses import dataclass, field, fields
+
+import pandas as pd
+
+from . import atomic_files, logic
+
+
+#
+# Online indicators: every precompute_indicator indicator as a small state updated in O(1) per new close
+# (amortized for max drawdown), so a daily update only reads the new row instead of recomputing rolling windows over history.
+#
+# Updates follow pandas' own recurrences (Kahan-compensated rolling sums, Welford variance, its ewm weights),
+# so values equal precompute_indicator's on the same closes up to float noise.
+# States are keyed by (ticker, fn, window-days), fed the ticker's own closes (precompute_indicator drops NaN days too)
+# and serialize to JSON, see OnlineIndicators.save/load.
+# Each state also keeps its value as of its last RECENT_DAYS days: symphonies mixing calendars (BTC-USD with SPY)
+# are evaluated on the last day all their tickers have a close, like IndicatorValues, not on the day fed last.
+#
+CHECKPOINT_VERSION = 2
+# a week and a half of a ticker trading every day
+RECENT_DAYS = 10
+NAN = float("nan")
+
+
+@dataclass
+class OnlineIndicator:
+    window: int
+    # last day fed, "YYYY-MM-DD"
+    last_day: typing.Optional[str] = None
+    value: float = NAN
+    # the last RECENT_DAYS days fed, and the value as of each
+    recent_days: list = field(default_factory=list)
+    recent_values: list = field(default_factory=list)
+
+    # fields stored as collections.deque (lists in checkpoints)
+    DEQUE_FIELDS: typing.ClassVar[typing.Tuple[str, ...]] = ()
+
+    def update(self, close: float, commit: bool = True) -> float:
+        """
+        Value with close appended, commit=False leaves the state as it was (see peek).
+        """
+        raise NotImplementedError()
+
+    def commit_day(self, day: str):
+        # after update, the value is the one as of day
+        self.last_day = day
+        self.recent_days.append(day)
+        self.recent_values.append(self.value)
+        if len(self.recent_days) > RECENT_DAYS:
+            del self.recent_days[0], self.recent_values[0]
+
+    def get_value_as_of(self, day: str) -> typing.Optional[float]:
+        for recent_day, value in zip(reversed(self.recent_days), reversed(self.recent_values)):
+            if recent_day == day:
+                return value
+        return None
+
+    def peek(self, close: float) -> float:
+        # value if close were the next close, like an intraday quote (see quote_stream)
+        return self.update(close, commit=False)
+
+    def to_dict(self) -> dict:
+        return {f.name: list(getattr(self, f.name)) if f.name in self.DEQUE_FIELDS else getattr(self, f.name) for f in fields(self)}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "OnlineIndicator":
+        indicator = cls(**data)
+        for name in cls.DEQUE_FIELDS:
+            setattr(indicator, name, collections.deque(getattr(indicator, name)))
+        return indicator
+
+
+@dataclass
+class CurrentPrice(OnlineIndicator):
+    def update(self, close: float, commit: bool = True) -> float:
+        if commit:
+            self.value = close
+        return close
+
+
+@dataclass
+class CumulativeReturn(OnlineIndicator):
+    closes: collections.deque = field(default_factory=collections.deque)
+    DEQUE_FIELDS = ("closes",)
+
+    def update(self, close: float, commit: bool = True) -> float:
+        full = len(self.closes) == self.window + 1
+        value = self.value
+        if full or len(self.closes) == self.window:
+            value = (close / self.closes[1 if full else 0] - 1) * 100
+        if commit:
+            if full:
+                self.closes.popleft()
+            self.closes.append(close)
+            self.value = value
+        return value
+
+
+@dataclass
+class RollingWindow(OnlineIndicator):
+    """
+    Last window values, and how many of the latest ones are the same (pandas returns exact results for those, GH#42064)
+    """
+    values: collections.deque = field(default_factory=collections.deque)
+    same_value_count: int = 0
+    DEQUE_FIELDS = ("values",)
+
+    def count_same_value(self, value: float) -> int:
+        if self.values and value == self.values[-1]:
+            return self.same_value_count + 1
+        return 1
+
+    def push(self, value: float, full: bool):
+        if full:
+            self.values.popleft()
+        self.values.append(value)
+
+
+@dataclass
+class RollingMean(RollingWindow):
+    """
+    pandas' roll_mean: a running sum with separate Kahan compensations for added and removed values
+    """
+    total: float = 0.0
+    compensation_add: float = 0.0
+    compensation_remove: float = 0.0
+    negative_count: int = 0
+
+    def roll(self, value: float, commit: bool) -> float:
+        total, compensation_add, compensation_remove, negative_count = self.total, self.compensation_add, self.compensation_remove, self.negative_count
+        full = len(self.values) == self.window
+        if full:
+            removed = self.values[0]
+            y = -removed - compensation_remove
+            t = total + y
+            compensation_remove = t - total - y
+            total = t
+            negative_count -= math.copysign(1.0, removed) < 0
+
+        y = value - compensation_add
+        t = total + y
+        compensation_add = t - total - y
+        total = t
+        negative_count += math.copysign(1.0, value) < 0
+        same_value_count = self.count_same_value(value)
+        count = len(self.values) if full else len(self.values) + 1
+        if commit:
+            self.total, self.compensation_add, self.compensation_remove, self.negative_count = total, compensation_add, compensation_remove, negative_count
+            self.same_value_count = same_value_count
+            self.push(value, full)
+
+        if count < self.window:
+            return NAN
+        if same_value_count >= self.window:
+            return value
+        mean = total / self.window
+        # a mean of only positive (negative) values is never negative (positive)
+        if negative_count == 0 and mean < 0:
+            mean = 0.0
+        elif negative_count == self.window and mean > 0:
+            mean = 0.0
+        return mean
+
+
+@dataclass
+class MovingAveragePrice(RollingMean):
+    def update(self, close: float, commit: bool = True) -> float:
+        value = self.roll(close, commit)
+        if commit:
+            self.value = value
+        return value
+
+
+@dataclass
+class MovingAverageReturn(RollingMean):
+    previous_close: float = NAN
+
+    def update(self, close: float, commit: bool = True) -> float:
+        value = self.value
+        if not math.isnan(self.previous_close):
+            value = self.roll(close / self.previous_close - 1, commit) * 100
+        if commit:
+            self.previous_close = close
+            self.value = value
+        return value
+
+
+@dataclass
+class RollingStandardDeviation(RollingWindow):
+    """
+    pandas' roll_var (ddof=1), square rooted: Welford's mean and sum of squared deviations, Kahan compensated
+    """
+    mean: float = 0.0
+    squared_deviations: float = 0.0
+    compensation_add: float = 0.0
+    compensation_remove: float = 0.0
+
+    def roll(self, value: float, commit: bool) -> float:
+        mean, squared_deviations, compensation_add, compensation_remove = self.mean, self.squared_deviations, self.compensation_add, self.compensation_remove
+        full = len(self.values) == self.window
+        count = len(self.values)
+        if full:
+            removed = self.values[0]
+            count -= 1
+            if count:
+                previous_mean = mean - compensation_remove
+                y = removed - compensation_remove
+                t = y - mean
+                compensation_remove = t + mean - y
+                mean -= t / count
+                squared_deviations -= (removed - previous_mean) * \
+                    (removed - mean)
+            else:
+                mean = squared_deviations = 0.0
+
+        same_value_count = self.count_same_value(value)
+        count += 1
+        previous_mean = mean - compensation_add
+        y = value - compensation_add
+        t = y - mean
+        compensation_add = t + mean - y
+        mean += t / count
+        squared_deviations += (value - previous_mean) * (value - mean)
+        if commit:
+            self.mean, self.squared_deviations, self.compensation_add, self.compensation_remove = mean, squared_deviations, compensation_add, compensation_remove
+            self.same_value_count = same_value_count
+            self.push(value, full)
+
+        if count < self.window or self.window < 2:
+            return NAN
+        if same_value_count >= self.window:
+            return 0.0
+        variance = squared_deviations / (self.window - 1)
+        return math.sqrt(variance) if variance >= 0 else 0.0
+
+
+@dataclass
+class StandardDeviationPrice(RollingStandardDeviation):
+    def update(self, close: float, commit: bool = True) -> float:
+        value = self.roll(close, commit)
+        if commit:
+            self.value = value
+        return value
+
+
+@dataclass
+class StandardDeviationReturn(RollingStandardDeviation):
+    previous_close: float = NAN
+
+    def update(self, close: float, commit: bool = True) -> float:
+        value = self.value
+        if not math.isnan(self.previous_close):
+            value = self.roll((close / self.previous_close - 1) * 100, commit)
+        if commit:
+            self.previous_close = close
+            self.value = value
+        return value
+
+
+@dataclass
+class MaxDrawdown(OnlineIndicator):
+    """
+    Monotonic queues of (position, value): the window's max close, and the window's min drawdown from those maxes
+    """
+    count: int = 0
+    maxes: collections.deque = field(default_factory=collections.deque)
+    drawdowns: collections.deque = field(default_factory=collections.deque)
+    DEQUE_FIELDS = ("maxes", "drawdowns")
+
+    def get_front(self, queue: collections.deque, position: int) -> typing.Optional[float]:
+        # first entry still in the window once position is added (at most one falls out per close)
+        for entry_position, value in itertools.islice(queue, 2):
+            if entry_position > position - self.window:
+                return value
+        return None
+
+    def update(self, close: float, commit: bool = True) -> float:
+        position = self.count
+        window_max = self.get_front(self.maxes, position)
+        window_max = close if window_max is None else max(window_max, close)
+        drawdown = close / window_max - 1.0
+        window_drawdown = self.get_front(self.drawdowns, position)
+        window_drawdown = drawdown if window_drawdown is None else min(
+            window_drawdown, drawdown)
+        value = window_drawdown * -100
+        if commit:
+            self.count += 1
+            while self.maxes and self.maxes[-1][1] <= close:
+                self.maxes.pop()
+            self.maxes.append([position, close])
+            if self.maxes[0][0] <= position - self.window:
+                self.maxes.popleft()
+            while self.drawdowns and self.drawdowns[-1][1] >= drawdown:
+                self.drawdowns.pop()
+            self.drawdowns.append([position, drawdown])
+            if self.drawdowns[0][0] <= position - self.window:
+                self.drawdowns.popleft()
+            self.value = value
+        return value
+
+
+@dataclass
+class ExponentialMovingAverage(OnlineIndicator):
+    """
+    pandas_ta.ema: seeded with the SMA of the first window, then ewm(span=window, adjust=False)
+    """
+    seed_closes: list = field(default_factory=list)
+
+    def update(self, close: float, commit: bool = True) -> float:
+        value = self.value
+        if len(self.seed_closes) < self.window:
+            if len(self.seed_closes) + 1 == self.window:
+                value = float(pd.Series(self.seed_closes + [close]).sum()) / self.window
+            if commit:
+                self.seed_closes.append(close)
+        else:
+            alpha = get_ewm_alpha((self.window - 1) / 2.0)
+            old_weight = 1.0 - alpha
+            if value != close:
+                value = (old_weight * value + alpha * close) / (old_weight + alpha)
+        if commit:
+            self.value = value
+        return value
+
+
+def get_ewm_alpha(center_of_mass: float) -> float:
+    # pandas turns span/alpha into a center of mass and back, keep its rounding
+    return 1.0 / (1.0 + center_of_mass)
+
+
+def update_ewm_mean(weighted: float, old_weight: float, value: float, alpha: float) -> typing.Tuple[float, float]:
+    """
+    One step of pandas' ewm(adjust=True).mean(): (weighted mean, old weight)
+    """
+    if math.isnan(weighted):
+        return value, 1.0
+    old_weight *= 1.0 - alpha
+    if weighted != value:
+        weighted = (old_weight * weighted + value) / (old_weight + 1.0)
+    return weighted, old_weight + 1.0
+
+
+@dataclass
+class RelativeStrengthIndex(OnlineIndicator):
+    """
+    pandas_ta.rsi: Wilder's smoothing (pandas_ta.rma, ewm(alpha=1/window, min_periods=window)) of gains and losses
+    """
+    previous_close: float = NAN
+    changes: int = 0
+    gain: float = NAN
+    gain_weight: float = 1.0
+    loss: float = NAN
+    loss_weight: float = 1.0
+
+    def update(self, close: float, commit: bool = True) -> float:
+        if math.isnan(self.previous_close):
+            if commit:
+                self.previous_close = close
+            return self.value
+        change = close - self.previous_close
+        alpha = 1.0 / self.window
+        alpha = get_ewm_alpha((1.0 - alpha) / alpha)
+        gain, gain_weight = update_ewm_mean(
+            self.gain, self.gain_weight, max(change, 0.0), alpha)
+        loss, loss_weight = update_ewm_mean(
+            self.loss, self.loss_weight, min(change, 0.0), alpha)
+        value = self.value
+        if self.changes + 1 >= self.window:
+            denominator = gain + abs(loss)
+            # flat prices, 0/0 like pandas
+            value = 100 * gain / denominator if denominator else NAN
+        if commit:
+            self.previous_close = close
+            self.changes += 1
+            self.gain, self.gain_weight, self.loss, self.loss_weight = gain, gain_weight, loss, loss_weight
+            self.value = value
+        return value
+
+
+INDICATOR_CLASSES: typing.Dict[str, typing.Type[OnlineIndicator]] = {
+    logic.ComposerIndicatorFunction.CURRENT_PRICE: CurrentPrice,
+    logic.ComposerIndicatorFunction.CUMULATIVE_RETURN: CumulativeReturn,
+    logic.ComposerIndicatorFunction.MOVING_AVERAGE_PRICE: MovingAveragePrice,
+    logic.ComposerIndicatorFunction.MOVING_AVERAGE_RETURNS: MovingAverageReturn,
+    logic.ComposerIndicatorFunction.STANDARD_DEVIATION_PRICE: StandardDeviationPrice,
+    logic.ComposerIndicatorFunction.STANDARD_DEVIATION_RETURNS: StandardDeviationReturn,
+    logic.ComposerIndicatorFunction.MAX_DRAWDOWN: MaxDrawdown,
+    logic.ComposerIndicatorFunction.EMA_PRICE: ExponentialMovingAverage,
+    logic.ComposerIndicatorFunction.RSI: RelativeStrengthIndex,
+}
+
+
+def get_key(indicator: dict) -> typing.Tuple[str, str, int]:
+    return (indicator["val"], indicator["fn"], indicator["window-days"])
+
+
+def format_day(day) -> str:
+    return pd.Timestamp(day).date().isoformat()
+
+
+class OnlineIndicators:
+    """
+    Online indicator states of a set of symphonies.
+    Also has latest_allocation.IndicatorValues' get_last_day/get, to evaluate symphonies on the last day fed.
+    """
+
+    def __init__(self):
+        self.states: typing.Dict[typing.Tuple[str, str, int], OnlineIndicator] = {}
+
+    def add_indicators(self, indicators: typing.Iterable[dict]) -> typing.List[typing.Tuple[str, str, int]]:
+        """
+        Keys of the indicators that are new (they need the ticker's whole history, see feed).
+        """
+        new_keys = []
+        for indicator in indicators:
+            key = get_key(indicator)
+            if key in self.states:
+                continue
+            if indicator["fn"] not in INDICATOR_CLASSES:
+                raise NotImplementedError(
+                    "Have not implemented indicator " + indicator["fn"])
+            self.states[key] = INDICATOR_CLASSES[indicator["fn"]](
+                window=indicator["window-days"])
+            new_keys.append(key)
+        return new_keys
+
+    def get_tickers(self) -> typing.Set[str]:
+        return {ticker for ticker, _fn, _window in self.states}
+
+    def get_stale_tickers(self, closes: pd.DataFrame) -> typing.Set[str]:
+        """
+        Tickers whose closes start after a state's last day (or that have new states): feeding them needs more history.
+        """
+        stale = set()
+        for (ticker, _fn, _window), state in self.states.items():
+            series = closes[ticker].dropna() if ticker in closes else closes.iloc[:0, 0]
+            if state.last_day is None:
+                if not series.empty:
+                    stale.add(ticker)
+            elif not series.empty and format_day(series.index[0]) > state.last_day:
+                stale.add(ticker)
+        return stale
+
+    def feed(self, closes: pd.DataFrame, checkpoint_path: typing.Optional[str] = None) -> int:
+        """
+        Updates every state with the closes after its last day, day by day. Returns the number of days fed.
+        Saves a checkpoint after each day if checkpoint_path is given.
+        """
+        states_by_ticker = collections.defaultdict(list)
+        for (ticker, _fn, _window), state in self.states.items():
+            if ticker in closes:
+                states_by_ticker[ticker].append(state)
+        if not states_by_ticker:
+            return 0
+        last_days = [state.last_day or "" for states in states_by_ticker.values()
+                     for state in states]
+        closes = closes[list(states_by_ticker)]
+        closes = closes[closes.index >= pd.Timestamp(min(last_days) or "1900-01-01")]
+
+        days_fed = 0
+        for day, row in zip(closes.index, closes.to_numpy()):
+            day_string = format_day(day)
+            fed = False
+            for ticker, close in zip(closes.columns, row):
+                if math.isnan(close):
+                    continue
+                for state in states_by_ticker[ticker]:
+                    if state.last_day is None or state.last_day < day_string:
+                        state.update(float(close))
+                        state.commit_day(day_string)
+                        fed = True
+            if fed:
+                days_fed += 1
+                if checkpoint_path:
+                    self.save(checkpoint_path)
+        return days_fed
+
+    #
+    # latest_allocation.IndicatorValues interface
+    #
+    def get_last_day(self, tickers: typing.Iterable[str]) -> typing.Optional[pd.Timestamp]:
+        """
+        Last recent day every ticker's states have a value for (any state's last day for a symphony without indicators),
+        None if there is none: the symphony is reported as failed before anything is evaluated.
+        """
+        tickers = set(tickers)
+        if not tickers:
+            last_days = [state.last_day for state in self.states.values()
+                         if state.last_day is not None]
+            return pd.Timestamp(max(last_days)) if last_days else None
+        days = None
+        for (ticker, _fn, _window), state in self.states.items():
+            if ticker in tickers:
+                days = set(state.recent_days) if days is None else days & set(
+                    state.recent_days)
+        if not days:
+            return None
+        return pd.Timestamp(max(days))
+
+    def get(self, indicator: dict, day: pd.Timestamp) -> float:
+        state = self.states[get_key(indicator)]
+        value = state.get_value_as_of(format_day(day))
+        if value is None:
+            raise ValueError(
+                f"{indicator['val']} {indicator['fn']} {indicator['window-days']} has no value as of {format_day(day)} (last day {state.last_day})")
+        return value
+
+    #
+    # Checkpoints
+    #
+    def to_dict(self) -> dict:
+        return {
+            "version": CHECKPOINT_VERSION,
+            "states": [{"ticker": ticker, "fn": fn, "window-days": window, "state": state.to_dict()} for (ticker, fn, window), state in self.states.items()],
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "OnlineIndicators":
+        online_indicators = cls()
+        if data.get("version") != CHECKPOINT_VERSION:
+            return online_indicators
+        for entry in data["states"]:
+            online_indicators.states[(entry["ticker"], entry["fn"], entry["window-days"])] = INDICATOR_CLASSES[entry["fn"]].from_dict(
+                entry["state"])
+        return online_indicators
+
+    def save(self, path: str):
+        # two runs may update the same checkpoint
+        with atomic_files.open_replacing(path) as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, path: str) -> "OnlineIndicators":
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+def update_checkpoint(root_nodes_by_id: typing.Mapping[str, dict], checkpoint_path: str, days: int = 21) -> OnlineIndicators:
+    """
+    Loads the checkpoint, feeds it the price rows after its last day (only the last `days` rows of each price file are read),
+    and saves it after each day. New indicators, and tickers the checkpoint fell further behind on, are fed their whole history once.
+    """
+    from . import get_backtest_data, traversers
+
+    online_indicators = OnlineIndicators.load(checkpoint_path)
+    for root_node in root_nodes_by_id.values():
+        online_indicators.add_indicators(
+            traversers.collect_indicators(root_node))
+
+    closes = get_backtest_data.get_price_tails(
+        {ticker: days for ticker in online_indicators.get_tickers()})
+    stale_tickers = online_indicators.get_stale_tickers(closes)
+    if stale_tickers:
+        online_indicators.feed(
+            get_backtest_data.get_backtest_data(stale_tickers))
+    online_indicators.feed(closes, checkpoint_path=checkpoint_path)
+    online_indicators.save(checkpoint_path)
+    return online_indicators
+
+
+def main():
+    import time
+
+    import numpy as np
+
+    from . import synthetic, transpilers
+
+    tickers = synthetic.generate_tickers(3)
+    closes = synthetic.generate_closes(tickers)
+    indicators = [{"val": ticker, "fn": fn, "window-days": window}
+                  for ticker in tickers for fn in INDICATOR_CLASSES for window in (2, 10, 200)]
+
+    online_indicators = OnlineIndicators()
+    online_indicators.add_indicators(indicators)
+    start = time.perf_counter()
+    online_indicators.feed(closes.iloc[:-1])
+    # restored from a checkpoint, one more day
+    online_indicators = OnlineIndicators.from_dict(
+        json.loads(json.dumps(online_indicators.to_dict())))
+    online_indicators.feed(closes)
+    print(f"{len(indicators)} indicators x {len(closes)} days: {time.perf_counter() - start:.2f}s")
+
+    worst = 0.0
+    for indicator in indicators:
+        batch_value = transpilers.precompute_indicator(
+            closes[indicator["val"]], indicator["fn"], indicator["window-days"]).iloc[-1]
+        online_value = online_indicators.get(indicator, closes.index[-1])
+        assert np.isnan(batch_value) == np.isnan(online_value), indicator
+        if not np.isnan(batch_value):
+            worst = max(worst, abs(online_value - batch_value) /
+                        max(abs(batch_value), 1e-12))
+    print(f"max relative difference to precompute_indicator: {worst:.2e}")
@@ -0,0 +1,136 @@
+import collections
+import concurrent.futures
+import multiprocessing
+import traceback
+import typing
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+
+from . import instrumentation
+
+
+#
+# Process pool for populate_symphonies stages
+# - a task is (key, args), function(*args) runs in a worker process and returns whatever the stage merges (record updates)
+# - an exception only fails its own task (TaskResult.error), the rest of the stage goes on
+# - results come back in task order whatever order workers finish in, so merges (and catalog commits) are deterministic
+# - state (like the shared closes frame) is handed to every worker once, at fork, instead of pickled per task
+# - workers=1 runs in this process, same code path as before there was a pool
+# - imap_tasks streams: tasks are read lazily with bounded read-ahead, results optionally as they finish (parser.py -b)
+#
+_worker_state: dict = {}
+
+
+@dataclass
+class TaskResult:
+    key: str
+    value: typing.Any = None
+    error: typing.Optional[str] = None
+    detail: str = ""
+    # spans and counters recorded in the worker, see instrumentation.take_records
+    records: typing.Optional[dict] = None
+
+
+def get_worker_state() -> dict:
+    return _worker_state
+
+
+def _initialize_worker(state: dict, instrumentation_origin: typing.Optional[float]):
+    _worker_state.clear()
+    _worker_state.update(state)
+    if instrumentation_origin is not None:
+        instrumentation.start_worker(instrumentation_origin)
+
+
+def _run_task(function: typing.Callable, key: str, args: tuple) -> TaskResult:
+    try:
+        result = TaskResult(key=key, value=function(*args))
+    except Exception as e:
+        result = TaskResult(key=key, error=f"{type(e).__name__}: {e}",
+                            detail=traceback.format_exc())
+    return result
+
+
+def _run_worker_task(function: typing.Callable, key: str, args: tuple) -> TaskResult:
+    result = _run_task(function, key, args)
+    result.records = instrumentation.take_records()
+    return result
+
+
+def run_tasks(function: typing.Callable, tasks: typing.Iterable[typing.Tuple[str, tuple]], workers: int = 1, state: typing.Optional[dict] = None) -> typing.Iterator[TaskResult]:
+    """
+    Yields a TaskResult per task, in task order. function must be importable (top-level) for workers > 1.
+    """
+    return imap_tasks(function, tasks, workers=workers, state=state)
+
+
+def _get_result(key: str, future: concurrent.futures.Future) -> TaskResult:
+    try:
+        result = future.result()
+    except BrokenProcessPool as e:
+        # a worker died (out of memory, segfault), every task still in the pool fails with it
+        result = TaskResult(key=key, error=f"worker process died: {e}")
+    instrumentation.merge_records(result.records)
+    return result
+
+
+def imap_tasks(function: typing.Callable, tasks: typing.Iterable[typing.Tuple[str, tuple]], workers: int = 1, state: typing.Optional[dict] = None, ordered: bool = True, max_in_flight: typing.Optional[int] = None) -> typing.Iterator[TaskResult]:
+    """
+    run_tasks for lazy (or endless) task streams: tasks are only read max_in_flight ahead (default: all of them).
+    ordered=False yields results as they finish instead.
+    """
+    state = state or {}
+    if workers <= 1:
+        _worker_state.clear()
+        _worker_state.update(state)
+        try:
+            for key, args in tasks:
+                yield _run_task(function, key, args)
+        finally:
+            _worker_state.clear()
+        return
+
+    tasks = iter(tasks)
+    in_flight: typing.Deque[typing.Tuple[str, concurrent.futures.Future]] = collections.deque()
+    exhausted = False
+    # fork: workers inherit state (and loaded modules) without pickling it
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_initialize_worker,
+            initargs=(state, instrumentation.get_origin())) as executor:
+        while True:
+            while not exhausted and (max_in_flight is None or len(in_flight) < max_in_flight):
+                task = next(tasks, None)
+                if task is None:
+                    exhausted = True
+                    break
+                key, args = task
+                in_flight.append((key, executor.submit(
+                    _run_worker_task, function, key, args)))
+            if not in_flight:
+                return
+
+            if ordered:
+                key, future = in_flight.popleft()
+            else:
+                done, _not_done = concurrent.futures.wait(
+                    [future for _key, future in in_flight], return_when=concurrent.futures.FIRST_COMPLETED)
+                position = next(position for position, (_key, future) in enumerate(
+                    in_flight) if future in done)
+                key, future = in_flight[position]
+                del in_flight[position]
+            yield _get_result(key, future)
+
+
+def _square(value: int) -> int:
+    if value == 3:
+        raise ValueError("three")
+    return value * value
+
+
+def main():
+    for result in run_tasks(_square, [(str(value), (value,)) for value in range(6)], workers=3):
+        print(result.key, result.value, result.error)
+    for result in imap_tasks(_square, ((str(value), (value,)) for value in range(6)), workers=3, ordered=False, max_in_flight=2):
+        print(result.key, result.value, result.error)
@@ -0,0 +1,147 @@
+import json
+import os
+import typing
+
+import numpy as np
+import pandas as pd
+
+from . import get_backtest_data, parallel, symphony_backtest, symphony_object, transpilers, traversers
+from .branch_tracker import BranchTracker
+
+
+#
+# Local engine vs Composer parity checks
+# - Composer responses come from symphony_backtest's on-disk cache, so this runs offline
+#   once responses are cached (or recorded responses are copied into the cache)
+#
+
+# Composer allocations are rounded to 4 decimals
+DEFAULT_TOLERANCE = 0.001
+
+
+def narrow_branches_to_tickers(root_node: dict, branch_ids: typing.List[str], tickers: typing.Set[str]) -> typing.List[str]:
+    """
+    Keeps the active branches which could have allocated toward the divergent tickers.
+    """
+    candidates = []
+    for branch_id in branch_ids:
+        node = traversers.find_node_by_id(root_node, branch_id)
+        if node and traversers.collect_allocateable_assets(node) & tickers:
+            candidates.append(branch_id)
+    # the root "branch" can reach every ticker, only blame it if nothing closer can
+    closer_candidates = [c for c in candidates if c != root_node[":id"]]
+    return closer_candidates or candidates or branch_ids
+
+
+def compare_allocations(local_allocations: pd.DataFrame, composer_allocations: pd.DataFrame, branch_tracker: BranchTracker, tolerance: float = DEFAULT_TOLERANCE, root_node: typing.Optional[dict] = None) -> dict:
+    dates = local_allocations.index.intersection(composer_allocations.index)
+    tickers = sorted(set(local_allocations.columns) |
+                     set(composer_allocations.columns))
+
+    local_values = local_allocations.reindex(
+        index=dates, columns=tickers).fillna(0.0).to_numpy(dtype=np.float64)
+    composer_values = composer_allocations.reindex(
+        index=dates, columns=tickers).fillna(0.0).to_numpy(dtype=np.float64)
+    differences = np.abs(local_values - composer_values)
+    divergent_cells = differences > tolerance
+    divergent_days = divergent_cells.any(axis=1)
+
+    result = {
+        "days_compared": len(dates),
+        "divergent_days": int(divergent_days.sum()),
+        "max_abs_difference": float(differences.max()) if differences.size else 0.0,
+        "first_divergent_date": None,
+        "first_divergent_branches": [],
+        "first_divergent_tickers": [],
+    }
+    if not divergent_days.any():
+        return result
+
+    first_divergent_row = int(np.argmax(divergent_days))
+    first_divergent_date = dates[first_divergent_row]
+    active_branch_ids = branch_tracker.get_active_branch_ids(
+        first_divergent_date)
+    if root_node:
+        active_branch_ids = narrow_branches_to_tickers(root_node, active_branch_ids, set(
+            tickers[i] for i in np.flatnonzero(divergent_cells[first_divergent_row])))
+    result.update({
+        "first_divergent_date": first_divergent_date.date().isoformat(),
+        "first_divergent_branches": active_branch_ids,
+        "first_divergent_tickers": [
+            {
+                "ticker": tickers[i],
+                "local": float(local_values[first_divergent_row, i]),
+                "composer": float(composer_values[first_divergent_row, i]),
+            } for i in np.flatnonzero(divergent_cells[first_divergent_row])
+        ],
+    })
+    return result
+
+
+def check_symphony_parity(symphony_id: str, tolerance: float = DEFAULT_TOLERANCE, offline: bool = True) -> dict:
+    result: typing.Dict[str, typing.Any] = {"symphony_id": symphony_id}
+    try:
+        symphony = json.load(
+            open(f'outputs/symphonies/{symphony_id}/symphony.json'))
+        root_node = symphony_object.extract_root_node_from_symphony_response(
+            symphony)
+        closes = get_backtest_data.get_backtest_data(
+            traversers.collect_referenced_assets(root_node))
+        local_allocations, branch_tracker = transpilers.VectorBTTranspiler.execute(
+            root_node, closes)
+
+        # any cached response of this version: refreshed prices move the local window, not what Composer computed
+        # (only days both have are compared), a backtest over the local window is only fetched when none is cached
+        version = symphony_object.extract_version_from_symphony_response(
+            symphony)
+        backtest_path = symphony_backtest.find_cached_composer_backtest(
+            symphony_id, version=version) or symphony_backtest.fetch_composer_backtest(
+            symphony_id,
+            local_allocations.index.min().date(),
+            local_allocations.index.max().date(),
+            version=version,
+            offline=offline,
+        )
+        with symphony_backtest.open_composer_backtest_buffer(backtest_path) as buffer:
+            composer_allocations = symphony_backtest.decode_allocations_from_composer_backtest(
+                buffer)
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+        return result
+
+    result.update(compare_allocations(
+        local_allocations, composer_allocations, branch_tracker, tolerance=tolerance, root_node=root_node))
+    return result
+
+
+def check_symphony_parity_task(symphony_id: str, tolerance: float, offline: bool) -> dict:
+    # top-level so worker processes can unpickle it
+    return check_symphony_parity(symphony_id, tolerance=tolerance, offline=offline)
+
+
+def run_parity_checks(symphony_ids: typing.Iterable[str], tolerance: float = DEFAULT_TOLERANCE, offline: bool = True, workers: typing.Optional[int] = None) -> typing.Iterator[dict]:
+    """
+    Checks every symphony on worker processes (parallel.imap_tasks, default: one per cpu), yields results in the same order
+    as symphony_ids as they come in. A worker dying (out of memory, segfault) fails the symphonies still in the pool with an error result,
+    the results already in are kept.
+    """
+    tasks = ((symphony_id, (symphony_id, tolerance, offline))
+             for symphony_id in symphony_ids)
+    for task_result in parallel.imap_tasks(check_symphony_parity_task, tasks, workers=workers or os.cpu_count() or 1):
+        if task_result.error:
+            yield {"symphony_id": task_result.key, "error": task_result.error}
+        else:
+            yield task_result.value
+
+
+def describe_parity_result(result: dict) -> str:
+    if "error" in result:
+        return f"{result['symphony_id']}: {result['error']}"
+    if result["first_divergent_date"]:
+        return f"{result['symphony_id']}: {result['divergent_days']}/{result['days_compared']} days diverge, first on {result['first_divergent_date']} in {result['first_divergent_branches']}"
+    return f"{result['symphony_id']}: matches ({result['days_compared']} days)"
+
+
+def main():
+    for result in run_parity_checks(symphony_object.get_cached_symphony_ids()):
+        print(describe_parity_result(result))
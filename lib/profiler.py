@@ -0,0 +1,195 @@
+import collections
+import io
+import json
+import time
+import typing
+
+import pandas as pd
+
+from . import human, logic, transpilers, traversers, vectorbt
+
+
+#
+# Per-node profiler for VectorBTTranspiler.execute
+# - the generated build_allocations_matrix calls back into the profiler (only when profiling, see vectorbt.print_python_logic)
+# - :if, :filter and :wt-inverse-vol are timed (inclusive of their children)
+# - :if-child hits, asset allocations and indicator precomputes are counted
+# - other nodes (:root, :wt-cash-*) are rolled up from their children
+#
+
+
+class SymphonyProfiler:
+    def __init__(self):
+        self.days = 0
+        self.visits: typing.Counter[str] = collections.Counter()
+        self.seconds: typing.DefaultDict[str, float] = collections.defaultdict(
+            float)
+        # keyed by node id, or "<node id>/<ticker>" for the children of :filter and :wt-inverse-vol
+        self.allocation_sums: typing.DefaultDict[str, float] = collections.defaultdict(
+            float)
+        self.indicator_seconds: typing.DefaultDict[str, float] = collections.defaultdict(
+            float)
+        self.indicator_calls: typing.Counter[str] = collections.Counter()
+        self.starts: typing.List[float] = []
+
+    #
+    # Called by generated code
+    #
+    def precompute_indicator(self, key: str, close_series: pd.Series, indicator: str, window_days: int):
+        start = time.perf_counter()
+        try:
+            return transpilers.precompute_indicator(close_series, indicator, window_days)
+        finally:
+            self.indicator_seconds[key] += time.perf_counter() - start
+            self.indicator_calls[key] += 1
+
+    def day(self):
+        self.days += 1
+
+    def enter(self, node_id: str):
+        self.visits[node_id] += 1
+        self.starts.append(time.perf_counter())
+
+    def exit(self, node_id: str):
+        self.seconds[node_id] += time.perf_counter() - self.starts.pop()
+
+    def hit(self, node_id: str):
+        self.visits[node_id] += 1
+
+    def allocate(self, node_id: str, weight: float, ticker: typing.Optional[str] = None):
+        if ticker is None:
+            self.visits[node_id] += 1
+        else:
+            self.allocation_sums[f"{node_id}/{ticker}"] += weight
+            self.visits[f"{node_id}/{ticker}"] += 1
+        self.allocation_sums[node_id] += weight
+
+    #
+    # Reporting
+    #
+    def summarize(self, root_node: dict) -> typing.Dict[str, dict]:
+        """
+        Stats per node id.
+        - days_active: days the node was evaluated (for assets, days it got an allocation)
+        - seconds: evaluation time, including children
+        - indicator_seconds: precompute time of indicators this node references (shared indicators are split evenly)
+        - allocation_contribution: average daily weight allocated through this node
+        """
+        referencing_nodes_by_indicator_key = collect_referencing_nodes_by_indicator_key(
+            root_node)
+        indicator_seconds_by_node_id = collections.defaultdict(float)
+        for key, node_ids in referencing_nodes_by_indicator_key.items():
+            for node_id in node_ids:
+                indicator_seconds_by_node_id[node_id] += self.indicator_seconds.get(
+                    key, 0.0) / len(node_ids)
+
+        stats_by_id = {}
+
+        def visit(node, parent_node=None) -> dict:
+            children_stats = [visit(child, node)
+                              for child in logic.get_node_children(node)]
+
+            key = node[":id"]
+            if parent_node and logic.is_asset_node(node) and (logic.is_filter_node(parent_node) or logic.is_weight_inverse_volatility_node(parent_node)):
+                key = f"{parent_node[':id']}/{logic.get_ticker_of_asset_node(node)}"
+
+            if key in self.visits or logic.is_asset_node(node) or logic.is_if_child_node(node):
+                days_active = self.visits.get(key, 0)
+            else:
+                days_active = max([s["days_active"]
+                                  for s in children_stats], default=0)
+            seconds = self.seconds[key] if key in self.seconds else sum(
+                s["seconds"] for s in children_stats)
+            allocation_sum = self.allocation_sums[key] if key in self.allocation_sums or logic.is_asset_node(
+                node) else sum(s["allocation_sum"] for s in children_stats)
+
+            stats = {
+                "id": node[":id"],
+                "step": node[":step"],
+                "days_active": days_active,
+                "days_active_ratio": days_active / self.days if self.days else 0.0,
+                "seconds": seconds,
+                "indicator_seconds": indicator_seconds_by_node_id.get(node[":id"], 0.0),
+                "allocation_sum": allocation_sum,
+                "allocation_contribution": allocation_sum / self.days if self.days else 0.0,
+            }
+            stats_by_id[node[":id"]] = stats
+            return stats
+
+        visit(root_node)
+        return stats_by_id
+
+    def to_json(self, root_node: dict) -> dict:
+        stats_by_id = self.summarize(root_node)
+        return {
+            "days": self.days,
+            "evaluation_seconds": stats_by_id[root_node[":id"]]["seconds"],
+            "indicator_seconds": sum(self.indicator_seconds.values()),
+            "nodes": stats_by_id,
+            "indicators": {
+                key: {"seconds": seconds, "calls": self.indicator_calls[key]}
+                for key, seconds in sorted(self.indicator_seconds.items(), key=lambda item: item[1], reverse=True)
+            },
+        }
+
+    def format_tree(self, root_node: dict) -> str:
+        stats_by_id = self.summarize(root_node)
+
+        def annotate(node) -> str:
+            stats = stats_by_id[node[":id"]]
+            s = f"  [days {stats['days_active']} ({stats['days_active_ratio']:.0%})"
+            if not logic.is_asset_node(node):
+                s += f" | {stats['seconds'] * 1000:.1f}ms"
+            if stats["indicator_seconds"]:
+                s += f" | ind {stats['indicator_seconds'] * 1000:.1f}ms"
+            s += f" | alloc {stats['allocation_contribution']:.1%}]"
+            return s
+
+        output = io.StringIO()
+        print(
+            f"{self.days} days, indicators {sum(self.indicator_seconds.values()) * 1000:.1f}ms", file=output)
+        human.print_children(root_node, file=output, annotate=annotate)
+        return output.getvalue()
+
+
+def collect_referencing_nodes_by_indicator_key(node) -> typing.Dict[str, typing.List[str]]:
+    """
+    Which node ids reference each indicator (by vectorbt indicator key)
+    """
+    indicators = []
+    if logic.is_conditional_node(node):
+        indicators.append(traversers.extract_lhs_indicator(node))
+        rhs_indicator = traversers.extract_rhs_indicator(node)
+        if rhs_indicator:
+            indicators.append(rhs_indicator)
+    if logic.is_filter_node(node):
+        indicators.extend(traversers.extract_filter_indicators(node))
+    if logic.is_weight_inverse_volatility_node(node):
+        indicators.extend(
+            traversers.extract_inverse_volatility_indicators(node))
+
+    node_ids_by_key = collections.defaultdict(list)
+    for indicator in indicators:
+        node_ids_by_key[vectorbt.extract_indicator_key_from_indicator(
+            indicator)].append(node[":id"])
+    for child in logic.get_node_children(node):
+        for key, node_ids in collect_referencing_nodes_by_indicator_key(child).items():
+            node_ids_by_key[key].extend(node_ids)
+    return node_ids_by_key
+
+
+def profile_symphony(root_node: dict, closes: pd.DataFrame) -> SymphonyProfiler:
+    profiler = SymphonyProfiler()
+    transpilers.VectorBTTranspiler.execute(root_node, closes, profiler=profiler)
+    return profiler
+
+
+def main():
+    from . import synthetic
+
+    tickers = synthetic.generate_tickers(10)
+    root_node = synthetic.generate_symphony(depth=3, breadth=2, tickers=tickers)
+    profiler = profile_symphony(
+        root_node, synthetic.generate_closes(tickers))
+    print(profiler.format_tree(root_node))
+    print(json.dumps(profiler.to_json(root_node), indent=2)[:1000])
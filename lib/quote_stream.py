@@ -0,0 +1,381 @@
+import collections
+import csv
+import sys
+import typing
+from dataclasses import dataclass
+
+import pandas as pd
+
+from . import latest_allocation, logic, online_indicators, traversers
+
+
+#
+# Intraday quote stream: would-be allocations as prices move, before the close
+# - a ticker's latest quote is today's provisional close: its online indicator states are peeked with it, never committed
+#   (checkpoints only ever take real closes, see online_indicators.update_checkpoint)
+# - until a ticker quotes, its provisional close is its last close
+# - a quote recomputes only that ticker's indicators, and the distinct conditions (traversers.get_condition_key)
+#   and filters (get_filter_key) on them, then re-evaluates only symphonies referencing the ticker (collect_referenced_assets)
+#   where one of those conditions flipped or filters selected other tickers,
+#   or that weight by its volatility (:wt-inverse-vol) in an active branch, since those weights move with every quote
+# - a re-evaluated symphony keeps every node's allocation that does not depend on what changed (IncrementalAllocation),
+#   only the :if nodes above a flipped condition, the changed filters and volatility weights, and their ancestors are interpreted again
+#
+@dataclass
+class Quote:
+    time: str
+    ticker: str
+    price: float
+
+
+def read_replay(path: str) -> typing.Iterator[Quote]:
+    """
+    Quotes of a replay csv (time,ticker,price), - for stdin (a live feed piped in).
+    """
+    replay_file = sys.stdin if path == "-" else open(path, newline="")
+    try:
+        for row in csv.DictReader(replay_file):
+            yield Quote(time=row["time"], ticker=row["ticker"], price=float(row["price"]))
+    finally:
+        if replay_file is not sys.stdin:
+            replay_file.close()
+
+
+def get_filter_key(node: dict) -> str:
+    """
+    Equal for :filter nodes that always select the same tickers
+    """
+    tickers = sorted(logic.get_ticker_of_asset_node(child)
+                     for child in logic.get_node_children(node))
+    return f"{node[':select-fn']} {node[':select-n']} by {node[':sort-by-fn']} {node[':sort-by-window-days']} of {' '.join(tickers)}"
+
+
+def collect_inverse_volatility_branch_ids(node: dict, branch_id: str, branch_ids_by_ticker: typing.Dict[str, typing.Set[str]]):
+    """
+    By ticker, the branch ids (see LatestAllocation.active_branch_ids) of the :wt-inverse-vol nodes weighting by it
+    """
+    if logic.is_if_child_node(node):
+        branch_id = node[":id"]
+    if logic.is_weight_inverse_volatility_node(node):
+        for indicator in traversers.extract_inverse_volatility_indicators(node):
+            branch_ids_by_ticker.setdefault(
+                indicator["val"], set()).add(branch_id)
+    for child_node in logic.get_node_children(node):
+        collect_inverse_volatility_branch_ids(
+            child_node, branch_id, branch_ids_by_ticker)
+
+
+class ProvisionalValues:
+    """
+    latest_allocation.IndicatorValues interface over the indicators' provisional values
+    """
+
+    def __init__(self, day: pd.Timestamp):
+        self.day = day
+        self.values: typing.Dict[typing.Tuple[str, str, int], float] = {}
+
+    def get_last_day(self, tickers: typing.Iterable[str]) -> pd.Timestamp:
+        return self.day
+
+    def get(self, indicator: dict, day: pd.Timestamp) -> float:
+        return self.values[online_indicators.get_key(indicator)]
+
+
+class IncrementalAllocation:
+    """
+    latest_allocation.evaluate_allocation of one symphony, keeping each node's (weights, activated branches) between evaluations.
+    invalidate drops the nodes depending on changed conditions, filters or volatilities (and their ancestors), evaluate
+    interprets only those again, in the same order as evaluate_node so the weights are the same floats.
+    condition_values and filter_selections are by traversers.get_condition_key / get_filter_key, kept up to date by the caller.
+    """
+
+    def __init__(self, root_node: dict, provisional_values: ProvisionalValues, condition_values: typing.Mapping[str, bool], filter_selections: typing.Mapping[str, typing.List[str]]):
+        self.root_node = root_node
+        self.provisional_values = provisional_values
+        self.condition_values = condition_values
+        self.filter_selections = filter_selections
+        # by id(node)
+        self.branch_states: typing.Dict[int, logic.NodeBranchState] = {}
+        self.condition_keys: typing.Dict[int, str] = {}
+        self.filter_keys: typing.Dict[int, str] = {}
+        # by ("condition", condition key), ("filter", filter key) or ("volatility", ticker), the ids of the nodes whose allocation depends on it
+        self.node_ids_by_dependency: typing.Dict[tuple, typing.Set[int]] = collections.defaultdict(set)
+        self.entries_by_node_id: typing.Dict[int, tuple] = {}
+        self.prepare(root_node, logic.build_node_branch_state_from_root_node(
+            root_node), [])
+
+    def prepare(self, node: dict, parent_node_branch_state: logic.NodeBranchState, ancestor_ids: typing.List[int]):
+        branch_state = logic.advance_branch_state(parent_node_branch_state, node)
+        self.branch_states[id(node)] = branch_state
+        node_ids = ancestor_ids + [id(node)]
+        if logic.is_if_child_node(node) and logic.is_conditional_node(node):
+            self.condition_keys[id(node)] = traversers.get_condition_key(node)
+            # the :if node choosing between its children depends on it, not the :if-child's own subtree
+            self.node_ids_by_dependency[(
+                "condition", self.condition_keys[id(node)])].update(ancestor_ids)
+        if logic.is_filter_node(node):
+            self.filter_keys[id(node)] = get_filter_key(node)
+            self.node_ids_by_dependency[(
+                "filter", self.filter_keys[id(node)])].update(node_ids)
+        if logic.is_weight_inverse_volatility_node(node):
+            for indicator in traversers.extract_inverse_volatility_indicators(node):
+                self.node_ids_by_dependency[(
+                    "volatility", indicator["val"])].update(node_ids)
+        for child_node in logic.get_node_children(node):
+            self.prepare(child_node, branch_state, node_ids)
+
+    def invalidate(self, dependencies: typing.Iterable[tuple]):
+        for dependency in dependencies:
+            for node_id in self.node_ids_by_dependency.get(dependency, ()):
+                self.entries_by_node_id.pop(node_id, None)
+
+    def get_entries(self, node: dict) -> tuple:
+        entries = self.entries_by_node_id.get(id(node))
+        if entries is None:
+            entries = self.entries_by_node_id[id(node)] = self.interpret(node)
+        return entries
+
+    def get_branch(self, node: dict) -> typing.Tuple[str, typing.List[str]]:
+        # (branch id, branch path) node activates, like evaluate_node's activate_branch
+        branch_path_ids = self.branch_states[id(node)].branch_path_ids
+        return branch_path_ids[-1], branch_path_ids[1:]
+
+    def interpret(self, node: dict) -> typing.Tuple[typing.List[typing.Tuple[str, float]], typing.List[typing.Tuple[str, typing.List[str]]]]:
+        """
+        latest_allocation.evaluate_node as ([(ticker, weight)], [(branch id, branch path)]) in the order it allocates.
+        """
+        if logic.is_if_node(node):
+            for child_node in logic.get_node_children(node):
+                if not logic.is_conditional_node(child_node) or self.condition_values[self.condition_keys[id(child_node)]]:
+                    return self.get_entries(child_node)
+            return [], []
+        if logic.is_asset_node(node):
+            return [(logic.get_ticker_of_asset_node(node), self.branch_states[id(node)].weight)], [self.get_branch(node)]
+        if logic.is_filter_node(node):
+            weight = self.branch_states[id(
+                logic.get_node_children(node)[0])].weight
+            return [(ticker, weight) for ticker in self.filter_selections[self.filter_keys[id(node)]]], [self.get_branch(node)]
+        if logic.is_weight_inverse_volatility_node(node):
+            entries = [(1 / self.provisional_values.get(indicator, self.provisional_values.day), indicator["val"])
+                       for indicator in traversers.extract_inverse_volatility_indicators(node)]
+            overall_inverse_volatility = sum(entry[0] for entry in entries)
+            weight = self.branch_states[id(
+                logic.get_node_children(node)[0])].weight
+            return [(ticker, weight * (inverse_volatility / overall_inverse_volatility)) for inverse_volatility, ticker in entries], [self.get_branch(node)]
+
+        weights, branches = [], []
+        for child_node in logic.get_node_children(node):
+            child_weights, child_branches = self.get_entries(child_node)
+            weights.extend(child_weights)
+            branches.extend(child_branches)
+        return weights, branches
+
+    def evaluate(self) -> latest_allocation.LatestAllocation:
+        weights, branches = self.get_entries(self.root_node)
+        allocation = latest_allocation.LatestAllocation(
+            day=self.provisional_values.day, weights={}, active_branch_ids=[])
+        for branch_id, branch_path in branches:
+            if branch_id not in allocation.branch_paths:
+                allocation.active_branch_ids.append(branch_id)
+                allocation.branch_paths[branch_id] = branch_path
+        for ticker, weight in weights:
+            allocation.weights[ticker] = allocation.weights.get(
+                ticker, 0.0) + weight
+        allocation.active_branch_ids.sort()
+        return allocation
+
+
+class QuoteStream:
+    def __init__(self, root_nodes_by_id: typing.Mapping[str, dict], indicators: online_indicators.OnlineIndicators, last_closes: typing.Mapping[str, float], day):
+        """
+        indicators must have every symphony's indicators, fed up to (not including) day.
+        Symphonies with indicators on a ticker whose states already have day's close (BTC-USD quotes every day, its price file can
+        include today) are left out, with the reason in unsupported: quotes would be a second close for it.
+        """
+        self.provisional_values = ProvisionalValues(
+            pd.Timestamp(day).normalize())
+        day_string = online_indicators.format_day(day)
+        closed_tickers = {ticker for (ticker, _fn, _window), state in indicators.states.items()
+                          if state.last_day is not None and state.last_day >= day_string}
+        self.unsupported: typing.Dict[str, str] = {}
+        self.root_nodes_by_id = {}
+        for symphony_id, root_node in root_nodes_by_id.items():
+            tickers = sorted(closed_tickers & {indicator["val"]
+                             for indicator in traversers.collect_indicators(root_node)})
+            if tickers:
+                self.unsupported[symphony_id] = f"{', '.join(tickers)} already closed on {day_string}"
+            else:
+                self.root_nodes_by_id[symphony_id] = root_node
+        self.indicators = indicators
+
+        self.keys_by_ticker = collections.defaultdict(list)
+        for key in indicators.states:
+            if key[0] not in closed_tickers:
+                self.keys_by_ticker[key[0]].append(key)
+
+        # a representative :if-child of each distinct condition, and its current value
+        self.condition_nodes: typing.Dict[str, dict] = {}
+        self.condition_values: typing.Dict[str, bool] = {}
+        self.condition_keys_by_ticker = collections.defaultdict(set)
+        self.symphony_ids_by_condition_key = collections.defaultdict(set)
+        # same for filters, with the tickers they select
+        self.filter_nodes: typing.Dict[str, dict] = {}
+        self.filter_selections: typing.Dict[str, typing.List[str]] = {}
+        self.filter_keys_by_ticker = collections.defaultdict(set)
+        self.symphony_ids_by_filter_key = collections.defaultdict(set)
+        # by ticker, symphony id: branch ids weighting by its volatility
+        self.weighting_branch_ids_by_ticker = collections.defaultdict(dict)
+        self.symphony_ids_by_ticker = collections.defaultdict(set)
+        for symphony_id, root_node in self.root_nodes_by_id.items():
+            for ticker in traversers.collect_referenced_assets(root_node):
+                self.symphony_ids_by_ticker[ticker].add(symphony_id)
+            for node in traversers.collect_nodes_of_type(":if-child", root_node):
+                if not logic.is_conditional_node(node):
+                    continue
+                condition_key = traversers.get_condition_key(node)
+                self.condition_nodes.setdefault(condition_key, node)
+                self.symphony_ids_by_condition_key[condition_key].add(
+                    symphony_id)
+                for indicator in [traversers.extract_lhs_indicator(node), traversers.extract_rhs_indicator(node)]:
+                    if indicator:
+                        self.condition_keys_by_ticker[indicator["val"]].add(
+                            condition_key)
+            for node in traversers.collect_nodes_of_type(":filter", root_node):
+                filter_key = get_filter_key(node)
+                self.filter_nodes.setdefault(filter_key, node)
+                self.symphony_ids_by_filter_key[filter_key].add(symphony_id)
+                for indicator in traversers.extract_filter_indicators(node):
+                    self.filter_keys_by_ticker[indicator["val"]].add(
+                        filter_key)
+            branch_ids_by_ticker = {}
+            collect_inverse_volatility_branch_ids(
+                root_node, root_node[":id"], branch_ids_by_ticker)
+            for ticker, branch_ids in branch_ids_by_ticker.items():
+                self.weighting_branch_ids_by_ticker[ticker][symphony_id] = branch_ids
+
+        # latest_allocation.evaluate_condition / select_filter_tickers operands, resolved once instead of on every quote
+        self.condition_operands = {}
+        for condition_key, node in self.condition_nodes.items():
+            rhs_indicator = traversers.extract_rhs_indicator(node)
+            self.condition_operands[condition_key] = (
+                online_indicators.get_key(
+                    traversers.extract_lhs_indicator(node)),
+                online_indicators.get_key(
+                    rhs_indicator) if rhs_indicator else None,
+                None if rhs_indicator else float(node[":rhs-val"]),
+                latest_allocation.COMPARISON_OPERATORS[node[":comparator"]])
+        self.filter_operands = {filter_key: (
+            [(online_indicators.get_key(indicator), indicator["val"])
+             for indicator in traversers.extract_filter_indicators(node)],
+            node[":select-fn"] == ":top",
+            int(node[":select-n"])) for filter_key, node in self.filter_nodes.items()}
+
+        for ticker, keys in self.keys_by_ticker.items():
+            for key in keys:
+                self.provisional_values.values[key] = indicators.states[key].peek(
+                    last_closes[ticker])
+        for condition_key in self.condition_nodes:
+            self.condition_values[condition_key] = self.evaluate_condition(
+                condition_key)
+        for filter_key in self.filter_nodes:
+            self.filter_selections[filter_key] = self.select_filter_tickers(
+                filter_key)
+        # symphonies re-evaluated by on_quote so far
+        self.evaluations = 0
+        self.incremental_allocations = {symphony_id: IncrementalAllocation(
+            root_node, self.provisional_values, self.condition_values, self.filter_selections) for symphony_id, root_node in self.root_nodes_by_id.items()}
+        self.allocations = {symphony_id: incremental_allocation.evaluate()
+                            for symphony_id, incremental_allocation in self.incremental_allocations.items()}
+
+    def evaluate_condition(self, condition_key: str) -> bool:
+        lhs_key, rhs_key, rhs_value, comparison_operator = self.condition_operands[condition_key]
+        values = self.provisional_values.values
+        return comparison_operator(values[lhs_key], values[rhs_key] if rhs_key else rhs_value)
+
+    def select_filter_tickers(self, filter_key: str) -> typing.List[str]:
+        entries, reverse, select_n = self.filter_operands[filter_key]
+        values = self.provisional_values.values
+        return [ticker for _sort_value, ticker in sorted(((values[key], ticker) for key, ticker in entries), reverse=reverse)[:select_n]]
+
+    def on_quote(self, ticker: str, price: float) -> typing.List[str]:
+        """
+        Ids of the symphonies whose would-be allocation (weights or active branches) changed with this quote.
+        """
+        for key in self.keys_by_ticker.get(ticker, []):
+            self.provisional_values.values[key] = self.indicators.states[key].peek(
+                price)
+
+        # volatility weights are dropped even where their branch is inactive, they are stale once it activates
+        weighting_branch_ids_by_symphony_id = self.weighting_branch_ids_by_ticker.get(ticker, {})
+        for symphony_id in weighting_branch_ids_by_symphony_id:
+            self.incremental_allocations[symphony_id].invalidate(
+                [("volatility", ticker)])
+        symphony_ids = {symphony_id for symphony_id, branch_ids in weighting_branch_ids_by_symphony_id.items()
+                        if not branch_ids.isdisjoint(self.allocations[symphony_id].active_branch_ids)}
+        changed_dependencies = []
+        for condition_key in self.condition_keys_by_ticker.get(ticker, ()):
+            value = self.evaluate_condition(condition_key)
+            if value != self.condition_values[condition_key]:
+                self.condition_values[condition_key] = value
+                changed_dependencies.append(("condition", condition_key))
+                symphony_ids |= self.symphony_ids_by_condition_key[condition_key]
+        for filter_key in self.filter_keys_by_ticker.get(ticker, ()):
+            selection = self.select_filter_tickers(filter_key)
+            if selection != self.filter_selections[filter_key]:
+                self.filter_selections[filter_key] = selection
+                changed_dependencies.append(("filter", filter_key))
+                symphony_ids |= self.symphony_ids_by_filter_key[filter_key]
+
+        self.evaluations += len(symphony_ids)
+        changed_symphony_ids = []
+        for symphony_id in sorted(symphony_ids):
+            incremental_allocation = self.incremental_allocations[symphony_id]
+            incremental_allocation.invalidate(changed_dependencies)
+            allocation = incremental_allocation.evaluate()
+            previous_allocation = self.allocations[symphony_id]
+            if allocation.weights != previous_allocation.weights or allocation.active_branch_ids != previous_allocation.active_branch_ids:
+                self.allocations[symphony_id] = allocation
+                changed_symphony_ids.append(symphony_id)
+        return changed_symphony_ids
+
+
+def main():
+    import random
+    import time
+
+    import numpy as np
+
+    from . import synthetic
+
+    tickers = synthetic.generate_tickers(60)
+    closes = synthetic.generate_closes(tickers)
+    root_nodes_by_id = {f"s{seed}": synthetic.generate_symphony(
+        depth=5, breadth=2, tickers=tickers, seed=seed) for seed in range(300)}
+
+    indicators = online_indicators.OnlineIndicators()
+    for root_node in root_nodes_by_id.values():
+        indicators.add_indicators(traversers.collect_indicators(root_node))
+    indicators.feed(closes.iloc[:-1])
+    stream = QuoteStream(root_nodes_by_id, indicators,
+                         closes.iloc[-2].to_dict(), closes.index[-1])
+
+    # prices wander intraday, then each ticker's last quote is its close
+    generator = random.Random(0)
+    quotes = [Quote("", ticker, closes[ticker].iloc[-2] * (1 + generator.gauss(0, 0.01)))
+              for _ in range(50) for ticker in tickers]
+    quotes.extend(Quote("", ticker, closes[ticker].iloc[-1])
+                  for ticker in tickers)
+    latencies = []
+    for quote in quotes:
+        start = time.perf_counter()
+        stream.on_quote(quote.ticker, quote.price)
+        latencies.append(time.perf_counter() - start)
+    print(f"{len(root_nodes_by_id)} symphonies, {len(quotes)} quotes: median {np.median(latencies) * 1e6:.0f}us, p99 {np.percentile(latencies, 99) * 1e6:.0f}us per quote, {stream.evaluations / len(quotes):.1f} symphonies re-evaluated per quote")
+
+    # once every close is in, the provisional allocations are the day's allocations
+    allocations, _failures = latest_allocation.get_latest_allocations(
+        root_nodes_by_id, closes)
+    for symphony_id, allocation in allocations.items():
+        assert allocation.active_branch_ids == stream.allocations[symphony_id].active_branch_ids, symphony_id
+        assert all(abs(weight - stream.allocations[symphony_id].weights.get(ticker, 0.0)) < 1e-9 for ticker, weight in allocation.weights.items()), symphony_id
+    print("provisional allocations at the close match latest_allocation")
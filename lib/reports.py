@@ -0,0 +1,159 @@
+import html
+import os
+import typing
+
+import numpy as np
+import pandas as pd
+
+from . import atomic_files, instrumentation, parallel
+from .metrics import STAT_NAMES
+
+
+#
+# Symphony reports
+# - quantstats: the full tearsheet (a dozen matplotlib charts, seconds each), rendered in worker processes
+# - lightweight: one self-contained HTML file with the precomputed stats (metrics.compute_stats) and a downsampled equity curve SVG, milliseconds each
+#
+REPORT_MODES = ["quantstats", "lightweight"]
+SVG_WIDTH = 800
+SVG_HEIGHT = 240
+SVG_MAX_POINTS = 400
+
+PERCENT_STAT_NAMES = ["Max Drawdown", "CAGR",
+                      "Adjusted Drawdown Risk", "2weeks"]
+
+
+#
+# quantstats
+#
+def render_quantstats_report(returns: pd.Series, benchmark_returns: pd.Series, title: str, path: str):
+    import matplotlib
+    matplotlib.use("Agg")
+    import quantstats
+
+    quantstats.reports.html(
+        returns, benchmark_returns, title=title, output=path, download_filename=path)
+
+
+def render_quantstats_report_task(symphony_id: str, returns: pd.Series, benchmark_returns: pd.Series, title: str, path: str):
+    # top-level so worker processes can unpickle it
+    with instrumentation.span(symphony_id, category="symphony", stage="reports"):
+        render_quantstats_report(returns, benchmark_returns, title, path)
+
+
+def render_quantstats_reports(tasks: typing.Iterable[typing.Tuple[str, pd.Series, pd.Series, str, str]], workers: typing.Optional[int] = None) -> typing.Iterator[parallel.TaskResult]:
+    """
+    tasks are (symphony_id, returns, benchmark returns, title, path); yields a parallel.TaskResult keyed by symphony_id
+    per report, as they finish. workers defaults to one per cpu, workers=1 renders in this process.
+    """
+    return parallel.imap_tasks(render_quantstats_report_task, ((task[0], task) for task in tasks), workers=workers or os.cpu_count() or 1, ordered=False)
+
+
+#
+# lightweight
+#
+def get_downsampled_positions(values: np.ndarray, max_points: int = SVG_MAX_POINTS) -> np.ndarray:
+    """
+    Positions of the min and max of each bucket (in time order), so drawdowns survive downsampling.
+    """
+    if len(values) <= max_points:
+        return np.arange(len(values))
+    positions = []
+    for bucket in np.array_split(np.arange(len(values)), max_points // 2):
+        bucket_values = values[bucket]
+        positions.extend(
+            sorted({bucket[bucket_values.argmin()], bucket[bucket_values.argmax()]}))
+    return np.array(positions)
+
+
+def format_polyline(equity: pd.Series, low: float, high: float, start: pd.Timestamp, end: pd.Timestamp, color: str) -> str:
+    values = equity.to_numpy()
+    positions = get_downsampled_positions(values)
+    span_seconds = max((end - start).total_seconds(), 1.0)
+    xs = (equity.index[positions] - start).total_seconds() / \
+        span_seconds * SVG_WIDTH
+    ys = SVG_HEIGHT - (values[positions] - low) / \
+        max(high - low, 1e-12) * SVG_HEIGHT
+    points = " ".join(f"{x:.1f},{y:.1f}" for x, y in zip(xs, ys))
+    return f'<polyline fill="none" stroke="{color}" stroke-width="1.5" points="{points}"/>'
+
+
+def render_equity_svg(returns: pd.Series, benchmark_returns: typing.Optional[pd.Series] = None) -> str:
+    returns = returns.dropna()
+    if returns.empty:
+        return ""
+    equities = [((1 + returns).cumprod(), "#1f77b4")]
+    if benchmark_returns is not None:
+        benchmark_returns = benchmark_returns[(benchmark_returns.index >= returns.index[0]) & (
+            benchmark_returns.index <= returns.index[-1])].dropna()
+        if not benchmark_returns.empty:
+            equities.append(((1 + benchmark_returns).cumprod(), "#999999"))
+
+    low = min(min(equity.min() for equity, _ in equities), 1.0)
+    high = max(max(equity.max() for equity, _ in equities), 1.0)
+    start, end = returns.index[0], returns.index[-1]
+    polylines = "".join(format_polyline(
+        equity, low, high, start, end, color) for equity, color in equities)
+    baseline_y = SVG_HEIGHT - (1.0 - low) / max(high - low, 1e-12) * SVG_HEIGHT
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {SVG_WIDTH} {SVG_HEIGHT}" width="{SVG_WIDTH}" height="{SVG_HEIGHT}">'
+        f'<line x1="0" y1="{baseline_y:.1f}" x2="{SVG_WIDTH}" y2="{baseline_y:.1f}" stroke="#dddddd"/>'
+        f'{polylines}</svg>'
+    )
+
+
+def format_stat(name: str, value) -> str:
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return "-"
+    if name in PERCENT_STAT_NAMES:
+        return f"{value:.2%}"
+    return f"{value:.2f}"
+
+
+def render_lightweight_report(title: str, stats: typing.Mapping[str, float], returns: pd.Series, benchmark_returns: typing.Optional[pd.Series] = None) -> str:
+    rows = "".join(
+        f"<tr><th>{html.escape(name)}</th><td>{format_stat(name, stats.get(name))}</td></tr>" for name in STAT_NAMES)
+    returns = returns.dropna()
+    period = f"{returns.index[0].date()} to {returns.index[-1].date()}" if not returns.empty else ""
+    return f"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{html.escape(title)}</title>
+<style>
+body {{ font-family: sans-serif; margin: 2em; }}
+table {{ border-collapse: collapse; }}
+th, td {{ padding: 2px 12px; border-bottom: 1px solid #eee; text-align: left; }}
+td {{ text-align: right; font-variant-numeric: tabular-nums; }}
+</style>
+</head>
+<body>
+<h1>{html.escape(title)}</h1>
+<p>{period}</p>
+{render_equity_svg(returns, benchmark_returns)}
+<table>{rows}</table>
+</body>
+</html>
+"""
+
+
+def write_lightweight_report(path: str, title: str, stats: typing.Mapping[str, float], returns: pd.Series, benchmark_returns: typing.Optional[pd.Series] = None):
+    with atomic_files.open_replacing(path) as f:
+        f.write(render_lightweight_report(
+            title, stats, returns, benchmark_returns))
+
+
+def main():
+    import time
+
+    from . import metrics, synthetic
+
+    closes = synthetic.generate_closes(synthetic.generate_tickers(3))
+    returns = closes.pct_change().iloc[1:]
+    stats = metrics.compute_stats(returns.iloc[:, 1:], returns.iloc[:, 0])
+
+    start = time.perf_counter()
+    for symphony_id in stats.index:
+        report = render_lightweight_report(
+            symphony_id, stats.loc[symphony_id].to_dict(), returns[symphony_id], returns.iloc[:, 0])
+    print(f"{(time.perf_counter() - start) / len(stats.index) * 1000:.1f}ms per report, {len(report)} bytes")
@@ -0,0 +1,226 @@
+import typing
+import zlib
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+
+from . import metrics, parallel
+
+
+#
+# Robustness: how much of a symphony's backtest is luck
+# - thousands of return paths are resampled from its cached daily returns, as (paths, days) index matrices into them
+#   - "bootstrap": stationary block bootstrap (Politis & Romano), blocks of geometric length keep volatility clustering
+#   - "shuffle": the same days in another order, a trade-order shuffle where every day is a trade (daily rebalancing);
+#     CAGR and Sharpe do not change, the drawdown does
+#   - "regime": the benchmark's regime sequence is kept (get_regimes), each day is drawn from the days of the same regime
+# - CAGR, Sharpe and max drawdown of every path as metrics.compute_stats computes them (rows are paths instead of symphonies),
+#   PATH_CHUNK_SIZE paths at a time so memory stays bounded, then their confidence interval
+# - a task per symphony on lib/parallel workers, each symphony's generator is seeded from its id,
+#   so results do not depend on the number of workers
+#
+METHODS = ["bootstrap", "shuffle", "regime"]
+STATS = ["CAGR", "Sharpe", "Max Drawdown"]
+DEFAULT_PATHS = 10000
+# (PATH_CHUNK_SIZE, days) float64 matrices, ~20MB for 10 years
+PATH_CHUNK_SIZE = 1000
+DEFAULT_MEAN_BLOCK_DAYS = 21
+DEFAULT_CONFIDENCE = 0.90
+
+# regimes: benchmark above its moving average or not, times its volatility above its median or not
+REGIME_TREND_DAYS = 200
+REGIME_VOLATILITY_DAYS = 21
+
+
+@dataclass
+class ResamplingOptions:
+    paths: int = DEFAULT_PATHS
+    methods: typing.List[str] = field(default_factory=lambda: list(METHODS))
+    mean_block_days: int = DEFAULT_MEAN_BLOCK_DAYS
+    confidence: float = DEFAULT_CONFIDENCE
+    seed: int = 0
+
+
+def get_regimes(benchmark_returns: pd.Series) -> pd.Series:
+    """
+    0-3 per day: 2 if the benchmark is at or above its REGIME_TREND_DAYS moving average, + 1 if its REGIME_VOLATILITY_DAYS volatility is above its median
+    """
+    prices = (benchmark_returns.fillna(0) + 1).cumprod()
+    trending = prices >= prices.rolling(
+        REGIME_TREND_DAYS, min_periods=1).mean()
+    volatility = benchmark_returns.rolling(
+        REGIME_VOLATILITY_DAYS, min_periods=2).std()
+    volatile = volatility > volatility.median()
+    return trending.astype(np.int64) * 2 + volatile.astype(np.int64)
+
+
+def get_generator(symphony_id: str, seed: int) -> np.random.Generator:
+    return np.random.default_rng([seed, zlib.crc32(symphony_id.encode())])
+
+
+#
+# Resampled day positions, (paths, days)
+#
+def draw_bootstrap_positions(generator: np.random.Generator, paths: int, days: int, mean_block_days: int) -> np.ndarray:
+    """
+    Stationary block bootstrap: a block starts at a random day with probability 1 / mean_block_days, else the previous day's next (wrapping around)
+    """
+    restarts = generator.random((paths, days)) < 1 / mean_block_days
+    restarts[:, 0] = True
+    starts = generator.integers(0, days, size=(paths, days))
+    day_positions = np.arange(days)
+    last_restarts = np.maximum.accumulate(
+        np.where(restarts, day_positions, 0), axis=1)
+    return (np.take_along_axis(starts, last_restarts, axis=1) + day_positions - last_restarts) % days
+
+
+def draw_shuffle_positions(generator: np.random.Generator, paths: int, days: int) -> np.ndarray:
+    return generator.permuted(np.broadcast_to(np.arange(days), (paths, days)), axis=1)
+
+
+def draw_regime_positions(generator: np.random.Generator, paths: int, regimes: np.ndarray) -> np.ndarray:
+    """
+    regimes: per day, any integer (e.g. get_regimes, -1 for unknown). Day d of a path is a random day with the regime of d.
+    """
+    positions = np.empty((paths, len(regimes)), dtype=np.int64)
+    for regime in np.unique(regimes):
+        regime_positions = np.flatnonzero(regimes == regime)
+        positions[:, regime_positions] = regime_positions[generator.integers(
+            0, len(regime_positions), size=(paths, len(regime_positions)))]
+    return positions
+
+
+def compute_path_stats(values: np.ndarray) -> typing.Dict[str, np.ndarray]:
+    """
+    STATS per row of (paths, days) returns, like metrics.compute_stats but without its NaN handling (paths have no gaps)
+    """
+    growth = values + 1
+    with np.errstate(invalid="ignore", divide="ignore"):
+        wealth = growth.prod(axis=1)
+        cagr = np.where(wealth < 0, np.nan, np.abs(wealth) **
+                        (metrics.TRADING_DAYS / values.shape[1]) - 1)
+        sharpe = values.mean(axis=1) / values.std(axis=1,
+                                                  ddof=1) * np.sqrt(metrics.TRADING_DAYS)
+    # metrics.compute_drawdowns, in place
+    prices = np.cumprod(growth, axis=1, out=growth)
+    peaks = np.maximum.accumulate(np.maximum(prices, 1.0), axis=1)
+    return {
+        "CAGR": cagr,
+        "Sharpe": sharpe,
+        "Max Drawdown": np.divide(prices, peaks, out=peaks).min(axis=1) - 1,
+    }
+
+
+def simulate_stats(returns: np.ndarray, method: str, generator: np.random.Generator, options: ResamplingOptions, regimes: typing.Optional[np.ndarray] = None) -> typing.Dict[str, np.ndarray]:
+    """
+    STATS of options.paths resampled paths of returns (one symphony's days, without gaps)
+    """
+    days = len(returns)
+    chunks = []
+    for chunk_start in range(0, options.paths, PATH_CHUNK_SIZE):
+        paths = min(PATH_CHUNK_SIZE, options.paths - chunk_start)
+        if method == "bootstrap":
+            positions = draw_bootstrap_positions(
+                generator, paths, days, options.mean_block_days)
+        elif method == "shuffle":
+            positions = draw_shuffle_positions(generator, paths, days)
+        elif method == "regime":
+            positions = draw_regime_positions(generator, paths, regimes)
+        else:
+            raise ValueError(f"unknown resampling method {method}")
+        chunks.append(compute_path_stats(returns[positions]))
+    return {stat: np.concatenate([chunk[stat] for chunk in chunks]) for stat in STATS}
+
+
+def summarize_symphony(symphony_id: str, returns: pd.Series, options: ResamplingOptions, regimes: typing.Optional[pd.Series] = None) -> typing.List[dict]:
+    """
+    A row per (method, stat): the backtest's value and the confidence interval and median of the resampled paths'.
+    regimes (get_regimes) is needed for the regime method.
+    """
+    returns = returns.replace([np.inf, -np.inf], np.nan).dropna()
+    if len(returns) < 2:
+        raise ValueError("not enough returns to resample")
+    values = returns.to_numpy(dtype=np.float64)
+    actual_stats = compute_path_stats(values[None, :])
+    day_regimes = None
+    if "regime" in options.methods:
+        if regimes is None:
+            raise ValueError("the regime method needs regimes")
+        day_regimes = regimes.reindex(returns.index).fillna(
+            -1).to_numpy(dtype=np.int64)
+
+    generator = get_generator(symphony_id, options.seed)
+    low, high = (1 - options.confidence) / 2, (1 + options.confidence) / 2
+    rows = []
+    for method in options.methods:
+        path_stats = simulate_stats(
+            values, method, generator, options, day_regimes)
+        for stat in STATS:
+            low_value, median, high_value = np.nanquantile(
+                path_stats[stat], [low, 0.5, high])
+            rows.append({
+                "symphony_id": symphony_id,
+                "method": method,
+                "stat": stat,
+                "actual": actual_stats[stat][0],
+                "low": low_value,
+                "median": median,
+                "high": high_value,
+                # paths doing worse than the backtest (for drawdown too, they are negative)
+                "worse": float(np.mean(path_stats[stat] < actual_stats[stat][0])),
+            })
+    return rows
+
+
+def summarize_task(symphony_id: str, options: ResamplingOptions) -> typing.List[dict]:
+    state = parallel.get_worker_state()
+    return summarize_symphony(symphony_id, state["returns"][symphony_id], options, state.get("regimes"))
+
+
+def summarize_symphonies(returns: pd.DataFrame, options: ResamplingOptions, benchmark_returns: typing.Optional[pd.Series] = None, workers: int = 1) -> typing.Tuple[pd.DataFrame, typing.Dict[str, str]]:
+    """
+    (summarize_symphony rows of every symphony in a (days, symphonies) returns frame like artifact_store.load_all_returns, failures by symphony id)
+    """
+    regimes = get_regimes(
+        benchmark_returns) if benchmark_returns is not None else None
+    rows, failures = [], {}
+    tasks = [(symphony_id, (symphony_id, options))
+             for symphony_id in returns.columns]
+    for result in parallel.run_tasks(summarize_task, tasks, workers=workers, state={"returns": returns, "regimes": regimes}):
+        if result.error:
+            failures[result.key] = result.error
+        else:
+            rows.extend(result.value)
+    return pd.DataFrame(rows, columns=["symphony_id", "method", "stat", "actual", "low", "median", "high", "worse"]), failures
+
+
+def main():
+    import time
+
+    from . import synthetic
+
+    closes = synthetic.generate_closes(synthetic.generate_tickers(4))
+    daily_returns = closes.pct_change().iloc[1:]
+    returns = daily_returns.iloc[:, 1:]
+    options = ResamplingOptions()
+
+    start = time.perf_counter()
+    summary, failures = summarize_symphonies(
+        returns, options, benchmark_returns=daily_returns.iloc[:, 0])
+    elapsed = time.perf_counter() - start
+    print(summary.to_string())
+    print(f"{len(returns.columns)} symphonies x {len(options.methods)} methods x {options.paths} paths x {len(returns)} days: {elapsed:.1f}s, {len(failures)} failed")
+
+    # shuffled days compound to the same wealth
+    shuffle_cagr = summary[(summary["method"] == "shuffle")
+                           & (summary["stat"] == "CAGR")]
+    assert np.allclose(shuffle_cagr["low"], shuffle_cagr["actual"])
+    assert np.allclose(shuffle_cagr["high"], shuffle_cagr["actual"])
+    # and the same stats as metrics.compute_stats for the backtest itself
+    stats = metrics.compute_stats(returns, daily_returns.iloc[:, 0])
+    for stat in STATS:
+        actual = summary[(summary["method"] == "bootstrap") & (
+            summary["stat"] == stat)].set_index("symphony_id")["actual"]
+        assert np.allclose(actual, stats.loc[actual.index, stat]), stat
+    print("actual stats match metrics.compute_stats")
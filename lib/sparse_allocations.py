@@ -0,0 +1,105 @@
+import typing
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from . import trading_calendar
+
+
+#
+# Allocations as day-indexed sparse rows (CSR)
+# - most days only a handful of the referenced tickers are non-zero
+# - row d's weights are weights[indptr[d]:indptr[d+1]], for tickers[ticker_indices[...]]
+# - stored as .npz, exact float64 round trip (unlike allocations.csv)
+#
+
+
+@dataclass
+class SparseAllocations:
+    index: pd.DatetimeIndex
+    tickers: typing.List[str]
+    indptr: np.ndarray
+    ticker_indices: np.ndarray
+    weights: np.ndarray
+
+    @classmethod
+    def from_frame(cls, frame: pd.DataFrame) -> "SparseAllocations":
+        values = frame.to_numpy(dtype=np.float64)
+        # NaN != 0, so NaNs are kept as explicit entries
+        non_zero = values != 0
+        rows, columns = np.nonzero(non_zero)
+        indptr = np.zeros(len(frame) + 1, dtype=np.int64)
+        np.cumsum(non_zero.sum(axis=1), out=indptr[1:])
+        return cls(
+            index=pd.DatetimeIndex(frame.index, name="Date"),
+            tickers=[str(c) for c in frame.columns],
+            indptr=indptr,
+            ticker_indices=columns.astype(np.int32),
+            weights=values[rows, columns],
+        )
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def get_row_numbers(self) -> np.ndarray:
+        # row number of each stored entry
+        return np.repeat(np.arange(len(self.index)), np.diff(self.indptr))
+
+    def to_dense(self) -> np.ndarray:
+        dense = np.zeros((len(self.index), len(self.tickers)))
+        dense[self.get_row_numbers(), self.ticker_indices] = self.weights
+        return dense
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.to_dense(), index=self.index, columns=self.tickers)
+
+    def to_dense_block(self, index: pd.DatetimeIndex) -> np.ndarray:
+        """
+        (len(index), tickers) with NaN on days outside this symphony's allocations, what batch_backtest stacks.
+        """
+        block = np.full((len(index), len(self.tickers)), np.nan)
+        positions = trading_calendar.TradingCalendar(
+            index).get_positions(self.index)
+        assert (positions >= 0).all(), "index must contain every allocation day"
+        block[positions] = 0.0
+        block[positions[self.get_row_numbers()], self.ticker_indices] = self.weights
+        return block
+
+    def row_sums(self) -> pd.Series:
+        sums = np.zeros(len(self.index))
+        np.add.at(sums, self.get_row_numbers(), self.weights)
+        return pd.Series(sums, index=self.index)
+
+    def save(self, path: str):
+        np.savez(
+            path,
+            index=self.index.values.astype("datetime64[ns]").view(np.int64),
+            tickers=np.array(self.tickers, dtype=str),
+            indptr=self.indptr,
+            ticker_indices=self.ticker_indices,
+            weights=self.weights,
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "SparseAllocations":
+        with np.load(path) as data:
+            return cls(
+                index=pd.DatetimeIndex(data["index"].view(
+                    "datetime64[ns]"), name="Date"),
+                tickers=[str(t) for t in data["tickers"]],
+                indptr=data["indptr"],
+                ticker_indices=data["ticker_indices"],
+                weights=data["weights"],
+            )
+
+
+def main():
+    frame = pd.DataFrame({
+        "SPY": [0.5, 0.5, 0.0],
+        "TLT": [0.5, 0.0, 1.0],
+        "QQQ": [0.0, 0.5, 0.0],
+    }, index=pd.bdate_range("2023-01-02", periods=3, name="Date"))
+    allocations = SparseAllocations.from_frame(frame)
+    print(allocations)
+    pd.testing.assert_frame_equal(allocations.to_frame(), frame)
@@ -0,0 +1,297 @@
+import collections
+import hashlib
+import itertools
+import json
+import typing
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from . import logic, traversers
+from .branch_tracker import BranchTracker
+
+
+#
+# Structural (Merkle) hashes of subtrees, ignoring ids and cosmetic fields
+# - community symphonies are mostly copies of each other ("Overbought S&P", "TQQQ for the long term", ...)
+#   that only differ in :id UUIDs, :price/:dollar_volume snapshots, :collapsed? and names
+# - a node's hash covers its own fields and its children's hashes (in order), so equal hashes mean equal behavior
+# - a node's own :weight belongs to its parent (it only matters under :wt-cash-specified), so it is hashed there
+#
+# Shared subtrees (same hash in several places) are evaluated once per closes frame by SubtreeCache,
+# and the generated code of every symphony containing one adds the cached allocations and branches instead
+# of re-evaluating it every day (see vectorbt.print_python_logic subtree_slots).
+#
+EPHEMERAL_KEYS = {":id", ":price", ":dollar_volume", ":collapsed?", ":collapsed-specified-weight?",
+                  ":children-count", ":name", ":description", ":exchange", ":has_marketcap"}
+STRUCTURAL_KEYS_HANDLED_BY_PARENT = {":children", ":weight"}
+
+# near-duplicate symphonies share at least this fraction of their (non-leaf) subtrees
+DEFAULT_SIMILARITY_THRESHOLD = 0.8
+
+
+def get_node_fields(node: dict) -> dict:
+    return {key: value for key, value in node.items() if key not in EPHEMERAL_KEYS and key not in STRUCTURAL_KEYS_HANDLED_BY_PARENT}
+
+
+def collect_subtree_hashes(node: dict, hashes_by_id: typing.Optional[typing.Dict[str, str]] = None) -> typing.Dict[str, str]:
+    """
+    Structural hash of every subtree, by node id.
+    """
+    hashes_by_id = {} if hashes_by_id is None else hashes_by_id
+    children = []
+    for child in logic.get_node_children(node):
+        collect_subtree_hashes(child, hashes_by_id)
+        weight = child.get(":weight") if logic.is_specified_weight_node(
+            node) else None
+        children.append([weight, hashes_by_id[child[":id"]]])
+    hashes_by_id[node[":id"]] = hashlib.sha256(json.dumps(
+        [get_node_fields(node), children], sort_keys=True, default=str).encode()).hexdigest()
+    return hashes_by_id
+
+
+def get_structural_hash(node: dict) -> str:
+    return collect_subtree_hashes(node)[node[":id"]]
+
+
+def iter_nodes(node: dict) -> typing.Iterator[dict]:
+    yield node
+    for child in logic.get_node_children(node):
+        yield from iter_nodes(child)
+
+
+def map_node_ids(node: dict, other_node: dict) -> typing.Dict[str, str]:
+    """
+    node's ids to the ids of the same positions in other_node (structurally equal subtrees).
+    """
+    return {a[":id"]: b[":id"] for a, b in zip(iter_nodes(node), iter_nodes(other_node))}
+
+
+def is_shareable(node: dict) -> bool:
+    # assets are trivial, :if-child is part of its :if's control flow, :root holds symphony-level fields
+    # without indicators there is nothing expensive to share (and its days would not be decided by its own indicators)
+    if logic.is_asset_node(node) or logic.is_if_child_node(node) or logic.is_root_node(node):
+        return False
+    return bool(traversers.collect_indicators(node))
+
+
+def find_shared_subtrees(root_nodes_by_id: typing.Mapping[str, dict], min_uses: int = 2) -> typing.Set[str]:
+    """
+    Hashes of shareable subtrees that appear at least min_uses times across the symphonies.
+    """
+    uses = collections.Counter()
+    for root_node in root_nodes_by_id.values():
+        hashes_by_id = collect_subtree_hashes(root_node)
+        for node in iter_nodes(root_node):
+            if is_shareable(node):
+                uses[hashes_by_id[node[":id"]]] += 1
+    return {subtree_hash for subtree_hash, count in uses.items() if count >= min_uses}
+
+
+def select_shared_subtrees(root_node: dict, shared_hashes: typing.Set[str]) -> typing.List[typing.Tuple[dict, str, str]]:
+    """
+    Outermost shared subtrees of root_node, as (node, hash, id of the branch it is on in root_node).
+    """
+    hashes_by_id = collect_subtree_hashes(root_node)
+    selected = []
+
+    def visit(node, parent_node_branch_state: logic.NodeBranchState):
+        current_node_branch_state = logic.advance_branch_state(
+            parent_node_branch_state, node)
+        subtree_hash = hashes_by_id[node[":id"]]
+        # (wrap_as_root gives the root its subtree's id, so a shared subtree being evaluated does not select itself)
+        if node[":id"] != root_node[":id"] and subtree_hash in shared_hashes and is_shareable(node):
+            selected.append(
+                (node, subtree_hash, current_node_branch_state.branch_path_ids[-1]))
+            return
+        for child in logic.get_node_children(node):
+            visit(child, current_node_branch_state)
+
+    visit(root_node, logic.build_node_branch_state_from_root_node(root_node))
+    return selected
+
+
+#
+# Evaluation
+#
+@dataclass
+class SubtreeResult:
+    # the copy that was evaluated, its ids label branch_tracker
+    node: dict
+    # (days, tickers) with the subtree at weight 1
+    allocations: pd.DataFrame
+    branch_tracker: BranchTracker
+
+
+@dataclass
+class SubtreeUse:
+    result: SubtreeResult
+    # branch tracker bit in the using symphony, per branch of result.branch_tracker
+    branch_bits: typing.List[int]
+
+
+def wrap_as_root(node: dict) -> dict:
+    # a :root parent so the subtree is evaluated at weight 1, and its own :weight is ignored
+    # assets not under one of its own :if-child are on the root's (= the subtree's id) branch
+    return {":id": node[":id"], ":step": ":root", ":children": [node]}
+
+
+class SubtreeCache:
+    def __init__(self, shared_hashes: typing.Set[str]):
+        self.shared_hashes = shared_hashes
+        self.results_by_key: typing.Dict[tuple, SubtreeResult] = {}
+        # for transpilers.precompute_indicator_cached, shared by every symphony and subtree evaluated with this cache
+        self.indicator_cache: typing.Dict[tuple, pd.Series] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, node: dict, subtree_hash: str, closes: pd.DataFrame) -> typing.Tuple[tuple, pd.DataFrame]:
+        # (same result for any closes frame that has the same rows for the subtree's tickers), and those closes
+        subtree_closes = closes[sorted(
+            traversers.collect_referenced_assets(node))].dropna(how="all")
+        return (subtree_hash, len(subtree_closes), subtree_closes.index.min(), subtree_closes.index.max()), subtree_closes
+
+    def get_result(self, node: dict, subtree_hash: str, closes: pd.DataFrame) -> SubtreeResult:
+        from . import transpilers
+
+        key, subtree_closes = self.get_key(node, subtree_hash, closes)
+        if key in self.results_by_key:
+            self.hits += 1
+            return self.results_by_key[key]
+
+        self.misses += 1
+        allocations, branch_tracker = transpilers.VectorBTTranspiler.build_allocations_matrix(
+            wrap_as_root(node), subtree_closes, subtree_cache=self)
+        result = SubtreeResult(
+            node=node, allocations=allocations, branch_tracker=branch_tracker)
+        self.results_by_key[key] = result
+        return result
+
+    def get_shared_subtree_nodes(self, root_nodes_by_id: typing.Mapping[str, dict]) -> typing.Dict[str, dict]:
+        """
+        One node per shared subtree the symphonies would evaluate, by hash (to evaluate them up front).
+        """
+        nodes_by_hash = {}
+        for root_node in root_nodes_by_id.values():
+            for node, subtree_hash, _context_branch_id in select_shared_subtrees(root_node, self.shared_hashes):
+                nodes_by_hash.setdefault(subtree_hash, node)
+        return nodes_by_hash
+
+    def prepare(self, root_node: dict, closes: pd.DataFrame, branch_ids: typing.List[str]) -> typing.Tuple[typing.Dict[str, int], typing.List[SubtreeUse]]:
+        """
+        (slot by node id, for code generation) and the SubtreeUses passed to build_allocations_matrix.
+        """
+        bits_by_branch_id = {branch_id: bit for bit,
+                             branch_id in enumerate(branch_ids)}
+        slots_by_node_id = {}
+        subtree_uses = []
+        for node, subtree_hash, context_branch_id in select_shared_subtrees(root_node, self.shared_hashes):
+            result = self.get_result(node, subtree_hash, closes)
+            ids = map_node_ids(result.node, node)
+            # the evaluated copy's own id stands for whichever branch the subtree is on here
+            ids[result.node[":id"]] = context_branch_id
+            slots_by_node_id[node[":id"]] = len(subtree_uses)
+            subtree_uses.append(SubtreeUse(result=result, branch_bits=[
+                                bits_by_branch_id[ids[branch_id]] for branch_id in result.branch_tracker.branch_ids]))
+        return slots_by_node_id, subtree_uses
+
+
+def apply_subtree_uses(allocations: pd.DataFrame, branch_rows: typing.List[int], subtree_visits: typing.List[typing.List[typing.Tuple[int, float]]], subtree_uses: typing.List[SubtreeUse]) -> pd.DataFrame:
+    """
+    Called by generated code after the day loop: adds each visited subtree's cached allocations (scaled by
+    the weight it was visited with) and branches, for the days (row positions) it was visited on.
+    """
+    values = allocations.to_numpy(dtype=np.float64, copy=True)
+    for visits, subtree_use in zip(subtree_visits, subtree_uses):
+        if not visits:
+            continue
+        positions = np.array([position for position, _ in visits])
+        weights = np.array([weight for _, weight in visits])
+        result = subtree_use.result
+
+        result_rows = result.allocations.index.get_indexer(
+            allocations.index[positions])
+        assert (result_rows >= 0).all(), "shared subtree was evaluated on fewer days"
+        columns = allocations.columns.get_indexer(result.allocations.columns)
+        present = columns >= 0
+        values[np.ix_(positions, columns[present])] += weights[:, None] * \
+            result.allocations.to_numpy(dtype=np.float64)[
+                result_rows][:, present]
+
+        tracker_rows = result.branch_tracker.index.get_indexer(
+            allocations.index[positions])
+        patterns, pattern_numbers = np.unique(
+            result.branch_tracker.to_bits()[tracker_rows], axis=0, return_inverse=True)
+        pattern_ints = [sum(1 << subtree_use.branch_bits[b] for b in np.flatnonzero(pattern))
+                        for pattern in patterns]
+        for position, pattern_number in zip(positions, pattern_numbers.reshape(-1)):
+            branch_rows[position] |= pattern_ints[pattern_number]
+    return pd.DataFrame(values, index=allocations.index, columns=allocations.columns)
+
+
+#
+# Duplicate report
+#
+def get_signature(root_node: dict) -> typing.Set[str]:
+    # non-leaf subtrees, leaves alone (a single ticker) say little about similarity
+    hashes_by_id = collect_subtree_hashes(root_node)
+    return {hashes_by_id[node[":id"]] for node in iter_nodes(root_node) if logic.get_node_children(node) and not logic.is_root_node(node)}
+
+
+def find_duplicates(root_nodes_by_id: typing.Mapping[str, dict], threshold: float = DEFAULT_SIMILARITY_THRESHOLD) -> typing.List[dict]:
+    """
+    Pairs of symphonies that are structurally identical, or share at least `threshold` (Jaccard) of their subtrees.
+    """
+    signatures_by_id = {symphony_id: get_signature(
+        root_node) for symphony_id, root_node in root_nodes_by_id.items()}
+    root_hashes_by_id = {symphony_id: get_structural_hash(
+        root_node) for symphony_id, root_node in root_nodes_by_id.items()}
+
+    # only compare symphonies sharing at least one subtree
+    symphony_ids_by_hash = collections.defaultdict(list)
+    for symphony_id, signature in signatures_by_id.items():
+        for subtree_hash in signature:
+            symphony_ids_by_hash[subtree_hash].append(symphony_id)
+    shared_counts = collections.Counter()
+    for symphony_ids in symphony_ids_by_hash.values():
+        for pair in itertools.combinations(sorted(symphony_ids), 2):
+            shared_counts[pair] += 1
+
+    duplicates = []
+    for (symphony_id, other_symphony_id), shared_count in shared_counts.items():
+        union_count = len(signatures_by_id[symphony_id]) + \
+            len(signatures_by_id[other_symphony_id]) - shared_count
+        similarity = shared_count / union_count if union_count else 1.0
+        exact = root_hashes_by_id[symphony_id] == root_hashes_by_id[other_symphony_id]
+        if exact or similarity >= threshold:
+            duplicates.append({
+                "symphony_id": symphony_id,
+                "other_symphony_id": other_symphony_id,
+                "kind": "exact" if exact else "near",
+                "similarity": 1.0 if exact else similarity,
+                "shared_subtrees": shared_count,
+            })
+    return sorted(duplicates, key=lambda d: (-d["similarity"], d["symphony_id"], d["other_symphony_id"]))
+
+
+def main():
+    import copy
+    import uuid
+
+    from . import synthetic
+
+    root_node = synthetic.generate_symphony(depth=3, breadth=2)
+    copied_root_node = copy.deepcopy(root_node)
+    for node in iter_nodes(copied_root_node):
+        node[":id"] = str(uuid.uuid4())
+        if logic.is_asset_node(node):
+            node[":price"] = 1.0
+    assert get_structural_hash(root_node) == get_structural_hash(
+        copied_root_node)
+
+    root_nodes_by_id = {"original": root_node, "copy": copied_root_node,
+                        "other": synthetic.generate_symphony(depth=3, breadth=2, seed=1)}
+    print(f"{len(find_shared_subtrees(root_nodes_by_id))} shared subtrees")
+    for duplicate in find_duplicates(root_nodes_by_id):
+        print(duplicate)
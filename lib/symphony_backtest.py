@@ -1,13 +1,19 @@
+import contextlib
 import datetime
+import glob
+import mmap
+import os
+import re
 import time
 import typing
 
 import requests
 import edn_format
+import numpy as np
 import pandas as pd
 import pytz
 
-from . import edn_syntax
+from . import atomic_files, edn_syntax, instrumentation
 
 
 UTC_TIMEZONE = pytz.UTC
@@ -27,40 +33,104 @@ def date_to_epoch_days(day: datetime.date) -> int:
 assert epoch_days_to_date(19289) == datetime.date(2022, 10, 24)
 
 
-def get_composer_backtest_results(symphony_id: str, start_date: datetime.date, end_date: typing.Union[datetime.date,None]=None) -> dict:
-    start_epoch_days = date_to_epoch_days(start_date)
+COMPOSER_BACKTEST_CACHE_DIR = "data/composer_backtests"
+DEFAULT_SLIPPAGE_PERCENT = 0.0005
+
+
+def get_composer_backtest_cache_path(symphony_id: str, version: str, start_date: datetime.date, end_date: datetime.date, slippage_percent: float) -> str:
+    return f"{COMPOSER_BACKTEST_CACHE_DIR}/{symphony_id}/{version}_{start_date.isoformat()}_{end_date.isoformat()}_{slippage_percent}.edn"
+
+
+def find_cached_composer_backtest(symphony_id: str, version: str = "latest", slippage_percent: float = DEFAULT_SLIPPAGE_PERCENT) -> typing.Optional[str]:
+    """
+    Path to the cached response of the symphony version ending last (the longest of those), whatever window it was requested for.
+    """
+    prefix = f"{COMPOSER_BACKTEST_CACHE_DIR}/{symphony_id}/{version}_"
+    suffix = f"_{slippage_percent}.edn"
+    windows_by_path = {}
+    for path in glob.glob(glob.escape(prefix) + "*" + glob.escape(suffix)):
+        start, _, end = path[len(prefix):-len(suffix)].partition("_")
+        try:
+            windows_by_path[path] = (datetime.date.fromisoformat(
+                end), -datetime.date.fromisoformat(start).toordinal())
+        except ValueError:
+            continue
+    if not windows_by_path:
+        return None
+    return max(windows_by_path, key=windows_by_path.__getitem__)
+
+
+def fetch_composer_backtest(symphony_id: str, start_date: datetime.date, end_date: typing.Union[datetime.date, None] = None, version: str = "latest", slippage_percent: float = DEFAULT_SLIPPAGE_PERCENT, offline: bool = False) -> str:
+    """
+    Path to the raw EDN response of a Composer backtest, cached on disk by (symphony_id, version, start, end, fees).
+
+    offline=True only reads the cache (or recorded responses copied into it), never posts to Composer.
+    """
     utc_today = datetime.datetime.now().astimezone(UTC_TIMEZONE).date()
-    payload = "{:uid nil, :start-date-in-epoch-days START_DATE_EPOCH_DAYS, :capital 10000, :apply-taf-fee? true, :symphony-benchmarks [], :slippage-percent 0.0005, :apply-reg-fee? true, :symphony \"SYMPHONY_ID_GOES_HERE\", :ticker-benchmarks []}"
+    cache_path = get_composer_backtest_cache_path(
+        symphony_id, version, start_date, end_date if end_date else utc_today, slippage_percent)
+    if os.path.exists(cache_path):
+        instrumentation.count("composer_backtests.hit")
+        return cache_path
+    instrumentation.count("composer_backtests.miss")
+    if offline:
+        raise FileNotFoundError(
+            f"No cached Composer backtest for {symphony_id} at {cache_path}")
+
+    start_epoch_days = date_to_epoch_days(start_date)
+    payload = "{:uid nil, :start-date-in-epoch-days START_DATE_EPOCH_DAYS, :capital 10000, :apply-taf-fee? true, :symphony-benchmarks [], :slippage-percent SLIPPAGE_PERCENT, :apply-reg-fee? true, :symphony \"SYMPHONY_ID_GOES_HERE\", :ticker-benchmarks []}"
     if end_date:
         end_epoch_days = date_to_epoch_days(end_date)
-        payload = "{:uid nil, :start-date-in-epoch-days START_DATE_EPOCH_DAYS, :end-date-in-epoch-days END_DATE_EPOCH_DAYS, :capital 10000, :apply-taf-fee? true, :symphony-benchmarks [], :slippage-percent 0.0005, :apply-reg-fee? true, :symphony \"SYMPHONY_ID_GOES_HERE\", :ticker-benchmarks []}"
+        payload = "{:uid nil, :start-date-in-epoch-days START_DATE_EPOCH_DAYS, :end-date-in-epoch-days END_DATE_EPOCH_DAYS, :capital 10000, :apply-taf-fee? true, :symphony-benchmarks [], :slippage-percent SLIPPAGE_PERCENT, :apply-reg-fee? true, :symphony \"SYMPHONY_ID_GOES_HERE\", :ticker-benchmarks []}"
         payload = payload.replace("END_DATE_EPOCH_DAYS", str(end_epoch_days))
     payload = payload.replace("SYMPHONY_ID_GOES_HERE", symphony_id)
     payload = payload.replace("START_DATE_EPOCH_DAYS", str(start_epoch_days))
-
+    payload = payload.replace("SLIPPAGE_PERCENT", str(slippage_percent))
 
     print(
         f"Fetching backtest results for {symphony_id} from {start_date} to {end_date if end_date else utc_today}...")
 
     tries_remaining = 3
+    retry_delay_seconds = 1
     response = None
     while tries_remaining:
         try:
             response = requests.post(
                 "https://backtest.composer.trade/v2/backtest",
-                json=payload)
+                json=payload, stream=True)
             response.raise_for_status()
             break
         except requests.HTTPError as e:
-            time.sleep(3)
             print("Error when submitting backtest:", e)
             tries_remaining -= 1
+            if tries_remaining:
+                time.sleep(retry_delay_seconds)
+                retry_delay_seconds *= 2
 
     if not response:
         raise Exception("Failed to submit backtest after retries")
 
+    # stream straight to disk, multi-decade backtests are large
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # parity.py and populate runs may fill the same cache at once
+    with atomic_files.open_replacing(cache_path, 'wb') as f:
+        for chunk in response.iter_content(chunk_size=1 << 20):
+            f.write(chunk)
+
+    return cache_path
+
+
+def get_composer_backtest_response_text(symphony_id: str, start_date: datetime.date, end_date: typing.Union[datetime.date, None] = None, version: str = "latest", slippage_percent: float = DEFAULT_SLIPPAGE_PERCENT, offline: bool = False) -> str:
+    with open(fetch_composer_backtest(symphony_id, start_date, end_date, version=version, slippage_percent=slippage_percent, offline=offline)) as f:
+        return f.read()
+
+
+def get_composer_backtest_results(symphony_id: str, start_date: datetime.date, end_date: typing.Union[datetime.date, None] = None, version: str = "latest", slippage_percent: float = DEFAULT_SLIPPAGE_PERCENT, offline: bool = False) -> dict:
+    response_text = get_composer_backtest_response_text(
+        symphony_id, start_date, end_date, version=version, slippage_percent=slippage_percent, offline=offline)
+
     backtest_result = edn_syntax.convert_edn_to_pythonic(
-        edn_format.loads(response.text))
+        edn_format.loads(response_text))
 
     return typing.cast(dict, backtest_result)
 
@@ -82,3 +152,147 @@ def extract_returns_from_composer_backtest_result(backtest_result: dict, symphon
     returns = pd.Series([row[1] for row in returns_by_day], index=[
                         row[0] for row in returns_by_day]).pct_change().dropna()
     return returns
+
+
+#
+# Vectorized decoding
+# - pulls :tdvm-weights and :dvm-capital straight out of the raw (memory-mapped) response into numpy arrays
+# - skips edn_format/convert_edn_to_pythonic, which build Python objects for every row of every ticker
+#
+EDN_STRING_OR_BRACE_PATTERN = re.compile(rb'"(?:[^"\\]|\\.)*"|[{}]')
+# one "string" {...} entry of a map, from where the previous one ended (commas are whitespace in EDN)
+EDN_STRING_KEYED_MAP_ENTRY_PATTERN = re.compile(rb'[\s,]*"((?:[^"\\]|\\.)*)"[\s,]*\{([^{}]*)\}')
+EDN_WHITESPACE_PATTERN = re.compile(rb'[\s,]*')
+
+
+def find_edn_map_value(buffer, key: bytes, start: int = 0, end: typing.Optional[int] = None) -> typing.Tuple[int, int]:
+    """
+    (start, end) offsets of the {...} map following `key`, braces included.
+    """
+    end = len(buffer) if end is None else end
+    key_position = buffer.find(key, start, end)
+    if key_position == -1:
+        raise KeyError(key.decode())
+    map_start = buffer.find(b"{", key_position + len(key), end)
+    if map_start == -1:
+        raise ValueError(f"{key.decode()} is not followed by a map")
+
+    depth = 0
+    for match in EDN_STRING_OR_BRACE_PATTERN.finditer(buffer, map_start, end):
+        token = match.group()
+        if token == b"{":
+            depth += 1
+        elif token == b"}":
+            depth -= 1
+            if depth == 0:
+                return map_start, match.end()
+    raise ValueError(f"{key.decode()} map is not terminated")
+
+
+def iter_edn_string_keyed_maps(buffer, map_start: int, map_end: int) -> typing.Iterator[typing.Tuple[str, bytes]]:
+    """
+    (key, inside of the value map) of every entry of the {"string" {...}, ...} map at (map_start, map_end) (find_edn_map_value),
+    raises on any entry of another shape instead of skipping it.
+    """
+    position, end = map_start + 1, map_end - 1
+    while True:
+        position = EDN_WHITESPACE_PATTERN.match(buffer, position, end).end()
+        if position == end:
+            return
+        match = EDN_STRING_KEYED_MAP_ENTRY_PATTERN.match(buffer, position, end)
+        if match is None:
+            raise ValueError(
+                f"expected a \"string\" {{...}} entry at offset {position}: {bytes(buffer[position:min(position + 40, end)])!r}")
+        yield match.group(1).decode(), match.group(2)
+        position = match.end()
+
+
+# commas are whitespace in EDN, M/N are BigDecimal/BigInt suffixes
+EDN_NUMBER_TRANSLATION = bytes.maketrans(b",", b" ")
+
+
+def decode_edn_number_map(body: bytes) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Decodes the inside of a {number number, ...} map into (keys, values) arrays, nil values are NaN.
+    """
+    # nil is never part of a number token
+    tokens = body.translate(EDN_NUMBER_TRANSLATION,
+                            b"MN").replace(b"nil", b"nan").split()
+    if len(tokens) % 2:
+        raise ValueError("map has an odd number of forms")
+    try:
+        pairs = np.array(tokens, dtype=np.bytes_).astype(
+            np.float64).reshape(-1, 2)
+    except ValueError as e:
+        raise ValueError(f"map contains forms that are not numbers ({e})")
+    if not np.isfinite(pairs[:, 0]).all():
+        raise ValueError("map has keys that are not numbers")
+    return pairs[:, 0].astype(np.int64), pairs[:, 1]
+
+
+def epoch_days_to_datetime_index(epoch_days: np.ndarray) -> pd.DatetimeIndex:
+    # epoch days are UTC dates, so this is exactly epoch_days_to_date, without a Python call per day
+    return pd.DatetimeIndex(epoch_days.astype("datetime64[D]").astype("datetime64[ns]"))
+
+
+def decode_weights_from_composer_backtest(buffer) -> typing.Tuple[np.ndarray, typing.List[str], np.ndarray]:
+    """
+    (epoch_days, tickers, weights) where weights is (days, tickers), from a raw response buffer.
+    """
+    map_start, map_end = find_edn_map_value(buffer, b":tdvm-weights")
+
+    tickers = []
+    days_by_ticker = []
+    weights_by_ticker = []
+    for ticker, body in iter_edn_string_keyed_maps(buffer, map_start, map_end):
+        tickers.append(ticker)
+        days, weights = decode_edn_number_map(body)
+        days_by_ticker.append(days)
+        # nil weights are 0, like extract_allocations_from_composer_backtest_result's fillna(0)
+        weights_by_ticker.append(np.where(np.isnan(weights), 0.0, weights))
+
+    all_days = np.unique(np.concatenate(days_by_ticker)) if days_by_ticker else np.empty(0, dtype=np.int64)
+    matrix = np.zeros((len(all_days), len(tickers)))
+    for column, (days, weights) in enumerate(zip(days_by_ticker, weights_by_ticker)):
+        matrix[np.searchsorted(all_days, days), column] = weights
+    return all_days, tickers, matrix
+
+
+def decode_capital_from_composer_backtest(buffer, symphony_id: str) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    (epoch_days, capital) sorted by day, from a raw response buffer.
+    """
+    map_start, map_end = find_edn_map_value(buffer, b":dvm-capital")
+    for key, body in iter_edn_string_keyed_maps(buffer, map_start, map_end):
+        if key != symphony_id:
+            continue
+        days, capital = decode_edn_number_map(body)
+        order = np.argsort(days, kind="stable")
+        return days[order], capital[order]
+    raise KeyError(symphony_id)
+
+
+def decode_allocations_from_composer_backtest(buffer) -> pd.DataFrame:
+    """
+    Same frame as extract_allocations_from_composer_backtest_result, straight from the raw response.
+    """
+    days, tickers, weights = decode_weights_from_composer_backtest(buffer)
+    return pd.DataFrame(weights.round(4), index=epoch_days_to_datetime_index(days), columns=tickers)
+
+
+def decode_returns_from_composer_backtest(buffer, symphony_id: str) -> pd.Series:
+    """
+    Same series as extract_returns_from_composer_backtest_result, straight from the raw response.
+    """
+    days, capital = decode_capital_from_composer_backtest(buffer, symphony_id)
+    return pd.Series(capital, index=epoch_days_to_datetime_index(days)).pct_change().dropna()
+
+
+@contextlib.contextmanager
+def open_composer_backtest_buffer(path: str) -> typing.Iterator[mmap.mmap]:
+    """
+    The raw response, memory-mapped until the with block ends (decode_* results do not reference it).
+    """
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            yield buffer
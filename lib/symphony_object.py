@@ -1,9 +1,10 @@
+import os
 import typing
 
 import requests
 import edn_format
 
-from . import edn_syntax
+from . import edn_syntax, instrumentation
 
 COMPOSER_CONFIG = {
     "projectId": "leverheads-278521",
@@ -14,8 +15,9 @@ COMPOSER_CONFIG = {
 def get_symphony(symphony_id: str) -> dict:
 
     print(f"Fetching symphony {symphony_id} from Composer")
-    response = requests.get(
-        f'https://firestore.googleapis.com/v1/projects/{COMPOSER_CONFIG["projectId"]}/databases/{COMPOSER_CONFIG["databaseName"]}/documents/symphony/{symphony_id}')
+    with instrumentation.span("download_symphony", category="download"):
+        response = requests.get(
+            f'https://firestore.googleapis.com/v1/projects/{COMPOSER_CONFIG["projectId"]}/databases/{COMPOSER_CONFIG["databaseName"]}/documents/symphony/{symphony_id}')
     response.raise_for_status()
 
     response_json = response.json()
@@ -31,6 +33,19 @@ def get_public_symphonies() -> list[dict]:
     print(f"fetched {len(response_json['documents'])} public symphonies")
     return response_json['documents']
 
+def get_cached_symphony_ids() -> typing.List[str]:
+    return sorted(os.listdir("outputs/symphonies"))
+
+
+def extract_version_from_symphony_response(response: dict) -> str:
+    # firestore wraps every field in a typed value, like {"stringValue": "..."}
+    version_field = response['fields'].get('latest_version')
+    if not version_field:
+        return "latest"
+    return str(next(iter(version_field.values())))
+
+
 def extract_root_node_from_symphony_response(response: dict) -> dict:
-    return typing.cast(dict, edn_syntax.convert_edn_to_pythonic(
-        edn_format.loads(response['fields']['latest_version_edn']['stringValue'])))
+    with instrumentation.span("parse_edn", category="edn"):
+        return typing.cast(dict, edn_syntax.convert_edn_to_pythonic(
+            edn_format.loads(response['fields']['latest_version_edn']['stringValue'])))
@@ -0,0 +1,193 @@
+import random
+import typing
+import uuid
+
+import edn_format
+import numpy as np
+import pandas as pd
+
+from . import edn_syntax, logic
+
+
+#
+# Synthetic symphonies and prices, for benchmarking/testing offline
+# - symphonies are pythonic root nodes (what symphony_object.extract_root_node_from_symphony_response returns)
+# - prices look like get_backtest_data output (Date index, one column per ticker, NaN before a ticker "exists")
+#
+DEFAULT_NODE_MIX = {
+    ":if": 4,
+    ":filter": 1,
+    ":wt-inverse-vol": 1,
+    ":wt-cash-specified": 1,
+    ":wt-cash-equal": 1,
+}
+
+# (low, high) of fixed :rhs-val comparisons per indicator, so conditions actually flip
+FIXED_VALUE_RANGES = {
+    logic.ComposerIndicatorFunction.CURRENT_PRICE: (50, 150),
+    logic.ComposerIndicatorFunction.CUMULATIVE_RETURN: (-10, 10),
+    logic.ComposerIndicatorFunction.STANDARD_DEVIATION_PRICE: (0, 5),
+    logic.ComposerIndicatorFunction.STANDARD_DEVIATION_RETURNS: (0, 4),
+    logic.ComposerIndicatorFunction.MAX_DRAWDOWN: (0, 30),
+    logic.ComposerIndicatorFunction.MOVING_AVERAGE_PRICE: (50, 150),
+    logic.ComposerIndicatorFunction.MOVING_AVERAGE_RETURNS: (-1, 1),
+    logic.ComposerIndicatorFunction.EMA_PRICE: (50, 150),
+    logic.ComposerIndicatorFunction.RSI: (20, 80),
+}
+INDICATOR_FUNCTIONS = list(FIXED_VALUE_RANGES.keys())
+COMPARATORS = [logic.ComposerComparison.LT, logic.ComposerComparison.LTE,
+               logic.ComposerComparison.GT, logic.ComposerComparison.GTE]
+WINDOW_DAYS = [3, 5, 7, 10, 14, 20, 30, 50, 100, 200]
+
+
+def generate_tickers(count: int) -> typing.List[str]:
+    return [f"T{i:03d}" for i in range(count)]
+
+
+class SymphonyGenerator:
+    def __init__(self, tickers: typing.List[str], seed: int = 0, node_mix: typing.Optional[typing.Mapping[str, float]] = None):
+        self.tickers = tickers
+        self.random = random.Random(seed)
+        self.node_mix = dict(node_mix or DEFAULT_NODE_MIX)
+
+    def new_id(self) -> str:
+        return str(uuid.UUID(int=self.random.getrandbits(128)))
+
+    def new_window_days(self) -> str:
+        # :*-window-days are strings, annoyingly
+        return str(self.random.choice(WINDOW_DAYS))
+
+    def new_asset(self, ticker: typing.Optional[str] = None) -> dict:
+        ticker = ticker or self.random.choice(self.tickers)
+        return {
+            ":id": self.new_id(),
+            ":step": ":asset",
+            ":ticker": ticker,
+            ":name": f"Synthetic {ticker}",
+            ":exchange": "XNYS",
+            ":has_marketcap": False,
+            ":price": round(self.random.uniform(10, 200), 2),
+            ":dollar_volume": round(self.random.uniform(1e6, 1e9), 2),
+        }
+
+    def new_distinct_assets(self, count: int) -> typing.List[dict]:
+        return [self.new_asset(ticker) for ticker in self.random.sample(self.tickers, min(count, len(self.tickers)))]
+
+    def new_condition(self) -> dict:
+        fn = self.random.choice(INDICATOR_FUNCTIONS)
+        condition = {
+            ":lhs-fn": fn,
+            ":lhs-val": self.random.choice(self.tickers),
+            ":lhs-window-days": self.new_window_days(),
+            ":comparator": self.random.choice(COMPARATORS),
+        }
+        if self.random.random() < 0.3:
+            # compare against another ticker's indicator of the same kind
+            condition.update({
+                ":rhs-fixed-value?": False,
+                ":rhs-fn": fn,
+                ":rhs-val": self.random.choice(self.tickers),
+                ":rhs-window-days": self.new_window_days(),
+            })
+        else:
+            low, high = FIXED_VALUE_RANGES[fn]
+            condition.update({
+                ":rhs-fixed-value?": True,
+                ":rhs-val": str(round(self.random.uniform(low, high))),
+            })
+        return condition
+
+    def new_node(self, depth: int, breadth: int) -> dict:
+        if depth <= 0:
+            return self.new_asset()
+
+        steps = list(self.node_mix.keys())
+        step = self.random.choices(
+            steps, weights=[self.node_mix[s] for s in steps])[0]
+
+        if step == ":if":
+            children = []
+            for i in range(max(breadth, 2)):
+                if_child = {
+                    ":id": self.new_id(),
+                    ":step": ":if-child",
+                    ":is-else-condition?": i == max(breadth, 2) - 1,
+                    ":children": [self.new_node(depth - 1, breadth)],
+                }
+                if not if_child[":is-else-condition?"]:
+                    if_child.update(self.new_condition())
+                children.append(if_child)
+            return {":id": self.new_id(), ":step": ":if", ":children": children}
+
+        if step == ":filter":
+            children = self.new_distinct_assets(breadth + 1)
+            return {
+                ":id": self.new_id(),
+                ":step": ":filter",
+                ":select?": True,
+                ":select-fn": self.random.choice([":top", ":bottom"]),
+                ":select-n": str(self.random.randint(1, max(len(children) - 1, 1))),
+                ":sort-by?": True,
+                ":sort-by-fn": self.random.choice(INDICATOR_FUNCTIONS),
+                ":sort-by-window-days": self.new_window_days(),
+                ":children": children,
+            }
+
+        if step == ":wt-inverse-vol":
+            return {
+                ":id": self.new_id(),
+                ":step": ":wt-inverse-vol",
+                ":window-days": self.new_window_days(),
+                ":children": self.new_distinct_assets(breadth),
+            }
+
+        children = [self.new_node(depth - 1, breadth) for _ in range(breadth)]
+        if step == ":wt-cash-specified":
+            cuts = sorted(self.random.sample(range(1, 100), len(children) - 1))
+            for child, low, high in zip(children, [0] + cuts, cuts + [100]):
+                child[":weight"] = {":num": str(high - low), ":den": 100}
+        return {":id": self.new_id(), ":step": step, ":children": children}
+
+    def generate(self, depth: int, breadth: int, name: str = "Synthetic symphony") -> dict:
+        return {
+            ":id": self.new_id(),
+            ":step": ":root",
+            ":name": name,
+            ":rebalance": ":daily",
+            ":children": [{
+                ":id": self.new_id(),
+                ":step": ":wt-cash-equal",
+                ":children": [self.new_node(depth, breadth)],
+            }],
+        }
+
+
+def generate_symphony(depth: int = 4, breadth: int = 2, tickers: typing.Optional[typing.List[str]] = None, seed: int = 0, node_mix: typing.Optional[typing.Mapping[str, float]] = None) -> dict:
+    return SymphonyGenerator(tickers or generate_tickers(10), seed=seed, node_mix=node_mix).generate(depth, breadth)
+
+
+def convert_root_node_to_edn(root_node: dict) -> str:
+    return edn_format.dumps(edn_syntax.convert_pythonic_to_edn(root_node))
+
+
+def generate_closes(tickers: typing.List[str], days: int = 2520, seed: int = 0, end: str = "2023-06-30") -> pd.DataFrame:
+    """
+    Geometric random walks; every ticker but the first starts at a random point in the first fifth of the range.
+    """
+    rng = np.random.default_rng(seed)
+    index = pd.bdate_range(end=end, periods=days, name="Date")
+    log_returns = rng.normal(0.0003, 0.02, size=(days, len(tickers)))
+    closes = 100 * np.exp(np.cumsum(log_returns, axis=0))
+    for column in range(1, len(tickers)):
+        closes[:rng.integers(0, days // 5), column] = np.nan
+    return pd.DataFrame(closes, index=index, columns=tickers)
+
+
+def main():
+    from . import human
+
+    tickers = generate_tickers(10)
+    root_node = generate_symphony(depth=3, breadth=2, tickers=tickers)
+    print(human.convert_to_pretty_format(root_node))
+    print(convert_root_node_to_edn(root_node)[:500])
+    print(generate_closes(tickers).tail())
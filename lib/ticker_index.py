@@ -0,0 +1,213 @@
+import datetime
+import glob
+import json
+import os
+import typing
+from dataclasses import asdict, dataclass
+
+import numpy as np
+import pandas as pd
+
+from . import atomic_files, get_backtest_data, logic, trading_calendar, traversers
+
+
+#
+# Ticker metadata index, kept next to the price store (data/adj-close_*.csv) in data/ticker_index.json
+# - per ticker: first and last day with a price, days with a price, gaps (more than GAP_DAYS calendar days between two prices),
+#   and average dollar volume
+# - an entry is scanned again when its price file changes (size, mtime), get_backtest_data refreshes the files it downloads
+# - dollar volume is not in the price files: it is seeded from the :dollar_volume snapshots asset nodes carry (seed_dollar_volumes)
+# - earliest backtest day and illiquid tickers come from the entries alone, O(tickers), without reading any price
+#
+INDEX_PATH = "data/ticker_index.json"
+# a long weekend plus a holiday is 4 days without a price
+GAP_DAYS = 4
+# average daily dollar volume under which a ticker is too illiquid to trade into
+MIN_DOLLAR_VOLUME = 5_000_000
+
+
+@dataclass
+class TickerMetadata:
+    ticker: str
+    first_day: typing.Optional[str] = None
+    last_day: typing.Optional[str] = None
+    days: int = 0
+    gaps: int = 0
+    dollar_volume: typing.Optional[float] = None
+    # (size, mtime_ns) of the price file first_day..gaps were scanned from
+    price_file_stamp: typing.Optional[typing.List[int]] = None
+
+
+def get_index_key(ticker: str) -> str:
+    # same name as its price file (get_price_path)
+    return ticker.replace("/", "-")
+
+
+def get_price_file_stamp(ticker: str) -> typing.Optional[typing.List[int]]:
+    path = get_backtest_data.get_price_path(get_index_key(ticker))
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def scan_price_file(ticker: str) -> TickerMetadata:
+    key = get_index_key(ticker)
+    prices = pd.read_csv(get_backtest_data.get_price_path(
+        key), index_col="Date", parse_dates=True).iloc[:, 0].dropna().sort_index()
+    metadata = TickerMetadata(
+        ticker=key, price_file_stamp=get_price_file_stamp(key))
+    if prices.empty:
+        return metadata
+    day_gaps = np.diff(prices.index.values).astype(
+        "timedelta64[D]").astype(np.int64)
+    metadata.first_day = prices.index[0].date().isoformat()
+    metadata.last_day = prices.index[-1].date().isoformat()
+    metadata.days = len(prices)
+    metadata.gaps = int((day_gaps > GAP_DAYS).sum())
+    return metadata
+
+
+class TickerIndex:
+    def __init__(self, entries: typing.Optional[typing.Dict[str, TickerMetadata]] = None):
+        self.entries: typing.Dict[str, TickerMetadata] = entries or {}
+
+    def get(self, ticker: str) -> typing.Optional[TickerMetadata]:
+        return self.entries.get(get_index_key(ticker))
+
+    def refresh(self, tickers: typing.Optional[typing.Iterable[str]] = None) -> typing.List[str]:
+        """
+        Scans the price files of tickers (default: every file in the price store) that changed since their entry. Returns the tickers scanned.
+        """
+        if tickers is None:
+            prefix, suffix = get_backtest_data.get_price_path("*").split("*")
+            tickers = [path[len(prefix):-len(suffix)]
+                       for path in glob.glob(get_backtest_data.get_price_path("*"))]
+        scanned = []
+        for ticker in tickers:
+            key = get_index_key(ticker)
+            stamp = get_price_file_stamp(key)
+            entry = self.entries.get(key)
+            if stamp is None or (entry is not None and entry.price_file_stamp == stamp):
+                continue
+            metadata = scan_price_file(key)
+            if entry is not None:
+                metadata.dollar_volume = entry.dollar_volume
+            self.entries[key] = metadata
+            scanned.append(key)
+        return scanned
+
+    def seed_dollar_volumes(self, root_nodes: typing.Iterable[dict]):
+        """
+        Average of the :dollar_volume snapshots of every asset node, per ticker, replacing what the entries had.
+        """
+        snapshots: typing.Dict[str, typing.List[float]] = {}
+        for root_node in root_nodes:
+            for node in traversers.collect_nodes_of_type(":asset", root_node):
+                if node.get(":dollar_volume") is not None:
+                    snapshots.setdefault(get_index_key(logic.get_ticker_of_asset_node(
+                        node)), []).append(float(node[":dollar_volume"]))
+        for key, dollar_volumes in snapshots.items():
+            entry = self.entries.setdefault(key, TickerMetadata(ticker=key))
+            entry.dollar_volume = float(np.mean(dollar_volumes))
+
+    def get_founded_day(self, ticker: str) -> typing.Optional[datetime.date]:
+        entry = self.get(ticker)
+        if entry is None or entry.first_day is None:
+            return None
+        return datetime.date.fromisoformat(entry.first_day)
+
+    def get_newest_day(self) -> typing.Optional[datetime.date]:
+        """
+        Last day of the most recent prices in the store.
+        """
+        last_days = [entry.last_day for entry in self.entries.values()
+                     if entry.last_day is not None]
+        return datetime.date.fromisoformat(max(last_days)) if last_days else None
+
+    def get_earliest_backtest_day(self, tickers: typing.Iterable[str]) -> typing.Tuple[typing.Optional[datetime.date], typing.Optional[str]]:
+        """
+        (first day every ticker has a price, the ticker that has it last), (None, None) if a ticker has no prices in the index.
+        """
+        latest_day, latest_ticker = None, None
+        for ticker in sorted(tickers):
+            founded_day = self.get_founded_day(ticker)
+            if founded_day is None:
+                return None, None
+            if latest_day is None or founded_day > latest_day:
+                latest_day, latest_ticker = founded_day, ticker
+        return latest_day, latest_ticker
+
+    def get_illiquid_tickers(self, tickers: typing.Iterable[str], min_dollar_volume: float = MIN_DOLLAR_VOLUME) -> typing.Dict[str, str]:
+        """
+        Reason by ticker, for tickers trading less than min_dollar_volume a day (unknown dollar volumes are not flagged).
+        """
+        illiquid = {}
+        for ticker in sorted(tickers):
+            entry = self.get(ticker)
+            if entry is not None and entry.dollar_volume is not None and entry.dollar_volume < min_dollar_volume:
+                illiquid[ticker] = f"Volume is too low (${entry.dollar_volume:,.0f} a day)"
+        return illiquid
+
+    def get_first_complete_position(self, closes: pd.DataFrame, tickers: typing.Iterable[str]) -> int:
+        """
+        trading_calendar.get_first_complete_position of closes[tickers], for closes from the price store:
+        the day the last founded ticker starts, checked against that row and the one before, O(tickers).
+        Falls back to scanning closes if the index does not describe them (unknown tickers, other data).
+        """
+        tickers = list(tickers)
+        columns = closes.columns.get_indexer(tickers)
+        earliest_day, latest_ticker = self.get_earliest_backtest_day(tickers)
+        if earliest_day is not None and (columns >= 0).all():
+            position = trading_calendar.TradingCalendar(
+                closes.index).get_position(earliest_day)
+            if position < len(closes) and closes.index[position].date() == earliest_day \
+                    and not pd.isna(closes.iloc[position, columns]).any() \
+                    and (position == 0 or pd.isna(closes.iloc[position - 1, closes.columns.get_loc(latest_ticker)])):
+                return position
+        return trading_calendar.get_first_complete_position(closes[tickers])
+
+    def to_dict(self) -> dict:
+        return {key: asdict(entry) for key, entry in sorted(self.entries.items())}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "TickerIndex":
+        return cls({key: TickerMetadata(**entry) for key, entry in data.items()})
+
+    def save(self, path: str = INDEX_PATH):
+        # get_backtest_data saves it from --workers processes
+        with atomic_files.open_replacing(path) as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    @classmethod
+    def load(cls, path: str = INDEX_PATH) -> "TickerIndex":
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+def update_index(tickers: typing.Optional[typing.Iterable[str]] = None, root_nodes: typing.Optional[typing.Iterable[dict]] = None, path: str = INDEX_PATH) -> TickerIndex:
+    """
+    Loads the index, refreshes the entries of tickers (default: the whole price store) and seeds dollar volumes from root_nodes, saves it if anything changed.
+    """
+    ticker_index = TickerIndex.load(path)
+    changed = bool(ticker_index.refresh(tickers))
+    if root_nodes is not None:
+        before = ticker_index.to_dict()
+        ticker_index.seed_dollar_volumes(root_nodes)
+        changed = changed or ticker_index.to_dict() != before
+    if changed:
+        ticker_index.save(path)
+    return ticker_index
+
+
+def main():
+    import time
+
+    ticker_index = TickerIndex.load()
+    start = time.perf_counter()
+    scanned = ticker_index.refresh()
+    print(f"scanned {len(scanned)} price files in {time.perf_counter() - start:.2f}s")
+    for entry in list(ticker_index.entries.values())[:10]:
+        print(entry)
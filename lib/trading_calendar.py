@@ -0,0 +1,88 @@
+import datetime
+import typing
+
+import numpy as np
+import pandas as pd
+
+
+#
+# Trading calendar: one integer day axis (positions in a sorted DatetimeIndex, usually the closes')
+# - trimming and alignment are integer slices and takes on numpy arrays, instead of `frame[frame.index.date >= start]`
+#   (an object array of Python dates per filter), reindex_like and `dropna().index.min()` scans
+# - start offsets (first day a ticker, indicator or allocation row is complete) are computed once, vectorized
+# - a DatetimeIndex is only attached again at the output boundary (frames handed back to callers)
+#
+Day = typing.Union[datetime.date, pd.Timestamp, np.datetime64, str]
+
+
+def get_values(frame: typing.Union[pd.DataFrame, pd.Series, np.ndarray]) -> np.ndarray:
+    return frame if isinstance(frame, np.ndarray) else frame.to_numpy()
+
+
+def get_first_valid_positions(frame: typing.Union[pd.DataFrame, np.ndarray]) -> np.ndarray:
+    """
+    Per column, position of its first non-NaN day (len if it has none): start offsets of tickers or indicators.
+    """
+    valid = ~pd.isna(get_values(frame))
+    return np.where(valid.any(axis=0), valid.argmax(axis=0), len(valid))
+
+
+def get_first_complete_position(frame: typing.Union[pd.DataFrame, np.ndarray]) -> int:
+    """
+    Position of the first day without any NaN (len if there is none), like `frame.dropna().index.min()`.
+    """
+    values = get_values(frame)
+    if values.ndim == 1:
+        values = values[:, None]
+    complete = ~pd.isna(values).any(axis=1)
+    return int(complete.argmax()) if complete.any() else len(complete)
+
+
+class TradingCalendar:
+    def __init__(self, index: pd.Index):
+        self.index = pd.DatetimeIndex(index, name="Date")
+        self.days = self.index.values
+        assert self.index.is_monotonic_increasing, "calendar days must be sorted"
+
+    def __len__(self) -> int:
+        return len(self.days)
+
+    def get_position(self, day: Day) -> int:
+        """
+        Position of the first calendar day on or after day, whatever its time (same days as `index.date >= day`).
+        """
+        return int(self.days.searchsorted(pd.Timestamp(day).normalize().to_datetime64(), side="left"))
+
+    def get_positions(self, index: pd.Index) -> np.ndarray:
+        """
+        Calendar positions of index's days, -1 for days the calendar does not have.
+        """
+        days = pd.DatetimeIndex(index).values
+        positions = self.days.searchsorted(days)
+        found = positions < len(self.days)
+        found[found] = self.days[positions[found]] == days[found]
+        return np.where(found, positions, -1)
+
+    def get_day(self, position: int) -> typing.Optional[pd.Timestamp]:
+        return self.index[position] if position < len(self.index) else None
+
+    def take(self, frame: pd.DataFrame, index: pd.Index, columns: typing.Optional[typing.Sequence[str]] = None) -> np.ndarray:
+        """
+        frame's values (frame is on this calendar) on index's days, NaN on days it does not have: frame.reindex(index) as an array.
+        """
+        values = get_values(frame if columns is None else frame[list(columns)]).astype(np.float64, copy=False)
+        positions = self.get_positions(index)
+        taken = values.take(np.maximum(positions, 0), axis=0)
+        taken[positions < 0] = np.nan
+        return taken
+
+
+def main():
+    index = pd.bdate_range("2023-01-02", periods=6, name="Date")
+    closes = pd.DataFrame({"SPY": [1.0, 2, 3, 4, 5, 6], "NEW": [
+                          np.nan, np.nan, 3, 4, 5, 6]}, index=index)
+    calendar = TradingCalendar(closes.index)
+    print(get_first_valid_positions(closes), get_first_complete_position(closes))
+    print(calendar.get_position(datetime.date(2023, 1, 4)),
+          calendar.get_position("2023-01-07"))
+    print(calendar.take(closes, index[::2].append(pd.DatetimeIndex(["2024-01-01"]))))
@@ -1,12 +1,17 @@
 import abc
+import functools
 import typing
 
+import numpy as np
 import pandas as pd
 import pandas_ta
 import vectorbt as vbt
 
-from . import human, vectorbt, traversers
+from . import code_cache, human, instrumentation, subtrees, trading_calendar, vectorbt, traversers
+from .branch_tracker import BranchTracker
+from .sparse_allocations import SparseAllocations
 
+BACKTEST_FEES = 0.0005
 
 class Transpiler():
     @abc.abstractstaticmethod
@@ -49,74 +54,140 @@ def precompute_indicator(close_series: pd.Series, indicator: str, window_days: i
             "Have not implemented indicator " + indicator)
 
 
+def precompute_indicator_cached(indicator_cache: dict, close_series: pd.Series, indicator: str, window_days: int):
+    # indicators only depend on the ticker's own closes, whichever symphony (or subtree) asks for them
+    key = (close_series.name, indicator, window_days, close_series.count(),
+           close_series.first_valid_index(), close_series.last_valid_index())
+    if key not in indicator_cache:
+        indicator_cache[key] = precompute_indicator(
+            close_series, indicator, window_days)
+    return indicator_cache[key]
+
+
 class VectorBTTranspiler():
     @staticmethod
     def convert_to_string(root_node: dict) -> str:
         return vectorbt.convert_to_vectorbt(root_node)
 
     @staticmethod
-    def execute(root_node: dict, closes: pd.DataFrame) -> typing.Tuple[pd.DataFrame, pd.DataFrame]:
-        code = VectorBTTranspiler.convert_to_string(root_node)
+    def build_allocations_matrix(root_node: dict, closes: pd.DataFrame, profiler=None, subtree_cache: typing.Optional[subtrees.SubtreeCache] = None, indicator_cache: typing.Optional[dict] = None, days: typing.Optional[pd.DatetimeIndex] = None) -> typing.Tuple[pd.DataFrame, BranchTracker]:
+        """
+        Runs the generated code, allocations for every day all indicators are available (no alignment).
+        indicator_cache (defaults to subtree_cache's) memoizes indicators across calls on the same closes.
+        days: only evaluate those, the other days have no allocations or branches.
+        """
+        slots_by_node_id, subtree_uses = {}, []
+        # profiling needs every node evaluated in place
+        if subtree_cache is not None and profiler is None:
+            slots_by_node_id, subtree_uses = subtree_cache.prepare(
+                root_node, closes, vectorbt.get_branch_ids(root_node))
+            if indicator_cache is None:
+                indicator_cache = subtree_cache.indicator_cache
+        indicator_function = precompute_indicator
+        if indicator_cache is not None and profiler is None:
+            indicator_function = functools.partial(
+                precompute_indicator_cached, indicator_cache)
+
+        code = code_cache.get_compiled_symphony(
+            root_node, profile=profiler is not None, subtree_slots=slots_by_node_id)
         locs = {}
-        exec(code, {
-            "pd": pd,
-            "precompute_indicator": precompute_indicator,
-        }, locs)
+        with instrumentation.span("exec", category="exec"):
+            exec(code, {
+                "pd": pd,
+                "precompute_indicator": indicator_function,
+                "BranchTracker": BranchTracker,
+                "apply_subtree_uses": subtrees.apply_subtree_uses,
+                "profiler": profiler,
+            }, locs)
         build_allocations_matrix = locs['build_allocations_matrix']
 
-        allocations, branch_tracker = build_allocations_matrix(closes)
+        with instrumentation.span("build_allocations_matrix", category="exec", items=len(closes)):
+            return build_allocations_matrix(closes, subtree_uses, days=days)
+
+    @staticmethod
+    def execute(root_node: dict, closes: pd.DataFrame, profiler=None, subtree_cache: typing.Optional[subtrees.SubtreeCache] = None, ticker_index=None) -> typing.Tuple[pd.DataFrame, BranchTracker]:
+        """
+        Pass a profiler.SymphonyProfiler to record per-node timings, hit counts and allocations (slower).
+        Pass a subtrees.SubtreeCache to evaluate subtrees shared with other symphonies only once.
+        Pass a ticker_index.TickerIndex (for closes from the price store) to find the backtest start from first days instead of scanning closes.
+        """
+        allocations, branch_tracker = VectorBTTranspiler.build_allocations_matrix(
+            root_node, closes, profiler=profiler, subtree_cache=subtree_cache)
+        return VectorBTTranspiler.trim_allocations(root_node, closes, allocations, branch_tracker, ticker_index=ticker_index)
 
+    @staticmethod
+    def trim_allocations(root_node: dict, closes: pd.DataFrame, allocations: pd.DataFrame, branch_tracker: BranchTracker, ticker_index=None) -> typing.Tuple[pd.DataFrame, BranchTracker]:
+        """
+        execute's allocations from build_allocations_matrix's: only allocateable tickers, from the first day they all have prices.
+        """
         allocateable_tickers = traversers.collect_allocateable_assets(
             root_node)
 
-        # remove tickers that were never intended for allocation
-        for reference_only_ticker in [c for c in allocations.columns if c not in allocateable_tickers]:
-            del allocations[reference_only_ticker]
-
-        allocations_possible_start = closes[list(
-            allocateable_tickers)].dropna().index.min().date()
-        allocations = allocations[allocations.index.date >=
-                                  allocations_possible_start]
+        # remove tickers that were never intended for allocation (a new frame, allocations is left as it was)
+        allocations = allocations.drop(
+            columns=[c for c in allocations.columns if c not in allocateable_tickers])
+
+        # allocations (and branch_tracker) are on the days every indicator is available, a subset of closes' days
+        if ticker_index is not None:
+            first_complete_position = ticker_index.get_first_complete_position(
+                closes, allocateable_tickers)
+        else:
+            first_complete_position = trading_calendar.get_first_complete_position(
+                closes[list(allocateable_tickers)])
+        allocations_possible_start = trading_calendar.TradingCalendar(
+            closes.index).get_day(first_complete_position)
+        calendar = trading_calendar.TradingCalendar(allocations.index)
+        start = calendar.get_position(
+            allocations_possible_start) if allocations_possible_start is not None else len(calendar)
 
         # aligning
-        backtest_start = allocations.dropna().index.min().date()
-        allocations = allocations[allocations.index.date >=
-                                  backtest_start]
-        branch_tracker = branch_tracker[branch_tracker.index.date >=
-                                        backtest_start]
+        start += trading_calendar.get_first_complete_position(
+            allocations.iloc[start:])
+        allocations = allocations.iloc[start:]
+        branch_tracker = branch_tracker.slice_days(start)
 
         return allocations, branch_tracker
 
     @staticmethod
-    def extract_branches_with_incorrect_allocations(allocations, branch_tracker):
-        branches_by_failed_allocation_days = branch_tracker[(
-            allocations.sum(axis=1) - 1).abs() > 0.0001].sum(axis=0)
+    def extract_branches_with_incorrect_allocations(allocations, branch_tracker: typing.Union[BranchTracker, pd.DataFrame]):
+        if isinstance(branch_tracker, pd.DataFrame):
+            branch_tracker = BranchTracker.from_frame(branch_tracker)
+        allocation_sums = allocations.row_sums() if isinstance(
+            allocations, SparseAllocations) else allocations.sum(axis=1)
+        failed_allocation_days = ((allocation_sums - 1).abs() > 0.0001).reindex(
+            branch_tracker.index, fill_value=False)
+        branches_by_failed_allocation_days = branch_tracker.filter_days(
+            failed_allocation_days.to_numpy()).counts()
         return branches_by_failed_allocation_days[
             branches_by_failed_allocation_days != 0].index.values
 
     @staticmethod
     def get_returns(closes, allocations, branch_tracker) -> pd.Series:
-        backtest_start = allocations.dropna().index.min().date()
+        start = trading_calendar.get_first_complete_position(allocations)
 
         assert not len(VectorBTTranspiler.extract_branches_with_incorrect_allocations(
             allocations, branch_tracker)), "found incomplete allocations (!= 100%)"
 
         # VectorBT
-        closes_aligned = closes[closes.index.date >=
-                                backtest_start].reindex_like(allocations)
-        portfolio = vbt.Portfolio.from_orders(
-            close=closes_aligned,
-            size=allocations,
-            size_type="targetpercent",
-            group_by=True,
-            cash_sharing=True,
-            call_seq="auto",
-            freq='D',
-            fees=0.0005,
-        )
-        returns = portfolio.asset_returns()
+        closes_aligned = trading_calendar.TradingCalendar(closes.index).take(
+            closes, allocations.index, allocations.columns)
+        closes_aligned[:start] = np.nan
+        closes_aligned = pd.DataFrame(
+            closes_aligned, index=allocations.index, columns=allocations.columns)
+        with instrumentation.span("vectorbt_simulation", category="vectorbt", items=1):
+            portfolio = vbt.Portfolio.from_orders(
+                close=closes_aligned,
+                size=allocations,
+                size_type="targetpercent",
+                group_by=True,
+                cash_sharing=True,
+                call_seq="auto",
+                freq='D',
+                fees=BACKTEST_FEES,
+            )
+            returns = portfolio.asset_returns()
         # for some reason, the first entry is -inf, breaks some stats
-        returns = returns.drop(index=backtest_start)
+        returns = returns.drop(index=returns.index[start])
         return returns
 
 
@@ -141,20 +212,19 @@ def main():
     allocations, branch_tracker = VectorBTTranspiler.execute(
         root_node, closes)
 
-    backtest_start = allocations.dropna().index.min().date()
-
-    allocations_aligned = allocations[allocations.index.date >= backtest_start]
-    branch_tracker_aligned = branch_tracker[branch_tracker.index.date >= backtest_start]
+    # already aligned by execute
+    start = trading_calendar.get_first_complete_position(allocations)
+    allocations_aligned = allocations.iloc[start:]
+    branch_tracker_aligned = branch_tracker.slice_days(start)
 
     assert len(allocations_aligned) == len(branch_tracker_aligned)
 
     print(allocations_aligned[(
         allocations_aligned.sum(axis=1) - 1).abs() > 0.0001])
-    branches_by_failed_allocation_days = branch_tracker_aligned[(
-        allocations_aligned.sum(axis=1) - 1).abs() > 0.0001].sum(axis=0)
-    branches_with_failed_allocation_days = branches_by_failed_allocation_days[
-        branches_by_failed_allocation_days != 0].index.values
+    branches_with_failed_allocation_days = VectorBTTranspiler.extract_branches_with_incorrect_allocations(
+        allocations_aligned, branch_tracker_aligned)
 
     for branch_id in branches_with_failed_allocation_days:
         print(f"  -> id={branch_id}")
-        print(allocations_aligned[branch_tracker_aligned[branch_id] == 1])
+        print(allocations_aligned[branch_tracker_aligned.get_branch(
+            branch_id).to_numpy() == 1])
@@ -138,9 +138,25 @@ def collect_indicators(node, parent_node_branch_state=None) -> typing.List[dict]
     return indicators
 
 
+def get_condition_key(node) -> str:
+    """
+    (lhs indicator, comparator, rhs) of a conditional :if-child, equal for conditions that always evaluate the same
+    """
+    lhs_indicator = extract_lhs_indicator(node)
+    lhs_key = human.pretty_indicator(
+        lhs_indicator['fn'], lhs_indicator['val'], lhs_indicator['window-days'])
+    rhs_indicator = extract_rhs_indicator(node)
+    if rhs_indicator:
+        rhs_key = human.pretty_indicator(
+            rhs_indicator['fn'], rhs_indicator['val'], rhs_indicator['window-days'])
+    else:
+        rhs_key = str(node[':rhs-val'])
+    return f"{lhs_key} {node[':comparator']} {rhs_key}"
+
+
 def collect_conditions(node) -> typing.List[dict]:
     """
-    Collects :if-child conditions used
+    Collects :if-child conditions used (one entry per occurrence, see `intern_conditions` for distinct ones)
     """
 
     conditions = []
@@ -149,6 +165,7 @@ def collect_conditions(node) -> typing.List[dict]:
         del copy_node[":children"]
         del copy_node[":step"]
         copy_node["pretty_text"] = human.pretty_condition(node)
+        copy_node["condition_key"] = get_condition_key(node)
         conditions.append(copy_node)
 
     for child in logic.get_node_children(node):
@@ -156,6 +173,26 @@ def collect_conditions(node) -> typing.List[dict]:
     return conditions
 
 
+def intern_conditions(node) -> typing.List[dict]:
+    """
+    Distinct conditions in order of first use, with how many :if-child nodes reference each (and which).
+    The generated code computes each one once, as a boolean column (see vectorbt.get_condition_numbers).
+    """
+    interned_by_key = {}
+    for condition in collect_conditions(node):
+        key = condition["condition_key"]
+        if key not in interned_by_key:
+            interned_by_key[key] = {
+                "condition_key": key,
+                "pretty_text": condition["pretty_text"],
+                "references": 0,
+                "ids": [],
+            }
+        interned_by_key[key]["references"] += 1
+        interned_by_key[key]["ids"].append(condition[":id"])
+    return list(interned_by_key.values())
+
+
 def collect_terminal_branch_paths(node, parent_node_branch_state: typing.Optional[logic.NodeBranchState] = None) -> typing.Set[str]:
     if not parent_node_branch_state:
         # current node is :root, there is no higher node
@@ -272,3 +309,6 @@ def main():
         ":wt-inverse-vol", root_node), "Inverse volatility weighting is not supported."
     assert not collect_nodes_of_type(
         ":wt-marketcap", root_node), "Market cap weighting is not supported."
+
+    for condition in intern_conditions(root_node):
+        print(f"{condition['references']}x {condition['pretty_text']}")
@@ -3,6 +3,9 @@ import json
 import typing
 from . import traversers, manual_testing, logic, human
 
+# bump whenever generated code changes, invalidates code_cache entries
+TRANSPILER_VERSION = 5
+
 
 def extract_indicator_key_from_indicator(indicator):
     return human.pretty_indicator(indicator['fn'], indicator['val'], indicator['window-days'])
@@ -28,10 +31,18 @@ def get_code_to_reference_indicator(indicator) -> str:
     return f"indicators.at[row, '{key}']"
 
 
-def express_condition(child_node) -> str:
+def get_code_to_reference_indicator_column(indicator) -> str:
+    key = extract_indicator_key_from_indicator(indicator)
+    return f"indicators['{key}']"
+
+
+def express_condition(child_node, reference_indicator: typing.Callable[[dict], str] = get_code_to_reference_indicator) -> str:
+    """
+    Python expression of the :if-child's condition, on one row (default) or on whole columns (get_code_to_reference_indicator_column)
+    """
     lhs_indicator = traversers.extract_lhs_indicator(
         child_node)
-    lhs_expression = get_code_to_reference_indicator(
+    lhs_expression = reference_indicator(
         lhs_indicator)
 
     rhs_indicator = traversers.extract_rhs_indicator(
@@ -39,20 +50,43 @@ def express_condition(child_node) -> str:
     if not rhs_indicator:
         rhs_expression = f"{child_node[':rhs-val']}"
     else:
-        rhs_expression = get_code_to_reference_indicator(
+        rhs_expression = reference_indicator(
             rhs_indicator)
 
     return f"{lhs_expression} {express_comparator_in_python(child_node[':comparator'])} {rhs_expression}"
 
 
-def print_python_logic(node, parent_node_branch_state: typing.Optional[logic.NodeBranchState] = None, indent: int = 0, indent_size: int = 4, file=None):
+def get_branch_ids(root_node) -> typing.List[str]:
+    """
+    Leaf :if-child ids (or the root id), in branch tracker bit order
+    """
+    return sorted(key.split("/")[-1] for key in traversers.collect_branches(root_node).keys())
+
+
+def get_condition_numbers(root_node) -> typing.Dict[str, int]:
+    """
+    condition_<n> column number of each distinct condition (by traversers.get_condition_key)
+    """
+    return {condition["condition_key"]: n for n, condition in enumerate(traversers.intern_conditions(root_node))}
+
+
+def print_python_logic(node, parent_node_branch_state: typing.Optional[logic.NodeBranchState] = None, indent: int = 0, indent_size: int = 4, file=None, profile: bool = False, branch_bits: typing.Optional[typing.Mapping[str, int]] = None, subtree_slots: typing.Optional[typing.Mapping[str, int]] = None, condition_numbers: typing.Optional[typing.Mapping[str, int]] = None):
     """
     Traverses tree and prints out python code for populating allocations dataframe.
+
+    profile=True also emits calls to a `profiler` (see profiler.SymphonyProfiler) to time and count each node.
+    subtree_slots: node ids of shared subtrees (see subtrees.SubtreeCache), only their visits are recorded.
     """
     if not parent_node_branch_state:
         # current node is :root, there is no higher node
         parent_node_branch_state = logic.build_node_branch_state_from_root_node(
             node)
+        branch_bits = branch_bits or {
+            branch_id: bit for bit, branch_id in enumerate(get_branch_ids(node))}
+        condition_numbers = condition_numbers or get_condition_numbers(node)
+    branch_bits = typing.cast(typing.Mapping[str, int], branch_bits)
+    condition_numbers = typing.cast(
+        typing.Mapping[str, int], condition_numbers)
     parent_node_branch_state = typing.cast(
         logic.NodeBranchState, parent_node_branch_state)
 
@@ -62,31 +96,52 @@ def print_python_logic(node, parent_node_branch_state: typing.Optional[logic.Nod
     def indented_print(msg: str, indent_offset=0):
         print((" " * indent_size * (indent + indent_offset)) + msg, file=file)
 
+    if subtree_slots and node[':id'] in subtree_slots:
+        # evaluated once for every symphony sharing it, added in after the day loop
+        indented_print(
+            f"subtree_visits[{subtree_slots[node[':id']]}].append((position, {current_node_branch_state.weight}))")
+        return
+
     # :wt-cash-equally and :wt-cash-specified is handled by logic.advance_branch_state logic for us
     # TODO: Weight inverse by volatility (similar approach to :filter)
     # TODO: weight by market cap dynamically, how to get data?
 
     if logic.is_if_node(node):
+        if profile:
+            indented_print(f"profiler.enter('{node[':id']}')")
         for i, child_node in enumerate(logic.get_node_children(node)):
+            # conditions are precomputed columns, one per distinct condition
             if i == 0:
-                indented_print(f"if {express_condition(child_node)}:")
+                indented_print(
+                    f"if condition_{condition_numbers[traversers.get_condition_key(child_node)]}[position]:")
             elif logic.is_conditional_node(child_node):
-                indented_print(f"elif {express_condition(child_node)}:")
+                indented_print(
+                    f"elif condition_{condition_numbers[traversers.get_condition_key(child_node)]}[position]:")
             else:
                 indented_print("else:")
+            if profile:
+                indented_print(
+                    f"profiler.hit('{child_node[':id']}')", indent_offset=1)
             print_python_logic(
-                child_node, parent_node_branch_state=current_node_branch_state, indent=indent+1, indent_size=indent_size, file=file)
+                child_node, parent_node_branch_state=current_node_branch_state, indent=indent+1, indent_size=indent_size, file=file, profile=profile, branch_bits=branch_bits, subtree_slots=subtree_slots, condition_numbers=condition_numbers)
+        if profile:
+            indented_print(f"profiler.exit('{node[':id']}')")
         return
     elif logic.is_asset_node(node):
         indented_print(
-            f"branch_tracker.at[row, '{current_node_branch_state.branch_path_ids[-1]}'] = 1")
+            f"active_branches |= {1 << branch_bits[current_node_branch_state.branch_path_ids[-1]]}")
         indented_print(
             f"allocations.at[row, '{logic.get_ticker_of_asset_node(node)}'] += {current_node_branch_state.weight}")
+        if profile:
+            indented_print(
+                f"profiler.allocate('{node[':id']}', {current_node_branch_state.weight})")
     elif logic.is_group_node(node):
         indented_print(f"# {node[':name']}")
     elif logic.is_filter_node(node):
+        if profile:
+            indented_print(f"profiler.enter('{node[':id']}')")
         indented_print(
-            f"branch_tracker.at[row, '{current_node_branch_state.branch_path_ids[-1]}'] = 1")
+            f"active_branches |= {1 << branch_bits[current_node_branch_state.branch_path_ids[-1]]}")
 
         indented_print(f"entries = [")
         for filter_indicator in traversers.extract_filter_indicators(node):
@@ -103,6 +158,10 @@ def print_python_logic(node, parent_node_branch_state: typing.Optional[logic.Nod
             current_node_branch_state, logic.get_node_children(node)[0]).weight
         indented_print(
             f"allocations.at[row, ticker] += {weight}", indent_offset=1)
+        if profile:
+            indented_print(
+                f"profiler.allocate('{node[':id']}', {weight}, ticker)", indent_offset=1)
+            indented_print(f"profiler.exit('{node[':id']}')")
 
         # Debugging
         # indented_print(
@@ -110,8 +169,10 @@ def print_python_logic(node, parent_node_branch_state: typing.Optional[logic.Nod
 
         return
     elif logic.is_weight_inverse_volatility_node(node):
+        if profile:
+            indented_print(f"profiler.enter('{node[':id']}')")
         indented_print(
-            f"branch_tracker.at[row, '{current_node_branch_state.branch_path_ids[-1]}'] = 1")
+            f"active_branches |= {1 << branch_bits[current_node_branch_state.branch_path_ids[-1]]}")
         indented_print(f"entries = [")
         for indicator in traversers.extract_inverse_volatility_indicators(node):
             fmt = extract_indicator_key_from_indicator(indicator)
@@ -126,46 +187,67 @@ def print_python_logic(node, parent_node_branch_state: typing.Optional[logic.Nod
             current_node_branch_state, logic.get_node_children(node)[0]).weight
         indented_print(
             f"allocations.at[row, ticker] += {weight} * (inverse_volatility / overall_inverse_volatility)", indent_offset=1)
+        if profile:
+            indented_print(
+                f"profiler.allocate('{node[':id']}', {weight} * (inverse_volatility / overall_inverse_volatility), ticker)", indent_offset=1)
+            indented_print(f"profiler.exit('{node[':id']}')")
 
         return
 
     for child_node in logic.get_node_children(node):
         print_python_logic(
-            child_node, parent_node_branch_state=current_node_branch_state, indent=indent, indent_size=indent_size, file=file)
+            child_node, parent_node_branch_state=current_node_branch_state, indent=indent, indent_size=indent_size, file=file, profile=profile, branch_bits=branch_bits, subtree_slots=subtree_slots, condition_numbers=condition_numbers)
 
 
-def convert_to_vectorbt(root_node) -> str:
+def convert_to_vectorbt(root_node, profile: bool = False, subtree_slots: typing.Optional[typing.Mapping[str, int]] = None) -> str:
     assert not traversers.collect_nodes_of_type(
         ":wt-marketcap", root_node), "Market cap weighting is not supported."
 
     output = io.StringIO()
-    _convert_to_vectorbt(root_node, file=output)
+    _convert_to_vectorbt(root_node, file=output,
+                         profile=profile, subtree_slots=subtree_slots)
     text = output.getvalue()
     output.close()
     return text
 
 
-def _convert_to_vectorbt(root_node, file=None):
+def _convert_to_vectorbt(root_node, file=None, profile: bool = False, subtree_slots: typing.Optional[typing.Mapping[str, int]] = None):
     def write(*msgs):
         print(*msgs, file=file)
 
     write(f"""
 
-def build_allocations_matrix(closes):
+def build_allocations_matrix(closes, subtree_uses=None, days=None):
     indicators = pd.DataFrame(index=closes.index)
 """)
     for indicator in traversers.collect_indicators(root_node):
-        write(
-            f"    indicators['{extract_indicator_key_from_indicator(indicator)}'] = precompute_indicator(closes['{indicator['val']}'], '{indicator['fn']}', {indicator['window-days']})")
+        key = extract_indicator_key_from_indicator(indicator)
+        if profile:
+            write(
+                f"    indicators['{key}'] = profiler.precompute_indicator('{key}', closes['{indicator['val']}'], '{indicator['fn']}', {indicator['window-days']})")
+        else:
+            write(
+                f"    indicators['{key}'] = precompute_indicator(closes['{indicator['val']}'], '{indicator['fn']}', {indicator['window-days']})")
     write("""
     # If any indicator is not available, we cannot compute that day
     # (assumes all na's stop at some point and then are continuously available into the future, no skips)
     indicators.dropna(axis=0, inplace=True)
     """)
 
-    branches_by_path = traversers.collect_branches(root_node)
-    branches_by_leaf_node_id = {
-        key.split("/")[-1]: value for key, value in branches_by_path.items()}
+    condition_numbers = get_condition_numbers(root_node)
+    write("""
+    #
+    # Conditions, each distinct one computed once for every day (see traversers.intern_conditions)
+    #""")
+    if_child_nodes_by_id = {node[":id"]: node for node in traversers.collect_nodes_of_type(
+        ":if-child", root_node)}
+    for condition in traversers.intern_conditions(root_node):
+        # any :if-child with this key has the same condition
+        child_node = if_child_nodes_by_id[condition["ids"][0]]
+        write(
+            f"    condition_{condition_numbers[condition['condition_key']]} = ({express_condition(child_node, get_code_to_reference_indicator_column)}).tolist()  # referenced {condition['references']}x")
+
+    branch_ids = get_branch_ids(root_node)
     write(f"""
     #
     # Algorithm Logic and instrumentation
@@ -173,14 +255,31 @@ def build_allocations_matrix(closes):
     allocations = pd.DataFrame(index=indicators.index, columns=closes.columns).fillna(0.0)
 
     # Track branch usage based on :id of "leaf" condition (closest :if-child up the tree to that leaf node)
-    branch_tracker = pd.DataFrame(index=indicators.index, columns={repr(sorted(branches_by_leaf_node_id.keys()))}).fillna(0)
-
-    for row in indicators.index:
+    # one int bitset per day, bit i is branch_ids[i] (see branch_tracker.BranchTracker)
+    branch_ids = {repr(branch_ids)}
+    branch_rows = [0] * len(indicators.index)
+    # (row position, weight) of each day a shared subtree is reached, see subtrees.apply_subtree_uses
+    subtree_visits = [[] for _ in range({len(subtree_slots or {})})]
+
+    # days: only evaluate those (see lineage.evaluate_lineage), the others are left without allocations or branches
+    positions = range(len(indicators.index)) if days is None else [position for position in indicators.index.get_indexer(days) if position >= 0]
+    for position in positions:
+        row = indicators.index[position]
+        active_branches = 0
     """)
+    if profile:
+        write("        profiler.day()")
 
-    print_python_logic(root_node, indent=2, indent_size=4, file=file)
+    print_python_logic(root_node, indent=2, indent_size=4,
+                       file=file, profile=profile, branch_bits={branch_id: bit for bit, branch_id in enumerate(branch_ids)}, subtree_slots=subtree_slots, condition_numbers=condition_numbers)
 
     write("""
+        branch_rows[position] = active_branches
+
+    if subtree_uses:
+        allocations = apply_subtree_uses(allocations, branch_rows, subtree_visits, subtree_uses)
+
+    branch_tracker = BranchTracker.from_int_rows(indicators.index, branch_ids, branch_rows)
     return allocations, branch_tracker
     """)
 
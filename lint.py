@@ -0,0 +1,40 @@
+import argparse
+import json
+import time
+
+import pandas as pd
+
+from lib import batch_backtest, linter, symphony_object, ticker_index
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Earliest backtest date and ticker warnings (illiquid, stale, gaps, no prices) of cached symphonies, from the ticker index instead of price data')
+    parser.add_argument('symphony_ids', nargs='*',
+                        help='symphony ids to lint (default: every cached symphony in outputs/symphonies)')
+    parser.add_argument('-o', '--outfile', dest='outfile', default='outputs/lint.csv',
+                        help='csv of (symphony_id, earliest_backtest_date, latest_founded_ticker, warnings)')
+    args = parser.parse_args()
+
+    root_nodes_by_id = {}
+    for symphony_id in args.symphony_ids or symphony_object.get_cached_symphony_ids():
+        try:
+            symphony = json.load(
+                open(f'outputs/symphonies/{symphony_id}/symphony.json'))
+        except FileNotFoundError:
+            continue
+        root_nodes_by_id[symphony_id] = symphony_object.extract_root_node_from_symphony_response(
+            symphony)
+
+    start = time.perf_counter()
+    # only price files that changed since they were indexed are read
+    index = ticker_index.update_index(batch_backtest.collect_universe(
+        root_nodes_by_id), root_nodes_by_id.values())
+    rows = linter.lint_symphonies(root_nodes_by_id, index)
+    pd.DataFrame(rows, columns=["symphony_id", "earliest_backtest_date", "latest_founded_ticker", "warnings"]).to_csv(
+        args.outfile, index=False)
+    print(f"{len(rows)} symphonies linted, {sum(1 for row in rows if row['warnings'])} with warnings in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+import argparse
+import json
+
+import pandas as pd
+
+from lib import parity, symphony_object
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare local allocations against Composer backtests for cached symphonies')
+    parser.add_argument('symphony_ids', nargs='*',
+                        help='symphony ids to check (default: every cached symphony in outputs/symphonies)')
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=None,
+                        help='worker processes (default: one per cpu)')
+    parser.add_argument('-t', '--tolerance', dest='tolerance', type=float, default=parity.DEFAULT_TOLERANCE,
+                        help='max allowed absolute weight difference per ticker per day')
+    parser.add_argument('--online', dest='online', action='store_true', default=False,
+                        help='post uncached backtests to Composer (default: only use cached/recorded responses)')
+    parser.add_argument('-o', '--outfile', dest='outfile', default='outputs/parity.csv',
+                        help='csv report path')
+    args = parser.parse_args()
+
+    symphony_ids = args.symphony_ids or symphony_object.get_cached_symphony_ids()
+    results = []
+    # printed as they come in, a large catalog takes a while
+    for result in parity.run_parity_checks(
+            symphony_ids, tolerance=args.tolerance, offline=not args.online, workers=args.workers):
+        results.append(result)
+        if result.get("divergent_days") != 0:
+            print(parity.describe_parity_result(result))
+
+    df = pd.DataFrame(results)
+    for column in ["first_divergent_branches", "first_divergent_tickers"]:
+        if column in df.columns:
+            df[column] = df[column].apply(json.dumps)
+    df.set_index("symphony_id").to_csv(args.outfile)
+    print(
+        f"{sum(1 for r in results if r.get('divergent_days') == 0)}/{len(results)} symphonies match Composer")
+
+
+if __name__ == '__main__':
+    main()
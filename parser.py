@@ -13,6 +13,9 @@ thinkscript
 
 '''
 import edn_format
+import contextlib
+import hashlib
+import os
 import traceback
 import requests
 import argparse
@@ -25,7 +28,7 @@ import json
 import sys
 import re
 
-from lib import edn_syntax, transpilers
+from lib import atomic_files, edn_syntax, instrumentation, lineage, parallel, symphony_object, transpilers
 
 
 class InFileReader:
@@ -82,10 +85,11 @@ class InFileReader:
             else:
                 print("I'm fancy and url loaded already\r\n")
                 data_with_wrapping_string_removed = self.resp['fields']['latest_version_edn']['stringValue']
-            root_data_immutable = edn_format.loads(
-                data_with_wrapping_string_removed)
-            self.data = typing.cast(
-                dict, edn_syntax.convert_edn_to_pythonic(root_data_immutable))
+            with instrumentation.span("parse_edn", category="edn"):
+                root_data_immutable = edn_format.loads(
+                    data_with_wrapping_string_removed)
+                self.data = typing.cast(
+                    dict, edn_syntax.convert_edn_to_pythonic(root_data_immutable))
             
             self.root_node = self.data
             if ":symphony" in self.data:
@@ -98,9 +102,10 @@ class InFileReader:
             my_traceback = traceback.format_exc() # returns a str
             print(my_traceback)
             
-            root_data_immutable = edn_format.loads(open(self.filePath, 'r').read())
-            self.data = typing.cast(
-                dict, edn_syntax.convert_edn_to_pythonic(root_data_immutable))
+            with instrumentation.span("parse_edn", category="edn"):
+                root_data_immutable = edn_format.loads(open(self.filePath, 'r').read())
+                self.data = typing.cast(
+                    dict, edn_syntax.convert_edn_to_pythonic(root_data_immutable))
             
         self.root_node = self.data
         if ":symphony" in self.data:
@@ -137,7 +142,9 @@ class OutfileHuman(OutfileBase):
         return
     
     def show(self, data):
-        print(transpilers.HumanTextTranspiler.convert_to_string(data))
+        with instrumentation.span("transpile_human", category="codegen"):
+            text = transpilers.HumanTextTranspiler.convert_to_string(data)
+        print(text)
         
     
     
@@ -160,42 +167,214 @@ class OutfileVectorBt(OutfileBase):
         
     # 
     def show(self, data):
-        print(transpilers.VectorBTTranspiler.convert_to_string(data))
+        with instrumentation.span("transpile_vectorbt", category="codegen"):
+            text = transpilers.VectorBTTranspiler.convert_to_string(data)
+        print(text)
         
 
+def fetch_symphony_responses(symphony_id: str, parent: bool = False) -> list:
+    """
+    firestore responses for the symphony, followed by its copied-from parents (oldest last) if parent is set
+    """
+    current_symph_id = symphony_id
+    response_list = []
+    while current_symph_id:
+        with instrumentation.span("fetch_symphony", category="download"):
+            symphReq = requests.get(f'https://firestore.googleapis.com/v1/projects/{symphony_object.COMPOSER_CONFIG["projectId"]}/databases/{symphony_object.COMPOSER_CONFIG["databaseName"]}/documents/symphony/{current_symph_id}')
+        resp = json.loads(symphReq.text)
+        # 'latest_backtest_info', 'latest_backtest_edn', 'latest_version', 'hashtag', 'owner', 'description', 'created_at', 'latest_version_edn', 'sparkgraph_url', 'color', 'name', 'share-with-everyone?', 'stats', 'last_updated_at', 'youtube-url', 'cached_rebalance', 'latest_backtest_run_at', 'cached_rebalance_corridor_width', 'copied-from', 'backtest_url'])
+
+        if 'fields' not in resp:
+            print("\r\nWas this a private symphony link? response 'object' had no 'fields' key.  could not parse\r\n  Error 2")
+            #sys.exit(2)
+            break
+
+        if parent:
+            if 'copied-from' in resp['fields']:
+                print("old id \r\n %s \r\nnew id \r\n %s\r\n" % (current_symph_id, resp['fields']['copied-from']['stringValue']))
+                if current_symph_id == resp['fields']['copied-from']['stringValue']:
+                    print("copied from fields are the same, no more parents, ending the lookups")
+                    # set current id to None, which should end our loop, and let us start looping over all our responses
+                    current_symph_id = None
+                else:
+                    # different parent id found, copy it, and then lets loop over and grab the next one
+                    current_symph_id = resp['fields']['copied-from']['stringValue']
+            else:
+                current_symph_id = None
+            sleep_time = 2 + 20 * random.random()
+            print("-->random delay of %s between requests" % str(sleep_time))
+            time.sleep(sleep_time)
+
+        # user did not ask for a "symphony parent lookup, so we will not try to loop over things
+        else:
+            print("---> skipping symphony parent check")
+            current_symph_id = None
+        # whatever the response was, copy it into our master response list.  we'll use all the responses later
+        response_list.append(copy.deepcopy(resp))
+    return response_list
+
+
+def extract_symphony_id(url: str) -> str:
+    m = re.search('\/symphony\/([^\/]+)', url)
+    return m.groups(1)[0]
+
+
+#
+# Bulk mode (-b): entries are read lazily (from a file, or stdin with -i -) and converted by worker processes,
+# a bounded number at a time, outputs are written as they complete
+#
+BULK_OUTPUT_EXTENSIONS = {"human": ".txt", "vector": ".py"}
+# read-ahead of the bulk input, so thousands of entries are never all in memory
+BULK_TASKS_PER_WORKER = 2
+
+
+def iter_bulk_entries(path: str) -> typing.Iterator[str]:
+    # one url or file path per line, blank lines and #comments are skipped
+    bulkfile = sys.stdin if path == "-" else open(path, 'r')
+    try:
+        for line in bulkfile:
+            entry = line.strip()
+            if entry and not entry.startswith("#"):
+                yield entry
+    finally:
+        if bulkfile is not sys.stdin:
+            bulkfile.close()
+
+
+def convert_parsed(inFileParser: InFileReader, mode: str) -> typing.Optional[str]:
+    if mode == "human":
+        with instrumentation.span("transpile_human", category="codegen"):
+            return transpilers.HumanTextTranspiler.convert_to_string(inFileParser.root_node)
+    if mode == "vector":
+        with instrumentation.span("transpile_vectorbt", category="codegen"):
+            return transpilers.VectorBTTranspiler.convert_to_string(inFileParser.data)
+    return None
+
+
+def convert_bulk_entry(entry: str, url: bool, parent: bool, mode: str) -> typing.List[dict]:
+    """
+    Worker task: outputs ({"name", "text"}) of one bulk entry, one per symphony (parents too with -p).
+    """
+    outputs = []
+    # stdout may be where outputs go, chatter goes to stderr
+    with contextlib.redirect_stdout(sys.stderr), instrumentation.span(entry, category="symphony", stage="parse"):
+        if url:
+            symphony_id = extract_symphony_id(entry)
+            responses = fetch_symphony_responses(symphony_id, parent)
+            if not responses:
+                # fetch_symphony_responses stops at a private or missing symphony, that is a failed entry, not an empty one
+                raise ValueError(f"symphony {symphony_id} is private or does not exist")
+            for resp in responses:
+                inFileParser = InFileReader(None, resp)
+                inFileParser.readFile(url_loaded = True)
+                outputs.append({"name": resp['name'].rsplit('/', 1)[-1], "text": convert_parsed(inFileParser, mode)})
+        else:
+            inFileParser = InFileReader(entry, None)
+            inFileParser.readFile()
+            outputs.append({"name": os.path.splitext(os.path.basename(entry))[0], "text": convert_parsed(inFileParser, mode)})
+    return outputs
+
+
+class OutfileBulk(OutfileBase):
+    """
+    outfile ending in .jsonl: one json line per converted symphony (or failed entry)
+    any other outfile: a directory, one file per symphony
+    no outfile: stdout
+    """
+
+    def __init__(self, filePath: typing.Optional[str], mode: str):
+        super().__init__()
+        self.filePath = filePath
+        self.mode = mode
+        # the entry each output name was first written for
+        self.entries_by_name: typing.Dict[str, str] = {}
+        self.jsonl = None
+        if filePath and filePath.endswith(".jsonl"):
+            self.jsonl = open(filePath, 'w')
+        elif filePath:
+            os.makedirs(filePath, exist_ok=True)
+
+    def get_output_name(self, entry: str, name: str) -> str:
+        """
+        name, or name-<hash of entry> if another entry already wrote an output by that name (a/x.json and b/x.json)
+        """
+        if self.entries_by_name.setdefault(name, entry) == entry:
+            return name
+        return "%s-%s" % (name, hashlib.sha1(entry.encode()).hexdigest()[:8])
+
+    def write(self, entry: str, outputs: typing.List[dict], error: typing.Optional[str] = None):
+        if self.jsonl:
+            if error:
+                self.jsonl.write(json.dumps({"input": entry, "error": error}) + "\n")
+            for output in outputs:
+                self.jsonl.write(json.dumps({"input": entry, "symphony_id": self.get_output_name(entry, output["name"]), "mode": self.mode, "output": output["text"]}) + "\n")
+            self.jsonl.flush()
+            return
+        if error:
+            print("%s: failed: %s" % (entry, error), file=sys.stderr)
+            return
+        for output in outputs:
+            if self.filePath:
+                path = os.path.join(self.filePath, self.get_output_name(entry, output["name"]) + BULK_OUTPUT_EXTENSIONS.get(self.mode, ".txt"))
+                with atomic_files.open_replacing(path) as f:
+                    f.write(output["text"] or "")
+            else:
+                print("=== %s (%s)" % (output["name"], entry))
+                print(output["text"])
+
+    def close(self):
+        if self.jsonl:
+            self.jsonl.close()
+
+
+def run_bulk(args: dict) -> int:
+    outfile = args['outfile'] if args['outfile'] != "OUTFILE" else None
+    writer = OutfileBulk(outfile, args["mode"])
+    workers = args['workers'] or os.cpu_count() or 1
+    tasks = ((entry, (entry, args['url'] == True, args['parent'] == True, args["mode"])) for entry in iter_bulk_entries(args['infile']))
+
+    start = time.perf_counter()
+    converted, failed = 0, 0
+    for result in parallel.imap_tasks(convert_bulk_entry, tasks, workers=workers, ordered=args['ordered'], max_in_flight=BULK_TASKS_PER_WORKER * workers):
+        writer.write(result.key, result.value or [], error=result.error)
+        if result.error:
+            failed += 1
+        else:
+            converted += 1
+    writer.close()
+    print("bulk: %s converted, %s failed in %.1fs" % (converted, failed, time.perf_counter() - start), file=sys.stderr)
+    return 1 if failed else 0
+
+
 #TODO arg parser for inputs: input file, output file, output mode
 def main()-> int:
     parser = argparse.ArgumentParser(description='Composer Symphony text parser')
     parser.add_argument('-i','--infile', dest="infile", action="store", help=' input file we read the symphony text from.  full path please', required=True)
     parser.add_argument('-o','--outfile', dest="outfile", action="store", default="OUTFILE", help=' output file to save the parsed text to.  if not given, will use stdout', required=False)
     parser.add_argument('-m','--mode', dest="mode", action="store", default="human", help=' output parsing mode to use.  if none given, will parse for "human readable output".  modes are: quantconnect, vectorbt, tradingview, thinkscript', required=False)
-    parser.add_argument('-b', '--bulk', action="store_true", dest='bulk', default='False', help="it means the specified input is a filepath, containing a bulk list of urls, or filenames to process.  one url or file path per line")
+    parser.add_argument('-b', '--bulk', action="store_true", dest='bulk', default='False', help="it means the specified input is a filepath (- for stdin), containing a bulk list of urls, or filenames to process.  one url or file path per line.  with -o, writes one file per symphony into that directory, or json lines if it ends in .jsonl")
+    parser.add_argument('--workers', dest='workers', type=int, default=None, help="bulk mode: worker processes fetching, parsing and transpiling at the same time (default: one per cpu)")
+    parser.add_argument('--ordered', dest='ordered', action="store_true", default=False, help="bulk mode: write outputs in input order, instead of as soon as each is done")
     
     parser.add_argument('-u', '--url', action="store_true", dest='url', default='False', help="specifies that the input file path is actually the url to a shared, public symphony on composer.trade")
     parser.add_argument('-p', '--parent', action="store_true", dest='parent', default='False', help="specifies that we should try and look up the parents of this symphony, and get all previous copied information too.  only works if the 'infile' given was a url")
+    parser.add_argument('--metrics', dest='metrics', default=None, help="write per-stage timings as JSONL to this file (and print a summary at the end)")
+    parser.add_argument('--trace', dest='trace', default=None, help="write a Chrome/Perfetto trace of the run to this file")
     
     
     args = vars(parser.parse_args())
 
+    if args['metrics'] or args['trace']:
+        instrumentation.start(metrics_path=args['metrics'], trace_path=args['trace'])
+
+    if args['bulk'] == True:
+        exit_code = run_bulk(args)
+        instrumentation.finish(file=sys.stderr)
+        return exit_code
+
     if args['url'] == True:
-        url_list = []
-        if args['bulk'] == True:
-            # read bulk file and add them all to the "list"
-            with open(args['infile'], 'r') as bulkfile:
-                for line in bulkfile.readlines():
-                    url_list.append(line)
-        else:
-            url_list.append(args['infile'])
-            # just add the single one to the list and have it process the "list" anyways
-        
-        
-        
-        
-        #todo move to request this from the composer site instead of hardcoding
-        composerConfig = {
-                "projectId" : "leverheads-278521",
-                "databaseName" : "(default)"
-            }
+        # bulk lists go through run_bulk
+        url_list = [args['infile']]
         total = len(url_list)
         for count, current_url in enumerate(url_list):
             
@@ -205,85 +384,55 @@ def main()-> int:
             print("****************************************************************************************************************")
             print("=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-")
             
-            m = re.search('\/symphony\/([^\/]+)', current_url)
-            symphId = m.groups(1)[0]
-
-            current_symph_id = symphId
-            response_list = []
-            while current_symph_id:
-                symphReq = requests.get(f'https://firestore.googleapis.com/v1/projects/{composerConfig["projectId"]}/databases/{composerConfig["databaseName"]}/documents/symphony/{symphId}')
-                resp = json.loads(symphReq.text)
-                # 'latest_backtest_info', 'latest_backtest_edn', 'latest_version', 'hashtag', 'owner', 'description', 'created_at', 'latest_version_edn', 'sparkgraph_url', 'color', 'name', 'share-with-everyone?', 'stats', 'last_updated_at', 'youtube-url', 'cached_rebalance', 'latest_backtest_run_at', 'cached_rebalance_corridor_width', 'copied-from', 'backtest_url'])
-
-                if 'fields' not in resp:
-                    print("\r\nWas this a private symphony link? response 'object' had no 'fields' key.  could not parse\r\n  Error 2")
-                    #sys.exit(2)
-                    current_symph_id = None
+            symphId = extract_symphony_id(current_url)
 
-                if args['parent'] == True:
-                    if 'copied-from' in resp['fields']:
-                        print("old id \r\n %s \r\nnew id \r\n %s\r\n" % (current_symph_id, resp['fields']['copied-from']['stringValue']))
-                        if current_symph_id == resp['fields']['copied-from']['stringValue']:
-                            print("copied from fields are the same, no more parents, ending the lookups")
-                            # set current id to None, which should end our loop, and let us start looping over all our responses
-                            current_symph_id = None
-                        else:
-                            # different parent id found, copy it, and then lets loop over and grab the next one
-                            current_symph_id = resp['fields']['copied-from']['stringValue']
-                    else:
-                        current_symph_id = None
-                    sleep_time = 2 + 20 * random.random()
-                    print("-->random delay of %s between requests" % str(sleep_time))
-                    time.sleep(sleep_time)
-
-                # user did not ask for a "symphony parent lookup, so we will not try to loop over things
-                else:
-                    print("---> skipping symphony parent check")
-                    current_symph_id = None
-                # whatever the response was, copy it into our master response list.  we'll use all the responses later
-                response_list.append(copy.deepcopy(resp))
+            response_list = fetch_symphony_responses(symphId, args['parent'] == True)
             #import pdb; pdb.set_trace()
 
+            root_node_list = []
             for resp in response_list:
-                print(json.dumps(resp['fields']['latest_version_edn']['stringValue'], indent=2))
-                inFileParser = InFileReader(None, resp)
-                inFileParser.printHeader(url_loaded = True)
-                inFileParser.readFile(url_loaded = True)
+                with instrumentation.span(symphId, category="symphony", stage="parse"):
+                    print(json.dumps(resp['fields']['latest_version_edn']['stringValue'], indent=2))
+                    inFileParser = InFileReader(None, resp)
+                    inFileParser.printHeader(url_loaded = True)
+                    inFileParser.readFile(url_loaded = True)
+                    root_node_list.append(inFileParser.root_node)
 
-                if args["mode"] == "human":
-                    humanParser = OutfileHuman(args["infile"])
-                    humanParser.show(inFileParser.root_node)
+                    if args["mode"] == "human":
+                        humanParser = OutfileHuman(args["infile"])
+                        humanParser.show(inFileParser.root_node)
 
-                if args["mode"] == "vector":
-                    vectorParser = OutfileVectorBt()
-                    vectorParser.show(inFileParser.data)
+                    if args["mode"] == "vector":
+                        vectorParser = OutfileVectorBt()
+                        vectorParser.show(inFileParser.data)
+
+            # response_list goes from the child to its oldest parent, show what each copy changed
+            for child_root_node, parent_root_node in zip(root_node_list, root_node_list[1:]):
+                print("---> changes from parent %s to child %s" % (parent_root_node.get(":id"), child_root_node.get(":id")))
+                print(lineage.format_changes(lineage.diff_trees(parent_root_node, child_root_node)))
+                if args["mode"] == "human":
+                    print(lineage.format_unified_diff(parent_root_node, child_root_node))
 
     else:
-        file_list = []
-        if args['bulk'] == True:
-            # read bulk file and add them all to the "list"
-            with open(args['infile'], 'r') as bulkfile:
-                for line in bulkfile.readlines():
-                    file_list.append(line)
-        else:
-            file_list.append(args['infile'])
-            # just add the single one to the list and have it process the "list" anyways
+        file_list = [args['infile']]
             
             
         for file in file_list:
             print(file)
-            inFileParser = InFileReader(file, None)
-            inFileParser.readFile()
+            with instrumentation.span(file, category="symphony", stage="parse"):
+                inFileParser = InFileReader(file, None)
+                inFileParser.readFile()
 
 
-            if args["mode"] == "human":
-                humanParser = OutfileHuman(file)
-                humanParser.show(inFileParser.root_node)
+                if args["mode"] == "human":
+                    humanParser = OutfileHuman(file)
+                    humanParser.show(inFileParser.root_node)
 
-            if args["mode"] == "vector":
-                vectorParser = OutfileVectorBt()
-                vectorParser.show(inFileParser.data)
+                if args["mode"] == "vector":
+                    vectorParser = OutfileVectorBt()
+                    vectorParser.show(inFileParser.data)
     
+    instrumentation.finish(file=sys.stderr)
     return 0
 #TODO make generic class for output mode
 
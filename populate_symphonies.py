@@ -1,12 +1,14 @@
+import argparse
 import json
 import os
 import typing
 
 import pandas as pd
 import requests
-import quantstats
 
-from lib import get_backtest_data, symphony_object, transpilers, traversers
+from lib import artifact_store, batch_backtest, build_graph, get_backtest_data, instrumentation, metrics, parallel, reports, subtrees, symphony_object, ticker_index, transpilers, traversers
+from lib.catalog import Catalog
+from lib.sparse_allocations import SparseAllocations
 
 
 def is_record_failed(record: dict) -> bool:
@@ -42,7 +44,9 @@ def write_symphony_cache_by_id(symphony_id: str, symphony: dict):
 
 def download_symphony(symphony_id, force=False) -> typing.Optional[dict]:
     if not force and read_symphony_cache_by_id(symphony_id):
+        instrumentation.count("symphony_json.hit")
         return
+    instrumentation.count("symphony_json.miss")
     try:
         symphony = symphony_object.get_symphony(symphony_id)
     except requests.exceptions.HTTPError as e:
@@ -53,217 +57,564 @@ def download_symphony(symphony_id, force=False) -> typing.Optional[dict]:
     write_symphony_cache_by_id(symphony_id, symphony)
 
 
-def main():
-    symphonies = pd.read_csv('outputs/symphonies.csv', index_col="symphony_id")
-    symphonies['symphony_id'] = symphonies.index
-    symphonies['force_update'] = symphonies['force_update'].fillna("")
-    symphonies['failure_status'] = symphonies['failure_status'].fillna("")
-    # if forcing an update, forget past failures
-    symphonies.loc[symphonies['force_update'] != "",
-                   ['failure_status', 'failure_detail']] = ""
+def artifact_exists(symphony_id: str, name: str) -> bool:
+    if name in artifact_store.ARTIFACT_TYPES:
+        return artifact_store.has_artifact(name, symphony_id)
+    return os.path.exists(get_cache_path(symphony_id, name))
 
-    records = symphonies.to_dict("records")
 
-    # How TQQQ for the long term works (useful conditions)
-    # https://www.reddit.com/user/derecknielsen/comments/yorwm0/educating_you_on_how_my_algo_tqqq_for_the_long/?context=3
+# artifacts each stage produces, the first one names the stage in the catalog
+STAGE_ARTIFACTS = [
+    ["symphony.json"],
+    ["human.txt"],
+    ["vectorbt.py"],
+    ["allocations", "branch_tracker"],
+    ["returns"],
+    ["VectorBT.html"],
+    ["report.html"],
+]
 
-    # Someone is tracking performance here:
-    # https://docs.google.com/spreadsheets/d/1OnDiuLzfQ8yy6YNuOusdfUmlZvRXsQTPB-kH4O7eHK8/edit#gid=890537793
 
-    # From Discover Page
-    # 1. save copy to drafts
-    # 2. make copy public
-    # 3. paste ids here
-
-    print("Updating community symphonies...")
-    for record in [r for r in records if not is_record_failed(r)]:
-        symphony_id = record['symphony_id']
-        failure_updates = download_symphony(
-            symphony_id, force=is_record_set_to_force(record))
-        if failure_updates:
-            record.update(failure_updates)
+def get_input_hash(record: dict, stage: str) -> typing.Optional[str]:
+    # see lib/build_graph.py, None until the symphony is downloaded
+    symphony = read_symphony_cache_by_id(record['symphony_id'])
+    if not symphony:
+        return
+    return build_graph.get_input_hashes(symphony, record.get("benchmark_ticker", "SPY"))[stage]
+
+
+def is_failure_stale(record: dict) -> bool:
+    # a failure only holds for the inputs it failed on, once the symphony (or the stage's code) changes it is retried
+    # (failures without a stage, from symphonies.csv, hold until force_update)
+    if not is_record_failed(record) or not record.get('failure_stage'):
+        return False
+    return get_input_hash(record, record['failure_stage']) != record.get('failure_input_hash')
+
+
+def is_stage_complete(catalog: typing.Optional[Catalog], record: dict, stage: str, input_hash: typing.Optional[str] = None) -> bool:
+    # without a catalog, existing artifacts are trusted
+    return catalog is None or catalog.is_stage_complete(record['symphony_id'], stage, input_hash=input_hash)
+
+
+def commit_stage(catalog: typing.Optional[Catalog], record: dict, stage: str, input_hash: typing.Optional[str] = None):
+    if catalog:
+        catalog.save_record(record, stage=stage, input_hash=input_hash)
+
+
+def is_artifact_fresh(record: dict, *filenames: str, catalog: typing.Optional[Catalog] = None, input_hash: typing.Optional[str] = None) -> bool:
+    """
+    filenames are files in the symphony's folder, or artifact_store artifact types.
+    With an input_hash, the artifacts must also have been built from the same inputs.
+    """
+    fresh = not is_record_set_to_force(record) and all(artifact_exists(
+        record['symphony_id'], filename) for filename in filenames) and is_stage_complete(catalog, record, filenames[0], input_hash=input_hash)
+    instrumentation.count(f"{filenames[0]}.hit" if fresh else f"{filenames[0]}.miss")
+    return fresh
+
+
+def mark_existing_artifacts_complete(catalog: Catalog, record: dict):
+    # for symphonies carried over from symphonies.csv, so their finished stages are not redone
+    # (not the download stage, it also fills in metadata and only downloads what is missing anyway)
+    # existing artifacts are trusted to be built from the current inputs, like before input hashes
+    for filenames in STAGE_ARTIFACTS[1:]:
+        if all(artifact_exists(record['symphony_id'], filename) for filename in filenames):
+            catalog.mark_stage_complete(
+                record['symphony_id'], filenames[0], input_hash=get_input_hash(record, filenames[0]))
+
+
+def run_stage_tasks(function: typing.Callable, tasks: typing.List[typing.Tuple[str, tuple]], records: typing.List[dict], stage: str, failure_status_prefix: str, catalog: typing.Optional[Catalog] = None, workers: int = 1, state: typing.Optional[dict] = None, input_hashes_by_id: typing.Optional[typing.Mapping[str, typing.Optional[str]]] = None) -> typing.List[dict]:
+    """
+    Runs one task per symphony (see lib/parallel.py), each returns its record's updates (None: nothing to commit).
+    Updates are merged and committed (with the symphony's input hash) in task order, returns the updated records.
+    """
+    records_by_id = {record['symphony_id']: record for record in records}
+    updated_records = []
+    for result in parallel.run_tasks(function, tasks, workers=workers, state=state):
+        record = records_by_id[result.key]
+        if result.error:
+            print(f"{result.key}: {stage} failed: {result.error}")
+            print(result.detail)
+            updates = {
+                'failure_status': f'{failure_status_prefix}: {result.error}',
+                'failure_detail': f''
+            }
+        elif result.value is None:
             continue
+        else:
+            updates = result.value
+        record.update(updates)
+        commit_stage(catalog, record, stage,
+                     input_hash=(input_hashes_by_id or {}).get(result.key))
+        updated_records.append(record)
+    return updated_records
+
+
+def download_symphony_task(symphony_id: str, force: bool) -> typing.Optional[dict]:
+    with instrumentation.span(symphony_id, category="symphony", stage="download"):
+        failure_updates = download_symphony(symphony_id, force=force)
+        if failure_updates:
+            return failure_updates
 
         symphony = read_symphony_cache_by_id(symphony_id)
         if not symphony:
-            continue
+            return
         root_node = symphony_object.extract_root_node_from_symphony_response(
             symphony)
-        record.update({
+        return {
             "name": symphony["fields"]["name"]["stringValue"],
             "branches_count": len(traversers.collect_branches(root_node)),
-            "unique_conditions_count": len(set([c['pretty_text'] for c in traversers.collect_conditions(root_node)])),
-        })
-    print("Updated community symphonies.")
+            "unique_conditions_count": len(traversers.intern_conditions(root_node)),
+        }
 
-    print("Reformatting downloaded symphonies to human.txt...")
+
+def update_community_symphonies(records: typing.List[dict], catalog: typing.Optional[Catalog] = None, workers: int = 1):
+    tasks = []
     for record in [r for r in records if not is_record_failed(r)]:
         symphony_id = record['symphony_id']
-
-        if not is_record_set_to_force(record) and os.path.exists(get_cache_path(symphony_id, "human.txt")):
+        if catalog and not is_record_set_to_force(record) and is_stage_complete(catalog, record, "symphony.json"):
             continue
+        tasks.append(
+            (symphony_id, (symphony_id, is_record_set_to_force(record))))
 
-        symphony = read_symphony_cache_by_id(symphony_id)
-        if not symphony:
-            continue
+    for record in run_stage_tasks(download_symphony_task, tasks, records, "symphony.json", "Download error", catalog=catalog, workers=workers):
+        if catalog and not is_record_failed(record):
+            # stamped after the download, with the EDN it got
+            catalog.mark_stage_complete(
+                record['symphony_id'], "symphony.json", input_hash=get_input_hash(record, "symphony.json"))
+            catalog.clear_force(record['symphony_id'])
+
+
+def write_human_format_task(symphony_id: str) -> typing.Optional[dict]:
+    symphony = read_symphony_cache_by_id(symphony_id)
+    if not symphony:
+        return
 
-        print(symphony_id)
-        print("  human format")
+    print(symphony_id)
+    print("  human format")
+    with instrumentation.span(symphony_id, category="symphony", stage="human"):
         with open(get_cache_path(symphony_id, 'human.txt'), 'w') as f:
             f.write(transpilers.HumanTextTranspiler.convert_to_string(
                 symphony_object.extract_root_node_from_symphony_response(symphony)))
-    print("Reformatted downloaded symphonies to human.txt.")
+    return {}
 
-    print("Reformatting downloaded symphonies to vectorbt.py...")
-    for record in [r for r in records if not is_record_failed(r)]:
-        symphony_id = record['symphony_id']
 
-        if not is_record_set_to_force(record) and os.path.exists(get_cache_path(symphony_id, "vectorbt.py")):
-            continue
+def write_human_formats(records: typing.List[dict], catalog: typing.Optional[Catalog] = None, workers: int = 1):
+    records_by_id = {record['symphony_id']: record for record in records}
+    input_hashes_by_id = {record['symphony_id']: get_input_hash(
+        record, "human.txt") for record in records if not is_record_failed(record)}
+    tasks = [(symphony_id, (symphony_id,)) for symphony_id, input_hash in input_hashes_by_id.items(
+    ) if not is_artifact_fresh(records_by_id[symphony_id], "human.txt", catalog=catalog, input_hash=input_hash)]
+    run_stage_tasks(write_human_format_task, tasks, records, "human.txt", "Human format error",
+                    catalog=catalog, workers=workers, input_hashes_by_id=input_hashes_by_id)
 
-        symphony = read_symphony_cache_by_id(symphony_id)
-        if not symphony:
-            continue
 
-        print(symphony_id)
-        print("  vectorbt format")
+def write_vectorbt_format_task(symphony_id: str) -> typing.Optional[dict]:
+    symphony = read_symphony_cache_by_id(symphony_id)
+    if not symphony:
+        return
+
+    print(symphony_id)
+    print("  vectorbt format")
+    with instrumentation.span(symphony_id, category="symphony", stage="vectorbt"):
         try:
             vectorbt_format = transpilers.VectorBTTranspiler.convert_to_string(
                 symphony_object.extract_root_node_from_symphony_response(symphony))
             with open(get_cache_path(symphony_id, 'vectorbt.py'), 'w') as f:
                 f.write(vectorbt_format)
         except Exception as e:
-            record.update({
+            return {
                 'failure_status': f'Transpiler error: {e}',
                 'failure_detail': f''
-            })
-            continue
-    print("Reformatted downloaded symphonies to vectorbt.py.")
-
-    print("Building allocation matrixes...")
-    for record in [r for r in records if not is_record_failed(r)]:
-        symphony_id = record['symphony_id']
+            }
+    return {}
 
-        if not is_record_set_to_force(record) and os.path.exists(get_cache_path(symphony_id, "allocations.csv")) and os.path.exists(get_cache_path(symphony_id, "branch_tracker.csv")):
-            continue
 
-        symphony = read_symphony_cache_by_id(symphony_id)
-        if not symphony:
-            continue
+def write_vectorbt_formats(records: typing.List[dict], catalog: typing.Optional[Catalog] = None, workers: int = 1):
+    records_by_id = {record['symphony_id']: record for record in records}
+    input_hashes_by_id = {record['symphony_id']: get_input_hash(
+        record, "vectorbt.py") for record in records if not is_record_failed(record)}
+    tasks = [(symphony_id, (symphony_id,)) for symphony_id, input_hash in input_hashes_by_id.items(
+    ) if not is_artifact_fresh(records_by_id[symphony_id], "vectorbt.py", catalog=catalog, input_hash=input_hash)]
+    run_stage_tasks(write_vectorbt_format_task, tasks, records, "vectorbt.py", "Transpiler error",
+                    catalog=catalog, workers=workers, input_hashes_by_id=input_hashes_by_id)
 
-        print(symphony_id)
 
-        root_node = symphony_object.extract_root_node_from_symphony_response(
-            symphony)
-        tickers = traversers.collect_referenced_assets(root_node)
-        closes = get_backtest_data.get_backtest_data(tickers)
+def build_allocation_matrix_task(symphony_id: str, root_node: dict, export_csv: bool) -> dict:
+    # closes and subtree cache come from parallel.run_tasks state (each worker process has its own subtree cache)
+    state = parallel.get_worker_state()
+    closes, subtree_cache = state["closes"], state["subtree_cache"]
+    print(symphony_id)
 
+    with instrumentation.span(symphony_id, category="symphony", stage="allocations"):
+        hits, misses = subtree_cache.hits, subtree_cache.misses
         try:
             allocations, branch_tracker = transpilers.VectorBTTranspiler.execute(
-                root_node, closes)
+                root_node, batch_backtest.select_symphony_closes(closes, root_node), subtree_cache=subtree_cache, ticker_index=state["ticker_index"])
         except Exception as e:
-            record.update({
+            return {
                 'failure_status': f'Backtest error {e}',
                 'failure_detail': f''
-            })
-            continue
-        allocations.to_csv(get_cache_path(symphony_id, "allocations.csv"))
-        branch_tracker.to_csv(get_cache_path(
-            symphony_id, "branch_tracker.csv"))
-        record.update({
+            }
+        finally:
+            instrumentation.count("subtree_cache.hit",
+                                  subtree_cache.hits - hits)
+            instrumentation.count("subtree_cache.miss",
+                                  subtree_cache.misses - misses)
+        with instrumentation.span("write_allocations", category="io"):
+            artifact_store.write_allocations(
+                symphony_id, SparseAllocations.from_frame(allocations))
+            artifact_store.write_branch_tracker(
+                symphony_id, branch_tracker)
+        if export_csv:
+            allocations.to_csv(get_cache_path(
+                symphony_id, "allocations.csv"))
+            branch_tracker.to_frame().to_csv(get_cache_path(
+                symphony_id, "branch_tracker.csv"))
+        return {
             "allocations_days": len(allocations),
             "branch_tracker_days": len(branch_tracker),
             "backtest_start": allocations.index.min().date().isoformat(),
             "backtest_end": allocations.index.max().date().isoformat(),
-        })
-    print("Built allocation matrixes.")
+        }
 
-    print("Extracting returns...")
+
+def evaluate_shared_subtree_task(node: dict, subtree_hash: str) -> typing.Tuple[tuple, subtrees.SubtreeResult]:
+    state = parallel.get_worker_state()
+    closes, subtree_cache = state["closes"], state["subtree_cache"]
+    instrumentation.count("subtree_cache.miss")
+    with instrumentation.span(subtree_hash[:16], category="subtree", items=1):
+        return subtree_cache.get_key(node, subtree_hash, closes)[0], subtree_cache.get_result(node, subtree_hash, closes)
+
+
+def build_allocation_matrixes(records: typing.List[dict], export_csv: bool = False, catalog: typing.Optional[Catalog] = None, workers: int = 1):
+    root_nodes_by_id = {}
     for record in [r for r in records if not is_record_failed(r)]:
         symphony_id = record['symphony_id']
 
-        if not is_record_set_to_force(record) and os.path.exists(get_cache_path(symphony_id, "returns.csv")):
+        if is_artifact_fresh(record, "allocations", "branch_tracker", catalog=catalog, input_hash=get_input_hash(record, "allocations")):
             continue
 
         symphony = read_symphony_cache_by_id(symphony_id)
         if not symphony:
             continue
 
-        print(symphony_id)
-
-        allocations = pd.read_csv(
-            get_cache_path(symphony_id, "allocations.csv"), parse_dates=True, index_col="Date")
-        branch_tracker = pd.read_csv(
-            get_cache_path(symphony_id, "branch_tracker.csv"), parse_dates=True, index_col="Date")
-
-        root_node = symphony_object.extract_root_node_from_symphony_response(
+        root_nodes_by_id[symphony_id] = symphony_object.extract_root_node_from_symphony_response(
             symphony)
-        tickers = traversers.collect_referenced_assets(root_node)
-        closes = get_backtest_data.get_backtest_data(tickers)
+    if not root_nodes_by_id:
+        return
 
-        try:
-            returns = transpilers.VectorBTTranspiler.get_returns(
-                closes, allocations, branch_tracker)
-        except Exception as e:
-            record.update({
-                "failure_status": f"Failed to get returns: {e}",
+    # one shared closes frame for every symphony in this stage
+    universe = batch_backtest.collect_universe(root_nodes_by_id)
+    closes = get_backtest_data.get_backtest_data(universe)
+    # where each ticker starts (execute's backtest start), and dollar volumes for the linter
+    universe_index = ticker_index.update_index(
+        universe, root_nodes_by_id.values())
+    # subtrees copied between symphonies are evaluated once (per worker)
+    subtree_cache = subtrees.SubtreeCache(
+        subtrees.find_shared_subtrees(root_nodes_by_id))
+
+    if workers > 1:
+        # workers fork with whatever is cached here, so evaluate shared subtrees first (in parallel too)
+        # instead of once per worker. one that fails is evaluated (and fails) with its symphonies
+        shared_subtree_tasks = [(subtree_hash, (node, subtree_hash)) for subtree_hash, node in subtree_cache.get_shared_subtree_nodes(
+            root_nodes_by_id).items()]
+        for result in parallel.run_tasks(evaluate_shared_subtree_task, shared_subtree_tasks, workers=workers, state={"closes": closes, "subtree_cache": subtree_cache}):
+            if not result.error:
+                key, subtree_result = result.value
+                subtree_cache.results_by_key[key] = subtree_result
+
+    # after get_backtest_data, so missing prices it downloaded are part of the stamp
+    records_by_id = {record['symphony_id']: record for record in records}
+    input_hashes_by_id = {symphony_id: get_input_hash(
+        records_by_id[symphony_id], "allocations") for symphony_id in root_nodes_by_id}
+    tasks = [(symphony_id, (symphony_id, root_node, export_csv))
+             for symphony_id, root_node in root_nodes_by_id.items()]
+    run_stage_tasks(build_allocation_matrix_task, tasks, records, "allocations", "Backtest error", catalog=catalog,
+                    workers=workers, state={"closes": closes, "subtree_cache": subtree_cache, "ticker_index": universe_index}, input_hashes_by_id=input_hashes_by_id)
+
+
+def extract_returns_task(symphony_ids: typing.List[str], benchmark_tickers_by_id: typing.Dict[str, str], export_csv: bool) -> typing.Dict[str, dict]:
+    """
+    Returns and stats of one chunk of symphonies, as updates by symphony id.
+    """
+    state = parallel.get_worker_state()
+    closes, benchmark_returns_by_ticker = state["closes"], state["benchmark_returns_by_ticker"]
+    updates_by_id = {}
+
+    allocations_by_id = {}
+    branch_trackers_by_id = {}
+    with instrumentation.span("read_allocations", category="io", items=len(symphony_ids)):
+        for symphony_id in symphony_ids:
+            allocations_by_id[symphony_id] = artifact_store.read_allocations(
+                symphony_id)
+            branch_trackers_by_id[symphony_id] = artifact_store.read_branch_tracker(
+                symphony_id)
+
+    try:
+        batches = [batch_backtest.simulate_returns(
+            closes, allocations_by_id, branch_trackers_by_id)]
+    except Exception:
+        # isolate whichever symphony broke the shared simulation
+        batches = []
+        for symphony_id in symphony_ids:
+            try:
+                batches.append(batch_backtest.simulate_returns(
+                    closes, {symphony_id: allocations_by_id[symphony_id]}, {symphony_id: branch_trackers_by_id[symphony_id]}))
+            except Exception as e:
+                updates_by_id[symphony_id] = {
+                    "failure_status": f"Failed to get returns: {e}",
+                    "failure_detail": f"",
+                }
+
+    for batch in batches:
+        for symphony_id, failure in batch.failures.items():
+            updates_by_id[symphony_id] = {
+                "failure_status": failure,
                 "failure_detail": f"",
-            })
+            }
+
+        returns_by_id = {}
+        for symphony_id in batch.symphony_ids:
+            print(symphony_id)
+
+            with instrumentation.span(symphony_id, category="symphony", stage="returns"):
+                returns = batch.get_returns(symphony_id)
+                artifact_store.write_returns(symphony_id, returns)
+                if export_csv:
+                    returns.to_csv(get_cache_path(
+                        symphony_id, "returns.csv"))
+                returns_by_id[symphony_id] = returns
+
+        # stats for the whole batch at once, per benchmark
+        symphony_ids_by_benchmark_ticker = {}
+        for symphony_id in returns_by_id:
+            symphony_ids_by_benchmark_ticker.setdefault(
+                benchmark_tickers_by_id[symphony_id], []).append(symphony_id)
+        for benchmark_ticker, benchmark_symphony_ids in symphony_ids_by_benchmark_ticker.items():
+            with instrumentation.span("stats", category="metrics", items=len(benchmark_symphony_ids)):
+                stats = metrics.compute_stats(
+                    pd.DataFrame(
+                        {symphony_id: returns_by_id[symphony_id] for symphony_id in benchmark_symphony_ids}),
+                    benchmark_returns_by_ticker[benchmark_ticker],
+                    allocation_days={symphony_id: len(allocations_by_id[symphony_id]) for symphony_id in benchmark_symphony_ids})
+            for symphony_id, symphony_stats in stats.iterrows():
+                updates_by_id[symphony_id] = symphony_stats.to_dict()
+    return updates_by_id
+
+
+def extract_returns(records: typing.List[dict], export_csv: bool = False, catalog: typing.Optional[Catalog] = None, workers: int = 1):
+    records_by_id = {record['symphony_id']: record for record in records}
+    root_nodes_by_id = {}
+    for record in [r for r in records if not is_record_failed(r)]:
+        symphony_id = record['symphony_id']
+
+        if is_artifact_fresh(record, "returns", catalog=catalog, input_hash=get_input_hash(record, "returns")):
             continue
-        returns.to_csv(get_cache_path(symphony_id, "returns.csv"))
 
-        benchmark_ticker = record.get("benchmark_ticker", "SPY")
-        closes = get_backtest_data.get_backtest_data(set([benchmark_ticker]))
-        record.update({
-            "Max Drawdown": quantstats.stats.max_drawdown(returns),
-            "Sharpe": quantstats.stats.sharpe(returns),
-            "Kelly": quantstats.stats.kelly_criterion(returns),
-
-            "CAGR": quantstats.stats.cagr(returns),
-            "Serenity": quantstats.stats.serenity_index(returns),
-            # max drawdown is proportional to sqrt(time), so correct for that!
-            "Adjusted Drawdown Risk": quantstats.stats.max_drawdown(returns) / ((len(allocations) / 252) ** 0.5),
-
-            "rolling_kelly": quantstats.stats.kelly_criterion(returns.tail(126)),
-            "rolling_beta": quantstats.stats.greeks(returns.tail(126), closes[benchmark_ticker].pct_change().dropna().tail(126))['beta'],
-            "rolling_sharpe": quantstats.stats.sharpe(returns.tail(126)),
-
-            "2weeks": typing.cast(float, (1+returns.tail(10)).prod()) - 1,
-        })
-    print("Extracted returns.")
+        symphony = read_symphony_cache_by_id(symphony_id)
+        if not symphony:
+            continue
 
-    print("Writing reports...")
+        root_nodes_by_id[symphony_id] = symphony_object.extract_root_node_from_symphony_response(
+            symphony)
+    if not root_nodes_by_id:
+        return
+
+    closes = get_backtest_data.get_backtest_data(
+        batch_backtest.collect_universe(root_nodes_by_id))
+    benchmark_tickers_by_id = {symphony_id: records_by_id[symphony_id].get(
+        "benchmark_ticker", "SPY") for symphony_id in root_nodes_by_id}
+    benchmark_returns_by_ticker = {}
+    for benchmark_ticker in sorted(set(benchmark_tickers_by_id.values())):
+        benchmark_closes = get_backtest_data.get_backtest_data(
+            set([benchmark_ticker]))
+        benchmark_returns_by_ticker[benchmark_ticker] = benchmark_closes[benchmark_ticker].pct_change(
+        ).dropna()
+    input_hashes_by_id = {symphony_id: get_input_hash(
+        records_by_id[symphony_id], "returns") for symphony_id in root_nodes_by_id}
+
+    # a task per chunk, simulations and stats are vectorized within a chunk
+    pending_symphony_ids = list(root_nodes_by_id.keys())
+    chunks = [pending_symphony_ids[chunk_start:chunk_start + batch_backtest.DEFAULT_CHUNK_SIZE]
+              for chunk_start in range(0, len(pending_symphony_ids), batch_backtest.DEFAULT_CHUNK_SIZE)]
+    tasks = [(str(chunk_number), (chunk_ids, {symphony_id: benchmark_tickers_by_id[symphony_id] for symphony_id in chunk_ids}, export_csv))
+             for chunk_number, chunk_ids in enumerate(chunks)]
+    for result in parallel.run_tasks(extract_returns_task, tasks, workers=workers, state={"closes": closes, "benchmark_returns_by_ticker": benchmark_returns_by_ticker}):
+        chunk_ids = chunks[int(result.key)]
+        if result.error:
+            print(f"returns failed: {result.error}")
+            print(result.detail)
+            updates_by_id = {symphony_id: {
+                "failure_status": f"Failed to get returns: {result.error}",
+                "failure_detail": f"",
+            } for symphony_id in chunk_ids}
+        else:
+            updates_by_id = result.value
+        for symphony_id in chunk_ids:
+            if symphony_id not in updates_by_id:
+                continue
+            record = records_by_id[symphony_id]
+            record.update(updates_by_id[symphony_id])
+            commit_stage(catalog, record, "returns",
+                         input_hash=input_hashes_by_id[symphony_id])
+
+
+REPORT_FILENAMES = {
+    "quantstats": "VectorBT.html",
+    "lightweight": "report.html",
+}
+
+
+def write_lightweight_report_task(symphony_id: str, returns: pd.Series, benchmark_returns: pd.Series, title: str, path: str, stats: dict) -> dict:
+    with instrumentation.span(symphony_id, category="symphony", stage="reports"):
+        reports.write_lightweight_report(
+            path, title, stats, returns, benchmark_returns)
+    return {}
+
+
+def write_reports(records: typing.List[dict], catalog: typing.Optional[Catalog] = None, mode: str = "quantstats", workers: typing.Optional[int] = None):
+    filename = REPORT_FILENAMES[mode]
+    tasks = []
+    benchmark_returns_by_ticker = {}
     for record in [r for r in records if not is_record_failed(r)]:
         symphony_id = record['symphony_id']
 
-        if not is_record_set_to_force(record) and os.path.exists(get_cache_path(symphony_id, "VectorBT.html")):
+        if is_artifact_fresh(record, filename, catalog=catalog, input_hash=get_input_hash(record, filename)):
             continue
 
         symphony = read_symphony_cache_by_id(symphony_id)
         if not symphony:
             continue
 
-        print(symphony_id)
-
-        returns = pd.read_csv(get_cache_path(
-            symphony_id, "returns.csv"), parse_dates=True, index_col="Date")['group']
+        returns = artifact_store.read_returns(symphony_id)
         benchmark_ticker = record.get("benchmark_ticker", "SPY")
-        closes = get_backtest_data.get_backtest_data(set([benchmark_ticker]))
+        if benchmark_ticker not in benchmark_returns_by_ticker:
+            benchmark_returns_by_ticker[benchmark_ticker] = get_backtest_data.get_backtest_data(
+                set([benchmark_ticker]))[benchmark_ticker].pct_change().dropna()
+        tasks.append((symphony_id, returns, benchmark_returns_by_ticker[benchmark_ticker],
+                     f"{symphony['fields']['name']['stringValue']} - VectorBT ({symphony_id})", get_cache_path(symphony_id, filename)))
 
-        quantstats.reports.html(
-            returns,
-            closes[benchmark_ticker].pct_change().dropna(),
-            title=f"{symphony['fields']['name']['stringValue']} - VectorBT ({symphony_id})",
-            output=get_cache_path(symphony_id, "VectorBT.html"), download_filename=get_cache_path(symphony_id, "VectorBT.html"))
+    records_by_id = {record['symphony_id']: record for record in records}
 
-        record.update({
-            "report_url": f"file://{os.path.abspath(get_cache_path(symphony_id, 'VectorBT.html'))}",
+    def commit_report(symphony_id: str):
+        records_by_id[symphony_id].update({
+            "report_url": f"file://{os.path.abspath(get_cache_path(symphony_id, filename))}",
         })
+        commit_stage(catalog, records_by_id[symphony_id], filename,
+                     input_hash=get_input_hash(records_by_id[symphony_id], filename))
+
+    if mode == "lightweight":
+        lightweight_tasks = [(task[0], task + (records_by_id[task[0]],))
+                             for task in tasks]
+        for result in parallel.run_tasks(write_lightweight_report_task, lightweight_tasks, workers=workers or 1):
+            if result.error:
+                print(f"{result.key}: report failed: {result.error}")
+                continue
+            commit_report(result.key)
+        return
+
+    with instrumentation.span("quantstats_reports", category="quantstats", items=len(tasks)):
+        for result in reports.render_quantstats_reports(tasks, workers=workers):
+            if result.error:
+                # not a failure of the symphony, the report is retried next run
+                print(f"{result.key}: report failed: {result.error}")
+                continue
+            print(result.key)
+            commit_report(result.key)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Download, transpile, backtest and report on every symphony in outputs/symphonies.csv')
+    parser.add_argument('--metrics', dest='metrics', default='outputs/metrics.jsonl',
+                        help='JSONL file for per-stage and per-symphony timings')
+    parser.add_argument('--trace', dest='trace', default='outputs/trace.json',
+                        help='Chrome/Perfetto trace export (chrome://tracing or ui.perfetto.dev)')
+    parser.add_argument('--export-csv', dest='export_csv', action='store_true', default=False,
+                        help='also write allocations.csv, branch_tracker.csv and returns.csv per symphony (artifacts live in outputs/artifacts)')
+    parser.add_argument('--catalog', dest='catalog', default='outputs/symphonies.sqlite',
+                        help='SQLite catalog, every finished stage is committed per symphony so interrupted runs resume')
+    parser.add_argument('--report-mode', dest='report_mode', choices=reports.REPORT_MODES, default='quantstats',
+                        help='quantstats tearsheets (VectorBT.html), or lightweight single-file reports (report.html) from the precomputed stats')
+    parser.add_argument('--workers', dest='workers', type=int, default=1,
+                        help='worker processes per stage (default: 1, everything in this process). failures stay per symphony, results are committed in symphonies.csv order')
+    parser.add_argument('--report-workers', dest='report_workers', type=int, default=None,
+                        help='worker processes rendering reports (default: --workers if given, else one per cpu for quantstats, 1 renders in-process)')
+    args = parser.parse_args()
+
+    instrumentation.start(metrics_path=args.metrics, trace_path=args.trace)
+    report_workers = args.report_workers or (
+        args.workers if args.workers > 1 else None)
+
+    # symphonies.csv is where new symphony ids (and force_update flags) come in, and an export of the catalog
+    catalog = Catalog(args.catalog)
+    new_symphony_ids, forced_symphony_ids = catalog.sync_from_csv(
+        'outputs/symphonies.csv')
+    for record in catalog.load_records():
+        if record['symphony_id'] in new_symphony_ids:
+            mark_existing_artifacts_complete(catalog, record)
+    # if forcing an update, forget past failures and redo every stage
+    for symphony_id in forced_symphony_ids:
+        catalog.reset(symphony_id)
+    for record in catalog.load_records():
+        if is_failure_stale(record):
+            print(f"{record['symphony_id']}: retrying {record['failure_stage']}, its inputs changed since it failed")
+            catalog.clear_failure(record['symphony_id'])
+    # clears force_update, so a resumed run does not start the forced symphonies over
+    catalog.export_csv('outputs/symphonies.csv')
+
+    records = catalog.load_records()
+
+    # How TQQQ for the long term works (useful conditions)
+    # https://www.reddit.com/user/derecknielsen/comments/yorwm0/educating_you_on_how_my_algo_tqqq_for_the_long/?context=3
+
+    # Someone is tracking performance here:
+    # https://docs.google.com/spreadsheets/d/1OnDiuLzfQ8yy6YNuOusdfUmlZvRXsQTPB-kH4O7eHK8/edit#gid=890537793
+
+    # From Discover Page
+    # 1. save copy to drafts
+    # 2. make copy public
+    # 3. paste ids here
+
+    print("Updating community symphonies...")
+    with instrumentation.span("download", items=len(records)):
+        update_community_symphonies(
+            records, catalog=catalog, workers=args.workers)
+    print("Updated community symphonies.")
+
+    print("Reformatting downloaded symphonies to human.txt...")
+    with instrumentation.span("human", items=len(records)):
+        write_human_formats(
+            records, catalog=catalog, workers=args.workers)
+    print("Reformatted downloaded symphonies to human.txt.")
+
+    print("Reformatting downloaded symphonies to vectorbt.py...")
+    with instrumentation.span("vectorbt", items=len(records)):
+        write_vectorbt_formats(
+            records, catalog=catalog, workers=args.workers)
+    print("Reformatted downloaded symphonies to vectorbt.py.")
+
+    print("Building allocation matrixes...")
+    with instrumentation.span("allocations", items=len(records)):
+        build_allocation_matrixes(
+            records, export_csv=args.export_csv, catalog=catalog, workers=args.workers)
+    print("Built allocation matrixes.")
+
+    print("Extracting returns...")
+    with instrumentation.span("returns", items=len(records)):
+        extract_returns(
+            records, export_csv=args.export_csv, catalog=catalog, workers=args.workers)
+    print("Extracted returns.")
+
+    print("Writing reports...")
+    with instrumentation.span("reports", items=len(records)):
+        write_reports(records, catalog=catalog,
+                      mode=args.report_mode, workers=report_workers)
     print("Wrote reports.")
 
     print("Updating symphonies.csv...")
-    df = pd.DataFrame(records)
-    df['force_update'] = ""
-    df = df.set_index("symphony_id")
-    df.to_csv('outputs/symphonies.csv')
+    catalog.export_csv('outputs/symphonies.csv')
+    catalog.close()
     print("Updated symphonies.csv.")
+
+    instrumentation.finish()
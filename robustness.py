@@ -0,0 +1,52 @@
+import argparse
+import time
+
+from lib import artifact_store, get_backtest_data, robustness
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Confidence intervals of CAGR, Sharpe and max drawdown from resampled return paths of cached symphony returns (see populate_symphonies.py)')
+    parser.add_argument('symphony_ids', nargs='*',
+                        help='symphony ids to resample (default: every symphony with returns in outputs/artifacts)')
+    parser.add_argument('-o', '--outfile', dest='outfile', default='outputs/robustness.csv',
+                        help='csv of (symphony_id, method, stat, actual, low, median, high, worse)')
+    parser.add_argument('-n', '--paths', dest='paths', type=int, default=robustness.DEFAULT_PATHS,
+                        help='resampled paths per symphony and method')
+    parser.add_argument('-m', '--method', dest='methods', action='append', choices=robustness.METHODS,
+                        help='resampling method, can be repeated (default: all)')
+    parser.add_argument('--block-days', dest='mean_block_days', type=int, default=robustness.DEFAULT_MEAN_BLOCK_DAYS,
+                        help='mean block length of the stationary bootstrap')
+    parser.add_argument('--confidence', dest='confidence', type=float, default=robustness.DEFAULT_CONFIDENCE,
+                        help='confidence of the low/high interval, 0.9 = 5th to 95th percentile')
+    parser.add_argument('--benchmark', dest='benchmark', default='SPY',
+                        help='ticker whose trend and volatility define the regimes')
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=1,
+                        help='worker processes, a symphony per task')
+    args = parser.parse_args()
+
+    options = robustness.ResamplingOptions(
+        paths=args.paths,
+        methods=args.methods or list(robustness.METHODS),
+        mean_block_days=args.mean_block_days,
+        confidence=args.confidence,
+        seed=args.seed,
+    )
+    returns = artifact_store.load_all_returns(args.symphony_ids or None)
+    benchmark_returns = None
+    if "regime" in options.methods:
+        benchmark_returns = get_backtest_data.get_backtest_data(
+            set([args.benchmark]))[args.benchmark].pct_change().dropna()
+
+    start = time.perf_counter()
+    summary, failures = robustness.summarize_symphonies(
+        returns, options, benchmark_returns=benchmark_returns, workers=args.workers)
+    for symphony_id, failure in failures.items():
+        print(f"{symphony_id}: {failure}")
+    summary.to_csv(args.outfile, index=False)
+    print(f"{summary['symphony_id'].nunique()} symphonies resampled, {len(failures)} failed in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()